@@ -3,6 +3,9 @@ This module contains the `Overlay` object within which the weighted
     overlay analysis takes place
 """
 import os
+import re
+import shutil
+import logging
 import geopandas as gpd
 import geopyspark as gps
 import numpy as np
@@ -10,12 +13,22 @@ import pandas as pd
 import palettable
 import matplotlib.pyplot as plt
 
-from subprocess import call
-from urllib import request
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from urllib.error import URLError
+from shapely.ops import unary_union
 from geonotebook.wrappers import TMSRasterData, VectorData
 
-from overlay import layers, constants  # , health_resources
+from overlay import constants, download, expression, facilities, layers, local, metrics
+from overlay import rasters, sampling, tiles, utils, vector, zonal  # , health_resources
+from overlay.cache import FileCache
+from overlay.grid import Grid
+from overlay.partitioning import SpatialPartitioner
+
+logger = logging.getLogger(__name__)
+
+# layer engines an overlay can be built with
+BACKENDS = {'spark': layers, 'numpy': local}
 
 
 class Overlay(object):
@@ -25,38 +38,70 @@ class Overlay(object):
     Attributes:
         id (string): unique identifier
         study_area (dict): contains geographic extent of analysis
+        backend (string): layer engine, one of the keys of `BACKENDS`
+        grid (grid.Grid): zoom 12 tile grid covering the study area
+        tile_keys ([(int, int)]): layout columns and rows of the tiles the
+            study area touches
+        partitioner (partitioning.SpatialPartitioner): partitioner of the
+            tiles of every layer on the 'spark' backend
+        weights (dict): weight of each hazard in the overlay
+        score_ranges (dict): lowest and highest score of each layer
+        score_range ((int, int)): lowest and highest score the overlay
+            expression can produce, set by `overlay_layers`
+        report (metrics.Report): timings and counters of the run, the
+            report that was active when the overlay was created or its own
         layersets (dict):
     """
 
-    # TODO: clip each to polygon
-
-    def __init__(self, id, spatial_file):
+    def __init__(self, id, spatial_file, backend='spark'):
         """
         Construct overlay object from a study area
 
         Args:
-            spatial_file (string): path to shp or geojson that defines
-                the study area
+            spatial_file (string or gpd.GeoDataFrame): path to shp or
+                geojson that defines the study area, or its features
+            backend (string): 'spark' to build layers with GeoPySpark or
+                'numpy' to build them in memory on this machine, defaults
+                to 'spark'
         """
         self.id = id
+        self.backend = backend
+        self.engine = BACKENDS[backend]
+        self.report = metrics.active() or metrics.Report(id)
+        self.report.labels.setdefault('overlay', id)
         self.study_area = {}
         self.set_study_area(spatial_file)
-
+        self.weights = dict(constants.OVERLAY_WEIGHTS)
+        self.score_ranges = dict(constants.SCORE_RANGES)
+        self.score_range = None
+        self.extra_layers = {}
+        self.extra_sources = {}
+        self.flood = None
+        self.sea_level_rise = None
+        self.storm_surge = None
+        self.input_data = {}
+        self.layer_params = {}
+
+    @metrics.timed('study_area')
     def set_study_area(self, spatial_file):
         """
         Define study are attributes from an input shopefile or geojson
 
         Args:
-            spatial_file (string): filepath for shapefile of geojson
-                that defines the study area
+            spatial_file (string or gpd.GeoDataFrame): filepath for shapefile
+                of geojson that defines the study area, or its features
         """
         # read in study area shp
-        self.study_area['shapefile'] = spatial_file
-        base_gpd = gpd.read_file(spatial_file)
-        base_poly = base_gpd.geometry[0]
+        if isinstance(spatial_file, gpd.GeoDataFrame):
+            base_gpd = spatial_file
+        else:
+            self.study_area['shapefile'] = spatial_file
+            base_gpd = gpd.read_file(spatial_file)
+        base_poly = base_gpd.geometry.iloc[0]
 
         # set the geom and bbox in wgs
         self.study_area['geom_wgs'] = [base_poly]
+        self.study_area['geom_hash'] = utils.geometry_hash(base_poly)
         bbox = list(base_poly.bounds)
         self.study_area['bbox_wgs'] = bbox
 
@@ -68,20 +113,35 @@ class Overlay(object):
 
         # reproject to web mercator
         if not base_gpd.crs == {'init': 'epsg:3857'}:
-            base_poly_wm = base_gpd.to_crs({'init': 'epsg:3857'}).geometry[0]
+            base_poly_wm = base_gpd.to_crs(
+                {'init': 'epsg:3857'}).geometry.iloc[0]
 
         # set the geom and bbox in wm
         self.study_area['geom_wm'] = [base_poly_wm]
         self.study_area['bbox_wm'] = list(base_poly_wm.bounds)
 
+        # tiles the study area touches: hazard inputs are clipped to them
+        #   before they are rasterized or read
+        self.grid = Grid(self.study_area['bbox_wm'])
+        self.tile_keys = self.grid.covering_keys(base_poly_wm)
+        cover = self.grid.cover(self.tile_keys)
+        self.study_area['cover_wm'] = cover
+        self.study_area['cover_wgs'] = gpd.GeoSeries(
+            [cover], crs={'init': 'epsg:3857'}).to_crs({'init': 'epsg:4326'}).iloc[0]
+
+        # one partitioner, sized by the number of tiles, for every layer
+        self.partitioner = SpatialPartitioner(self.tile_keys)
+        metrics.gauge('tiles', len(self.tile_keys))
+        metrics.gauge('partitions', self.partitioner.num_partitions)
+        if self.backend == 'spark':
+            utils.spark_context(num_tiles=len(self.tile_keys))
+
         # tiled raster
-        base_raster = gps.rasterize(
-            [base_poly], 4326, 14, 1, gps.CellType.INT8)
-        base_tiled = base_raster.tile_to_layout(
-            gps.GlobalLayout(zoom=12), 3857)
-        self.base = base_tiled
+        self.base = self.engine.base(self)
 
-    def prep_data(self, flood_hazard_national, sea_level_rise_url, storm_surge_national):
+    @metrics.timed('prep_data')
+    def prep_data(self, flood_hazard_national, sea_level_rise_url, storm_surge_national,
+                  build_cog=False, cache=None, concurrent=False):
         """
         Prepare input datasets for all layers
 
@@ -89,122 +149,392 @@ class Overlay(object):
             flood_hazard_national (string): path to national flood hazard layer
             sea_level_rise_url (string): link to appropriate sea level rise dataset
                 from https://coast.noaa.gov/slrdata/
-            storm_surge_national (string): link to national storm surge tiff
+            storm_surge_national (string or [string]): link to national storm
+                surge tiff, or a list of them to build a stacked storm surge
+                layer with one band per category
+            build_cog (bool): write a tiled, overviewed copy of the national
+                storm surge tiff if there isn't one yet, defaults to False
+            cache (cache.FileCache): cache of prepared inputs, defaults to
+                the cache in `constants.CACHE_DIR`
+            concurrent (bool): prepare the three datasets in parallel threads.
+                A dataset that fails is set to None and its error is kept in
+                `prep_errors` instead of aborting the run, defaults to False
 
         Returns:
             (dict) with paths to all input files of overlay layers
         """
+        if cache is None:
+            cache = FileCache()
+
         # save paths to input files
-        input_data = {}
-
-        def _new_shp_path(national_shp, extension, id):
-            subset_shp = national_shp.replace('/read/', '/write/')
-            return subset_shp.replace(extension, '_{}'.format(id) + extension)
-
-        # flood hazard
-        flood_hazard_study_area = _new_shp_path(
-            flood_hazard_national, '.shp', self.id)
-        if os.path.isfile(flood_hazard_study_area):
-            print('>> Flood hazard dataset already exists for this study area')
-            input_data['flood'] = flood_hazard_study_area
+        input_data, self.prep_errors = _run_stages({
+            'flood': lambda: self._prep_flood(flood_hazard_national, cache),
+            'sea_level': lambda: self._prep_sea_level(sea_level_rise_url, cache),
+            'storm_surge': lambda: self._prep_storm_surge(storm_surge_national,
+                                                          build_cog)
+        }, concurrent)
+        return input_data
+
+    def _prep_flood(self, flood_hazard_national, cache):
+        """
+        Helper function ('private') to clip the national flood hazard layer
+            to the study area
+        """
+        flood_key = cache.key('flood_clip', [flood_hazard_national],
+                              self.study_area['geom_wgs'][0])
+        flood_dir = cache.get(flood_key)
+        if flood_dir is not None:
+            logger.info('Flood hazard dataset already exists for this study area')
         else:
-            print('>> Clipping flood hazard dataset to study area extent...')
-            flood_national = gpd.read_file(flood_hazard_national)
-            flood_study_area = flood_national[
-                flood_national.geometry.intersects(self.study_area['geom_wgs'][0])]
-            if len(flood_study_area) > 0:
-                flood_study_area.to_file(flood_hazard_study_area)
-                input_data['flood'] = flood_hazard_study_area
-            else:
-                print('>> There are no flood hazard zones in this study area')
-                input_data['flood'] = None
+            logger.info('Clipping flood hazard dataset to study area extent...')
+            flood_study_area = vector.read_bbox(flood_hazard_national,
+                                                self.study_area['bbox_wgs'],
+                                                self.study_area['geom_wgs'][0])
+
+            def _write_flood(directory):
+                if len(flood_study_area) > 0:
+                    flood_study_area.to_file(os.path.join(directory, 'flood.shp'))
+
+            flood_dir = cache.put(flood_key, _write_flood,
+                                  source=flood_hazard_national,
+                                  study_area=self.id)
+        flood_shp = os.path.join(flood_dir, 'flood.shp')
+        if os.path.isfile(flood_shp):
+            return flood_shp
+        logger.info('There are no flood hazard zones in this study area')
+        return None
+
+    def _prep_sea_level(self, sea_level_rise_url, cache):
+        """
+        Helper function ('private') to download and extract the sea level
+            rise geodatabase
+        """
+        if sea_level_rise_url is None:
+            logger.info('No sea level rise input')
+            return None
 
-        # sea level rise
         #   define file and directory names
-        if sea_level_rise_url is None:
-            print('>> No sea level rise input')
-            input_data['sea_level'] = None
-        else:
-            sea_level_directory = constants.SEA_LEVEL_DIR
-            zip_file_name = os.path.basename(
-                os.path.normpath(sea_level_rise_url))
-            zip_dir_name = zip_file_name.replace('.zip', '')
-            zip_path = os.path.join(sea_level_directory, zip_file_name)
-            gdb_directory = os.path.join(sea_level_directory, zip_dir_name)
-            gdb_file = (zip_dir_name + '.gdb').replace('data', 'final')
-            gdb = os.path.join(gdb_directory, gdb_file)
+        zip_file_name = os.path.basename(
+            os.path.normpath(sea_level_rise_url))
+        zip_dir_name = zip_file_name.replace('.zip', '')
+        gdb_file = (zip_dir_name + '.gdb').replace('data', 'final')
+        #   the key follows the version of the archive on the server
+        try:
+            sea_key = cache.key('sea_level_rise', [sea_level_rise_url])
+        except (URLError, HTTPException, OSError) as e:
+            sea_key = cache.latest(source=sea_level_rise_url)
+            if sea_key is None:
+                raise
+            logger.warning('Could not check {} for changes ({}), using the last download'.format(
+                sea_level_rise_url, e))
+        legacy_gdb = os.path.join(constants.SEA_LEVEL_DIR, gdb_file)
+        #   concurrent requests for the url wait for one download
+        with download.url_lock(sea_level_rise_url):
+            sea_dir = cache.get(sea_key)
             #   avoid downloading if the file is already there
-            if os.path.isdir(gdb):
-                print(
-                    '>> Sea level rise dataset has already been downloaded for this study area')
+            if sea_dir is not None:
+                logger.info(
+                    'Sea level rise dataset has already been downloaded for this study area')
+            elif os.path.isdir(legacy_gdb):
+                logger.info('Copying sea level rise geodatabase from {} into the cache...'.format(
+                    constants.SEA_LEVEL_DIR))
+                sea_dir = cache.put(sea_key,
+                                    lambda directory: shutil.copytree(
+                                        legacy_gdb, os.path.join(directory, gdb_file)),
+                                    source=sea_level_rise_url)
             else:
-                print('>> Downloading sea level rise dataset...')
-                request.urlretrieve(sea_level_rise_url, zip_path)
-                print('>> Extracting sea level rise dataset...')
-                ZipFile(zip_path).extractall(gdb_directory)
-                os.system('rm {}'.format(zip_path))
-            input_data['sea_level'] = gdb
-
-        # storm surge
-        storm_surge_study_area = _new_shp_path(
-            storm_surge_national, '.tif', self.id)
-        if os.path.isfile(storm_surge_study_area):
-            print(
-                '>> Storm surge tiffs have already been created for this study area')
-        else:
-            args_storm = self.study_area[
-                'bbox_wgs'] + [storm_surge_national, storm_surge_study_area]
-            cmd_storm = 'gdalwarp -overwrite -te {}'.format(
-                ' '.join(map(str, args_storm)))
-            print('>> Clipping storm surge raster to study area extent...')
-            call(cmd_storm, shell=True)
-        input_data['storm_surge'] = storm_surge_study_area
-
-        return input_data
-
-    def build_layers(self, input_data):
+                #   stage outside of the cache entry so a failed download
+                #   resumes on the next attempt
+                staging = cache.path(sea_key) + '.download'
+
+                def _write_sea_level(directory):
+                    logger.info('Downloading sea level rise geodatabase...')
+                    download.extract_members(sea_level_rise_url, staging)
+                    for name in os.listdir(staging):
+                        os.rename(os.path.join(staging, name),
+                                  os.path.join(directory, name))
+                    os.rmdir(staging)
+
+                sea_dir = cache.put(sea_key, _write_sea_level,
+                                    source=sea_level_rise_url)
+        return os.path.join(sea_dir, gdb_file)
+
+    def _prep_storm_surge(self, storm_surge_national, build_cog):
+        """
+        Helper function ('private') to find the storm surge rasters to read
+            by window at build time, from the tiled copies if there are any
+        """
+        storm_surge_tiffs = []
+        for storm_tiff in (storm_surge_national if isinstance(storm_surge_national, list)
+                           else [storm_surge_national]):
+            if build_cog:
+                rasters.build_cog(storm_tiff)
+            if rasters.has_cog(storm_tiff):
+                logger.info('Using tiled copy of {}'.format(os.path.basename(storm_tiff)))
+                storm_surge_tiffs.append(rasters.cog_path(storm_tiff))
+            else:
+                storm_surge_tiffs.append(storm_tiff)
+        if isinstance(storm_surge_national, list):
+            return storm_surge_tiffs
+        return storm_surge_tiffs[0]
+
+    @metrics.timed('build_layers')
+    def build_layers(self, input_data, catalog=None, feet=5, slr_scenarios=False,
+                     storm_category=None, concurrent=False):
         """
         Build all three layers from input files
 
         Args:
             input_data (dict): dict with input filenames output or prep_data
+            catalog (catalog.LayerCatalog): catalog to read previously built
+                layers from and write new ones to. Only used by the 'spark'
+                backend, defaults to None
+            feet (int): feet of sea level rise, defaults to 5
+            slr_scenarios (bool): if True, read every sea level rise scenario
+                of the geodatabase once into `sea_level_rise_depths`, so
+                `set_sea_level_rise` can switch scenarios without rebuilding,
+                defaults to False
+            storm_category (int): storm category to select when the storm
+                surge input is a list of one tiff per category. None selects
+                the worst case across categories, defaults to None
+            concurrent (bool): build the three layers in parallel threads. A
+                layer that fails is set to None and its error is kept in
+                `build_errors` instead of aborting the run, defaults to False
         """
-        self.flood = layers.flood_hazard(self, input_data['flood'])
-        self.sea_level_rise = layers.sea_level_rise(
-            self, input_data['sea_level'])
-        self.storm_surge = layers.storm_surge(self, input_data['storm_surge'])
+        if self.backend != 'spark':
+            catalog = None
+
+        def _build(name, build, source, **params):
+            if catalog is None or source is None:
+                return build()
+            key = catalog.key(self, name, source, **params)
+            layer = catalog.get(self, key)
+            if layer is None:
+                layer = build()
+                if layer is not None:
+                    catalog.put(key, layer, layer=name, study_area=self.id,
+                                source=source, params=params)
+            return layer
+
+        def _build_flood():
+            return _build('flood',
+                          lambda: self.engine.flood_hazard(
+                              self, input_data['flood']),
+                          input_data['flood'])
+
+        def _build_sea_level_rise():
+            if slr_scenarios:
+                self.sea_level_rise_depths = _build('sea_level_rise_depths',
+                                                    lambda: self.engine.sea_level_rise_depths(
+                                                        self, input_data['sea_level']),
+                                                    input_data['sea_level'])
+                return self.engine.sea_level_rise_from_depths(
+                    self, self.sea_level_rise_depths, feet)
+            return _build('sea_level_rise',
+                          lambda: self.engine.sea_level_rise(
+                              self, input_data['sea_level'], feet),
+                          input_data['sea_level'],
+                          feet=feet)
+
+        def _build_storm_surge():
+            if isinstance(input_data['storm_surge'], list):
+                self.storm_surge_stack = _build('storm_surge_stack',
+                                                lambda: self.engine.storm_surge_stack(
+                                                    self, input_data['storm_surge']),
+                                                input_data['storm_surge'])
+                return self.engine.select_storm_category(
+                    self.storm_surge_stack, storm_category)
+            return _build('storm_surge',
+                          lambda: self.engine.storm_surge(
+                              self, input_data['storm_surge']),
+                          input_data['storm_surge'])
+
+        self.input_data = input_data
+        self.layer_params = {'feet': feet, 'storm_category': storm_category}
+        self.sea_level_rise_depths = None
+        self.storm_surge_stack = None
+        built, self.build_errors = _run_stages({
+            'flood': _build_flood,
+            'sea_level_rise': _build_sea_level_rise,
+            'storm_surge': _build_storm_surge
+        }, concurrent)
+        self.flood = built['flood']
+        self.sea_level_rise = built['sea_level_rise']
+        self.storm_surge = built['storm_surge']
+
+    @metrics.timed('set_sea_level_rise')
+    def set_sea_level_rise(self, feet):
+        """
+        Switch the sea level rise layer to another scenario, derived from the
+            layer of minimum inundating rise built by
+            `build_layers(..., slr_scenarios=True)`
 
-    def overlay_layers(self):
+        Args:
+            feet (int): feet of sea level rise
         """
-        Add all three layers together
+        self.sea_level_rise = self.engine.sea_level_rise_from_depths(
+            self, self.sea_level_rise_depths, feet)
+        self.layer_params['feet'] = feet
+        logger.info('Set sea level rise scenario to {} ft'.format(feet))
+
+    @metrics.timed('select_storm_category')
+    def select_storm_category(self, category=None):
+        """
+        Switch the storm surge layer to another storm category, selected from
+            the stacked layer built when the storm surge input is a list of
+            one tiff per category
+
+        Args:
+            category (int): storm category from 1 to 5. None selects the
+                worst case across categories, defaults to None
         """
-        l = [self.flood, self.sea_level_rise, self.storm_surge]
-        l = list(filter(None.__ne__, l))
-        self.overlay = sum(l) - len(l)
-        print('>> Combined {} layers into climate risk surface'.format(len(l)))
+        self.storm_surge = self.engine.select_storm_category(
+            self.storm_surge_stack, category)
+        self.layer_params['storm_category'] = category
+        logger.info('Set storm surge to {}'.format(
+            'worst case' if category is None else 'category {}'.format(category)))
+
+    def add_layer(self, name, layer, weight=1, source=None, score_range=(1, 5)):
+        """
+        Register another hazard layer for the overlay, e.g. wildfire or heat.
+            Like the built hazards, it should score cells from 1 (no hazard)
+            on the overlay's grid.
+
+        Args:
+            name (string): layer name
+            layer (gps.TiledRasterLayer or local.LocalLayer): the layer
+            weight (int): weight of the layer in the overlay, defaults to 1
+            source (str): input file the layer was built from, used to key
+                the overlay's map tiles, defaults to None
+            score_range ((int, int)): lowest and highest score of the layer,
+                defaults to (1, 5)
+        """
+        self.extra_layers[name] = layer
+        self.extra_sources[name] = source
+        self.weights[name] = weight
+        self.score_ranges[name] = score_range
+
+    @property
+    def hazards(self):
+        """
+        (dict): name to layer of every hazard that has been built or added
+        """
+        hazards = {'flood': self.flood,
+                   'sea_level_rise': self.sea_level_rise,
+                   'storm_surge': self.storm_surge}
+        hazards.update(self.extra_layers)
+        return {name: layer for name, layer in hazards.items() if layer is not None}
+
+    @metrics.timed('overlay_layers')
+    def overlay_layers(self, expr=None, keys=None):
+        """
+        Combine the hazard layers into the climate risk surface in one pass
+            over their tiles, find the range of its scores in `score_range`,
+            and key the result by what it was built from in `overlay_key`,
+            so its map tiles can be cached
+
+        Args:
+            expr (expression.Expression): overlay of the layers in `hazards`
+                and 'base'. Defaults to the weighted sum of the hazards with
+                `weights`
+            keys ([(int, int)]): only compute the tiles at these layout
+                columns and rows, e.g. the tiles with points to sample,
+                defaults to None
+        """
+        hazards = self.hazards
+        if expr is None:
+            expr = expression.weighted_overlay(
+                {name: self.weights.get(name, 1) for name in hazards})
+        program = expression.Program(expr)
+        self.overlay = self.engine.weighted_overlay(self, program, hazards, keys)
+        self.score_range = program.score_range(self.score_ranges)
+
+        sources = []
+        for name in sorted(self.input_data):
+            source = self.input_data[name]
+            for s in (source if isinstance(source, list) else [source]):
+                sources.append(utils.file_identity(s)
+                               if s is not None and os.path.exists(s) else s)
+        self.overlay_key = utils.hash_key(
+            self.backend,
+            self.study_area['geom_hash'],
+            sources,
+            self.layer_params,
+            sorted(hazards),
+            [self.extra_sources.get(name) for name in sorted(self.extra_layers)],
+            expr.key,
+            None if keys is None else sorted(keys))
+        logger.info('Combined {} layers into climate risk surface'.format(len(hazards)))
+
+    @metrics.timed('zonal_statistics')
+    def zonal_statistics(self, zones, id_field=None,
+                         at_risk_score=constants.AT_RISK_SCORE):
+        """
+        Summarize the climate risk surface by zone, e.g. by county, tract or
+            ZIP code, in one pass over the surface
+
+        Args:
+            zones (string or gpd.GeoDataFrame): path to zone polygons, or
+                their features
+            id_field (string): attribute that identifies each zone, defaults
+                to the row index
+            at_risk_score (int): lowest risk score that counts as at risk,
+                defaults to `constants.AT_RISK_SCORE`
+
+        Returns:
+            (pd.DataFrame): risk score histogram, mean score and area at risk
+                of every zone
+        """
+        if not isinstance(zones, gpd.GeoDataFrame):
+            zones = gpd.read_file(zones)
+        logger.info('Computing zonal statistics for {} zones...'.format(len(zones)))
+        return zonal.zonal_statistics(self.overlay, self.grid, zones, id_field,
+                                      at_risk_score, self.score_range)
 
 
 # Additional Functions
 
 
-def map_layer(geonotebook, tiled_layer, color_map=None, remove_existing=True):
+@metrics.timed('map_layer')
+def map_layer(geonotebook, tiled_layer, color_map=None, remove_existing=True,
+              key=None, tile_cache=None, score_range=None, tile_host=None):
     """
     Add a tiled raster layer to the map in a Geonotebook
 
     geonotebook (geonotebook.kernel.Geonotebook): Geonotebook to add to
-    tiled_layer (TiledRasterLayer): the layer to add to the map
+    tiled_layer (TiledRasterLayer or local.LocalLayer): the layer to add to
+        the map
     color_map (color.ColorMap): color map used to map the layer. If none,
-        construct a colormap from Matplotlib 'magma', defaults to None
+        construct a colormap from Matplotlib 'magma', or use the fixed
+        overlay score colors if `key` is given, defaults to None
+    key (str): key of an overlay layer, e.g. `Overlay.overlay_key`. If
+        given with no color map, the layer's tiles are rendered once with
+        `tiles.fixed_color_map` into the tile cache and served from disk,
+        so mapping the same layer again doesn't use Spark, defaults to None
+    tile_cache (cache.FileCache): tile cache, defaults to the cache in
+        `constants.TILE_CACHE_DIR`
+    score_range ((int, int)): lowest and highest score of the overlay layer
+        colored by `tiles.fixed_color_map`, e.g. `Overlay.score_range`,
+        defaults to the range of the default weighted overlay
+    tile_host (str): address the server of cached tiles binds to, defaults
+        to the loopback interface. Use e.g. '0.0.0.0' when the browser
+        fetches tiles from a remote notebook host such as an EMR master, as
+        described in `overlay.tiles`
     """
-    print('>> Creating pyramid layer...')
-    pyramid_layer = tiled_layer.pyramid()
-    if color_map is None:
-        print('>> Getting layer histogram...')
-        color_map = gps.ColorMap.build(pyramid_layer.get_histogram(), 'magma')
-    tms = gps.TMS.build(pyramid_layer, color_map)
+    if key is not None and color_map is None:
+        tms = tiles.cached_tms(tiled_layer, key, tile_cache, score_range, tile_host)
+    else:
+        if isinstance(tiled_layer, local.LocalLayer):
+            tiled_layer = tiled_layer.to_tiled_layer()
+        logger.info('Creating pyramid layer...')
+        pyramid_layer = tiled_layer.pyramid()
+        if color_map is None:
+            logger.info('Getting layer histogram...')
+            color_map = gps.ColorMap.build(pyramid_layer.get_histogram(), 'magma')
+        tms = gps.TMS.build(pyramid_layer, color_map)
     if remove_existing:
         remove_map_layers(geonotebook)
-    print('>> Adding weighted overlay layer to map...')
+    logger.info('Adding weighted overlay layer to map...')
     geonotebook.add_layer(TMSRasterData(tms), name="layer")
 
 
@@ -214,11 +544,12 @@ def remove_map_layers(geonotebook):
 
     geonotebook (geonotebook.kernel.Geonotebook): Geonotebook with layers to remove
     """
-    print('>> Removing existing layers from map...')
+    logger.info('Removing existing layers from map...')
     for l in geonotebook.layers:
         geonotebook.remove_layer(l)
 
 
+@metrics.timed('overlay_analysis')
 def overlay_analysis(geonotebook,
                      overlay_name,
                      boundary_shp,
@@ -227,7 +558,10 @@ def overlay_analysis(geonotebook,
                      sea_url=None,
                      storm=constants.NATL_STORM_SURGE_1,
                      flood=constants.NATL_FLOOD_SHP,
-                     color_map=None):
+                     color_map=None,
+                     backend='spark',
+                     catalog=None,
+                     storm_category=None):
     """
     This function wraps all steps in the overlay analysis pipeline
 
@@ -236,39 +570,46 @@ def overlay_analysis(geonotebook,
         overlay_name (str): id for overlay object
         boundary_shp (str): path to shapefile that defines study area
         sea (str): url for sea level rise input dataset
-        storm (str): national storm surge dataset
+        storm (str or [str]): national storm surge dataset, or one per
+            storm category (e.g. `constants.NATL_STORM_SURGE`)
         flood (str): national flood dataset
         color_map (gps.ColorMap): color map to use in mapping the result. If
             None, it will construct one using Matplotlib color ramp 'magma'
+        backend (str): 'spark' or 'numpy' layer engine, defaults to 'spark'
+        catalog (catalog.LayerCatalog): catalog of previously built layers,
+            defaults to None
+        storm_category (int): storm category to select when `storm` is a
+            list, None for the worst case, defaults to None
 
     Returns:
         (analysis.Overlay): overlay object for the specified layer
     """
 
     # set up study area in GeoNotebook
-    print('Overlay context')
-    print('>> Defining study area boundaries...')
-    ov = Overlay(overlay_name, boundary_shp)
-    print('>> Setting geonotebook view extent...')
+    logger.info('Overlay context')
+    logger.info('Defining study area boundaries...')
+    ov = Overlay(overlay_name, boundary_shp, backend)
+    logger.info('Setting geonotebook view extent...')
     geonotebook.set_center(ov.study_area['centroid_wgs'][
                            'x'], ov.study_area['centroid_wgs']['y'], 10)
 
     # pre-process data
-    print('Data preparation')
+    logger.info('Data preparation')
     input_data = ov.prep_data(flood, sea_url, storm)
 
     # build layers
-    print('Analysis')
-    print('>> Building layers...')
-    ov.build_layers(input_data)
+    logger.info('Analysis')
+    logger.info('Building layers...')
+    ov.build_layers(input_data, catalog, storm_category=storm_category)
 
     # overlay layers
-    print('>> Combining layers...')
+    logger.info('Combining layers...')
     ov.overlay_layers()
 
     # add weighted overlay to map
-    print('Add to map')
-    map_layer(geonotebook, ov.overlay, color_map)
+    logger.info('Add to map')
+    map_layer(geonotebook, ov.overlay, color_map, key=ov.overlay_key,
+              score_range=ov.score_range)
 
     # get raster values at certain points
     input_file = os.path.basename(
@@ -290,7 +631,153 @@ def overlay_analysis(geonotebook,
         p = plot_risk_score_counts(study_area_points_df, input_points.lower())
         return ov, p
     except OSError:
-        print('Try evaluating risk for a broader study area or a different health resource')
+        logger.warning('Try evaluating risk for a broader study area or a '
+                       'different health resource')
+
+
+@metrics.timed('batch_overlay_analysis')
+def batch_overlay_analysis(study_areas,
+                           input_points,
+                           sea_url=None,
+                           storm=constants.NATL_STORM_SURGE_1,
+                           flood=constants.NATL_FLOOD_SHP,
+                           backend='spark',
+                           catalog=None,
+                           name_field='NAME'):
+    """
+    Run the overlay analysis for many study areas at once. The national
+        inputs are read, clipped and rasterized once for the union of all
+        study areas, and the study areas are numbered once in a zone layer
+        on the same grid. The health facilities of every study area are then
+        scored in one pass over the combined surface and the zone layer, a
+        facility belonging to the study area of the cell it falls in, and
+        each area's outputs are written at the end.
+
+    Args:
+        study_areas (str or [(str, str)]): boundary file in which every
+            feature is a study area (e.g. `constants.NATL_MSA_SHP`), or a
+            list of (overlay name, boundary shapefile) pairs. Study areas
+            should not overlap; where they do, cells belong to the one that
+            comes last.
+        input_points (str): health facility category to score
+        sea_url (str): url for sea level rise input dataset
+        storm (str or [str]): national storm surge dataset, or one per
+            storm category for the worst case across categories
+        flood (str): national flood dataset
+        backend (str): 'spark' or 'numpy' layer engine, defaults to 'spark'.
+            The 'numpy' backend holds the union of all study areas in
+            memory, so it only suits areas that are close together.
+        catalog (catalog.LayerCatalog): catalog of previously built layers,
+            defaults to None
+        name_field (str): attribute that names each feature of a boundary
+            file, defaults to 'NAME'
+
+    Returns:
+        (analysis.Overlay, layer, dict): overlay object of the union of the
+            study areas, whose overlay layer only holds the tiles with
+            health facilities, its zone layer, in which each cell holds the
+            position of its study area counting from 1, and overlay name to
+            the scored health facilities of each study area, None where
+            there are none
+    """
+    logger.info('Overlay context')
+    logger.info('Defining study area boundaries...')
+    if isinstance(study_areas, str):
+        boundaries = gpd.read_file(study_areas)
+        names = [_overlay_name(name) for name in boundaries[name_field]]
+    else:
+        files = [gpd.read_file(f) for _, f in study_areas]
+        boundaries = gpd.GeoDataFrame(geometry=[f.geometry.iloc[0] for f in files],
+                                      crs=files[0].crs)
+        names = [name for name, _ in study_areas]
+    union = gpd.GeoDataFrame(geometry=[unary_union(list(boundaries.geometry))],
+                             crs=boundaries.crs)
+    batch = Overlay('batch', union, backend)
+
+    # pre-process data once for all study areas
+    logger.info('Data preparation')
+    input_data = batch.prep_data(flood, sea_url, storm)
+
+    # build and combine layers once for all study areas
+    logger.info('Analysis')
+    logger.info('Building layers...')
+    batch.build_layers(input_data, catalog)
+
+    # only the tiles with health facilities are sampled, so only those
+    #   tiles of the surface are combined
+    health_points_file = constants.HEALTH_RESOURCE_FILES[input_points]
+    health = vector.read_bbox(health_points_file, batch.study_area['bbox_wm'])
+    logger.info('Combining layers...')
+    batch.overlay_layers(keys=batch.grid.point_keys(health.geometry.x.values,
+                                                    health.geometry.y.values))
+
+    # number the study areas on the same grid
+    logger.info('Rasterizing {} study areas...'.format(len(names)))
+    with metrics.span('zones'):
+        zones = batch.engine.zones(
+            batch, list(boundaries.to_crs({'init': 'epsg:3857'}).geometry))
+
+    # score the health facilities of every study area in one pass
+    logger.info('Scoring health facilities of every study area...')
+    with metrics.span('get_health_point_values'):
+        scores, area_numbers = sampling.sample_zones(batch.overlay, zones, health,
+                                                     batch.partitioner, fill=0.0)
+    inside = area_numbers > 0
+    health = health[inside].copy()
+    health['risk_score'] = scores[inside]
+    area_numbers = area_numbers[inside]
+    metrics.count('features_scored', len(health))
+
+    # write the outputs of each study area
+    input_file = os.path.basename(health_points_file)
+    results = {name: None for name in names}
+    for number, area_points in health.groupby(area_numbers):
+        name = names[number - 1]
+        output_file = os.path.join(constants.OUTPUT_DIR, input_file.replace(
+            '.shp', '_{}.shp'.format(name)))
+        area_points.to_file(output_file)
+        results[name] = pd.DataFrame(area_points)
+        results[name].to_csv(output_file.replace('.shp', '.csv'), index=False)
+    missing = [name for name, scored in results.items() if scored is None]
+    if len(missing) > 0:
+        logger.warning('None of these health resources are located within {} '
+                       'of the study areas'.format(len(missing)))
+    return batch, zones, results
+
+
+def _run_stages(stages, concurrent=False):
+    """
+    Helper function ('private') to run independent stages of the analysis,
+        one after another or in parallel threads, each timed as a stage of
+        the running one. In parallel, a stage that raises is reported and
+        returns None instead of aborting the others.
+    """
+    def _timed(name, stage):
+        with metrics.span(name):
+            return stage()
+
+    if not concurrent:
+        return {name: _timed(name, stage) for name, stage in stages.items()}, {}
+
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        futures = {name: executor.submit(metrics.bind(_timed), name, stage)
+                   for name, stage in stages.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.warning('{} failed: {!r}'.format(name, e))
+                results[name] = None
+                errors[name] = e
+    return results, errors
+
+
+def _overlay_name(name):
+    """
+    Helper function ('private') to turn a boundary name into an overlay id
+    """
+    return re.sub('[^0-9a-zA-Z]+', '_', name).strip('_').lower()
 
 
 def reproject_wgs(file, directory):
@@ -320,7 +807,9 @@ def add_points(geonotebook, shp, name='health', colors=[0xFFFFFF]):
     geonotebook.add_layer(VectorData(shp), name=name, colors=colors)
 
 
-def get_health_point_values(health_points, overlay, output_file):
+@metrics.timed('get_health_point_values')
+def get_health_point_values(health_points, overlay, output_file, health=None,
+                            index=None):
     """
     Get raster values at the locations of specified health resources. Subset
         a point file to the study area, add raster values as a attribute and
@@ -330,26 +819,85 @@ def get_health_point_values(health_points, overlay, output_file):
         health_points (str): point layer to measure raster values at
         overlay (overlay.Overlay): with overlay tiled layer to get values from
         output_file (string): output shp
+        health (gpd.GeoDataFrame): facilities already read from the point
+            layer, at least those in the study area. If None, they are read
+            from the file, defaults to None
+        index (facilities.FacilityIndex): index to find the facilities in
+            the study area with instead of reading the point layer, defaults
+            to None
     """
     # suppress unnecessary `SettingWithCopy` warnings
     pd.options.mode.chained_assignment = None  # default='warn'
-    health_points_file = constants.HEALTH_RESOURCE_FILES[health_points]
-    health = gpd.read_file(health_points_file)
-    health_study_area = health[health.within(
-        overlay.study_area['geom_wm'][0])]
-    try:
-        pt_vals = overlay.overlay.get_point_values(
-            list(health_study_area.geometry))
-        values = list(map(lambda x: 0.0 if np.isnan(
-            x[1][0]) else x[1][0], pt_vals))
-        health_study_area['risk_score'] = values
-        health_study_area.to_file(output_file)
-        output_csv = output_file.replace('.shp', '.csv')
-        hsa_df = pd.DataFrame(health_study_area)
-        hsa_df.to_csv(output_csv, index=False)
-        return hsa_df
-    except TypeError:
-        print('None of these health resources are located within the study area')
+    if index is not None:
+        health_study_area = index.within(overlay.study_area['geom_wm'][0],
+                                         [health_points])
+    else:
+        if health is None:
+            health_points_file = constants.HEALTH_RESOURCE_FILES[health_points]
+            health = vector.read_bbox(health_points_file,
+                                      overlay.study_area['bbox_wm'])
+        health_study_area = health[health.within(
+            overlay.study_area['geom_wm'][0])]
+    if len(health_study_area) == 0:
+        logger.warning('None of these health resources are located within the study area')
+        return None
+    health_study_area['risk_score'] = sampling.sample(overlay.overlay,
+                                                      health_study_area,
+                                                      fill=0.0)
+    metrics.count('features_scored', len(health_study_area))
+    health_study_area.to_file(output_file)
+    output_csv = output_file.replace('.shp', '.csv')
+    hsa_df = pd.DataFrame(health_study_area)
+    hsa_df.to_csv(output_csv, index=False)
+    return hsa_df
+
+
+@metrics.timed('facility_risk_report')
+def facility_risk_report(overlay, output_dir=constants.OUTPUT_DIR, index=None,
+                         categories=None):
+    """
+    Score the health facilities of every category in a study area in one
+        pass, and write a shapefile and a csv per category plus combined
+        ones
+
+    Args:
+        overlay (overlay.Overlay): with overlay tiled layer to get values from
+        output_dir (str): directory for the output files, defaults to
+            `constants.OUTPUT_DIR`
+        index (facilities.FacilityIndex): facility index, defaults to the
+            index of `constants.HEALTH_RESOURCE_FILES`
+        categories ([str]): categories to score, defaults to all of them
+
+    Returns:
+        (pd.DataFrame, dict): scored facilities of all categories, and the
+            same split by category
+    """
+    if index is None:
+        index = facilities.default_index()
+    logger.info('Scoring health facilities...')
+    scored, by_category = index.score(overlay, categories)
+    if len(scored) == 0:
+        logger.warning('None of these health resources are located within the study area')
+        return None, {}
+
+    def _write(gdf, output_file):
+        gdf.to_file(output_file)
+        df = pd.DataFrame(gdf)
+        df.to_csv(output_file.replace('.shp', '.csv'), index=False)
+        return df
+
+    reports = {}
+    for category, gdf in by_category.items():
+        input_file = os.path.basename(constants.HEALTH_RESOURCE_FILES.get(
+            category, _overlay_name(category) + '.shp'))
+        reports[category] = _write(gdf, os.path.join(
+            output_dir, input_file.replace('.shp', '_{}.shp'.format(overlay.id))))
+    # keep the attributes that every category has
+    common = [c for c in scored.columns
+              if all(c in gdf.columns for gdf in by_category.values())]
+    combined = _write(scored[common],
+                      os.path.join(output_dir, 'HealthFacilities_{}.shp'.format(overlay.id)))
+    return combined, reports
 
 
 def plot_risk_score_counts(health_facility_df, facility_type):
@@ -0,0 +1,436 @@
+"""
+Benchmark every stage of an overlay analysis on synthetic national inputs
+
+`run` writes synthetic national datasets at a given scale with
+    `synthetic.make_sources`, then runs the stages of an analysis on them in
+    order: starting Spark, reading the study area and building its base,
+    `prep_data`, `build_layers`, `overlay_layers`, `map_layer`,
+    `get_health_point_values` for every facility category and
+    `zonal_statistics` by county. Each stage records its wall time, the peak
+    resident memory of this process and of the processes it started (the
+    Spark JVM and Python workers in local mode), and the task metrics of the
+    Spark jobs it ran, read from the monitoring REST API of the Spark UI.
+    Results are written to JSON with the commit they were measured at and
+    the run's `metrics.Report`, in which every stage is timed under a
+    'benchmark' span, so runs at different commits can be lined up with
+    `compare`.
+
+Nothing is downloaded: the sea level rise archive is read from a file:// url
+    and Spark runs in local mode, so a benchmark runs on one Linux machine
+    without a network, e.g.
+
+    python -m overlay.benchmark /tmp/overlay-benchmark --scale 4
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import subprocess
+import tempfile
+import logging
+import pandas as pd
+
+from urllib import request
+from urllib.error import URLError
+
+from overlay import analysis, constants, metrics, synthetic, utils
+from overlay.cache import FileCache
+from overlay.facilities import FacilityIndex
+
+logger = logging.getLogger(__name__)
+
+# task metrics of the Spark stages of a job that are summed per benchmark stage
+SPARK_TASK_METRICS = ['executorRunTime', 'executorCpuTime', 'jvmGcTime',
+                      'inputBytes', 'inputRecords', 'outputBytes', 'outputRecords',
+                      'shuffleReadBytes', 'shuffleReadRecords', 'shuffleWriteBytes',
+                      'shuffleWriteRecords', 'memoryBytesSpilled', 'diskBytesSpilled']
+
+
+def run(directory, scale=1, backend='spark', seed=0, output=None,
+        master=constants.BENCHMARK_SPARK_MASTER, memory=constants.SPARK_DRIVER_MEMORY):
+    """
+    Benchmark the stages of an overlay analysis on synthetic inputs
+
+    Args:
+        directory (str): directory for the synthetic inputs, which are kept
+            and reused by later runs at the same scale and seed, and for the
+            default output file
+        scale (float): size of the study area and number of features,
+            relative to `synthetic.DEFAULT_BBOX`, defaults to 1
+        backend (str): 'spark' or 'numpy', defaults to 'spark'
+        seed (int): random seed of the synthetic inputs, defaults to 0
+        output (str): JSON file to write the results to, defaults to a file
+            in `directory` named after the commit, backend and scale
+        master (str): Spark master url, used if no Spark context is running,
+            defaults to `constants.BENCHMARK_SPARK_MASTER`
+        memory (str): Spark driver memory, e.g. '12G'
+
+    Returns:
+        (dict): the results, with a record per stage under 'stages'
+    """
+    results = environment()
+    results.update({'backend': backend, 'scale': scale, 'seed': seed})
+
+    start = time.perf_counter()
+    sources = _sources(os.path.join(directory, 'sources_x{}_{}'.format(scale, seed)),
+                       scale, seed)
+    results['generate_seconds'] = time.perf_counter() - start
+
+    work = tempfile.mkdtemp(prefix='run_', dir=directory)
+    ov = None
+    sc = None
+    results['stages'] = []
+    report = metrics.Report('benchmark', {'backend': backend, 'scale': scale})
+    try:
+        stages = [
+            ('spark_context', lambda: utils.spark_context(memory=memory, master=master)),
+            ('study_area', lambda: analysis.Overlay('benchmark', sources['study_area'],
+                                                    backend)),
+            ('prep_data', lambda: ov.prep_data(sources['flood'],
+                                               sources['sea_level_rise_url'],
+                                               sources['storm_surge'],
+                                               cache=FileCache(os.path.join(work, 'cache')))),
+            ('build_layers', lambda: ov.build_layers(input_data)),
+            ('overlay_layers', lambda: ov.overlay_layers()),
+            ('map_layer', lambda: analysis.map_layer(_Headless(), ov.overlay,
+                                                     key=ov.overlay_key,
+                                                     tile_cache=FileCache(
+                                                         os.path.join(work, 'tiles')),
+                                                     score_range=ov.score_range)),
+            ('get_health_point_values', lambda: _health_point_values(
+                ov, sources['facilities'], work)),
+            ('zonal_statistics', lambda: ov.zonal_statistics(sources['counties'],
+                                                             id_field='GEOID'))
+        ]
+        with report.span('benchmark'):
+            for name, stage in stages:
+                result, record = measure(name, stage, sc)
+                results['stages'].append(record)
+                if 'error' in record:
+                    logger.warning('Stopping the benchmark, {} failed: {}'.format(
+                        name, record['error']))
+                    break
+                if name == 'spark_context':
+                    sc = result
+                elif name == 'study_area':
+                    ov = result
+                    results['tiles'] = len(ov.tile_keys)
+                    results['partitions'] = ov.partitioner.num_partitions
+                elif name == 'prep_data':
+                    input_data = result
+        results['spark_conf'] = utils.effective_conf(sc)
+        results['report'] = report.to_dict()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if output is None:
+        output = os.path.join(directory, 'benchmark_{}_{}_x{}.json'.format(
+            (results['commit'] or 'unknown')[:10], backend, scale))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    logger.info('Benchmark results written to {}'.format(output))
+    return results
+
+
+def measure(name, stage, sc=None):
+    """
+    Run one stage and measure its wall time, peak memory and Spark task
+        metrics. Errors are recorded instead of raised.
+
+    Args:
+        name (str): stage name, also used as the Spark job group of the
+            stage's jobs
+        stage (function): runs the stage, called without arguments
+        sc (pyspark.SparkContext): context the stage runs its jobs on, or
+            None if there isn't one yet, defaults to None
+
+    Returns:
+        (object, dict): what the stage returned, and its record
+    """
+    logger.info('Benchmarking {}...'.format(name))
+    _reset_peak_rss(_process_tree())
+    if sc is not None:
+        sc.setJobGroup(name, 'overlay benchmark: {}'.format(name))
+    result = None
+    record = {'stage': name}
+    start, cpu = time.perf_counter(), time.process_time()
+    try:
+        result = stage()
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    record['seconds'] = time.perf_counter() - start
+    record['cpu_seconds'] = time.process_time() - cpu
+    record['peak_rss_bytes'] = _peak_rss([os.getpid()])
+    record['peak_rss_tree_bytes'] = _peak_rss(_process_tree())
+    if sc is not None:
+        record['spark'] = spark_metrics(sc, name)
+    return result, record
+
+
+def spark_metrics(sc, group):
+    """
+    Sum the task metrics of the Spark jobs of a job group
+
+    Args:
+        sc (pyspark.SparkContext): the context
+        group (str): job group
+
+    Returns:
+        (dict): number of jobs, stages, tasks and failed tasks, and the sums
+            of `SPARK_TASK_METRICS` if the Spark UI is enabled
+    """
+    tracker = sc.statusTracker()
+    job_ids = tracker.getJobIdsForGroup(group)
+    # the UI learns of finished tasks shortly after the jobs return
+    deadline = time.time() + 10
+    jobs = [tracker.getJobInfo(j) for j in job_ids]
+    while (any(j is not None and j.status == 'RUNNING' for j in jobs) and
+           time.time() < deadline):
+        time.sleep(0.1)
+        jobs = [tracker.getJobInfo(j) for j in job_ids]
+    stage_ids = set(s for j in jobs if j is not None for s in j.stageIds)
+
+    metrics = {'jobs': len(job_ids), 'stages': 0, 'tasks': 0, 'failed_tasks': 0}
+    stages = _ui_stages(sc)
+    if stages is None:
+        # no UI: task counts from the status tracker only
+        for stage_id in stage_ids:
+            info = tracker.getStageInfo(stage_id)
+            if info is not None and info.numCompletedTasks + info.numFailedTasks > 0:
+                metrics['stages'] += 1
+                metrics['tasks'] += info.numCompletedTasks
+                metrics['failed_tasks'] += info.numFailedTasks
+        return metrics
+
+    for name in SPARK_TASK_METRICS:
+        metrics[name] = 0
+    for stage in stages:
+        # stages of earlier jobs that are reused are skipped, not run
+        if stage['stageId'] not in stage_ids or stage['status'] not in ('COMPLETE', 'FAILED'):
+            continue
+        metrics['stages'] += 1
+        metrics['tasks'] += stage.get('numCompleteTasks', 0)
+        metrics['failed_tasks'] += stage.get('numFailedTasks', 0)
+        for name in SPARK_TASK_METRICS:
+            metrics[name] += stage.get(name, 0)
+    return metrics
+
+
+def environment():
+    """
+    Describe the code and machine a benchmark runs on
+
+    Returns:
+        (dict): commit, whether the working tree has changes, time, host,
+            platform, Python version and number of CPUs
+    """
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {'commit': _git('rev-parse', 'HEAD'),
+            'dirty': None if status is None else status != '',
+            'created': datetime.datetime.utcnow().isoformat() + 'Z',
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count()}
+
+
+def compare(baseline, current):
+    """
+    Line up the stages of two benchmark results
+
+    Args:
+        baseline (str or dict): results, or the JSON file they were written to
+        current (str or dict): results to compare to the baseline
+
+    Returns:
+        (pd.DataFrame): seconds and peak memory of each stage in both
+            results, and their ratio of current to baseline
+    """
+    frames = []
+    for results in (baseline, current):
+        if not isinstance(results, dict):
+            with open(results) as f:
+                results = json.load(f)
+        frames.append(pd.DataFrame(results['stages']).set_index('stage')[
+            ['seconds', 'peak_rss_tree_bytes']])
+    comparison = frames[0].join(frames[1], lsuffix='_baseline', rsuffix='_current',
+                                how='outer')
+    # keep the order the stages ran in
+    order = list(frames[1].index) + [s for s in frames[0].index if s not in frames[1].index]
+    comparison = comparison.reindex(order)
+    comparison['seconds_ratio'] = (comparison['seconds_current'] /
+                                   comparison['seconds_baseline'])
+    comparison['peak_rss_ratio'] = (comparison['peak_rss_tree_bytes_current'] /
+                                    comparison['peak_rss_tree_bytes_baseline'])
+    return comparison
+
+
+def _sources(directory, scale, seed):
+    """
+    Helper function ('private') to write the synthetic inputs of a scale
+        and seed, or read their paths if they were written before
+    """
+    index = os.path.join(directory, 'sources.json')
+    if os.path.isfile(index):
+        logger.info('Reusing synthetic inputs in {}'.format(directory))
+        with open(index) as f:
+            return json.load(f)
+    logger.info('Writing synthetic inputs at scale {}...'.format(scale))
+    sources = synthetic.make_sources(directory, scale, seed)
+    with open(index, 'w') as f:
+        json.dump(sources, f, indent=2)
+    return sources
+
+
+def _health_point_values(overlay, files, directory):
+    """
+    Helper function ('private') to index the synthetic facilities and score
+        those of every category
+    """
+    index = FacilityIndex(files)
+    scored = {}
+    for category in index.categories:
+        output_file = os.path.join(directory, '{}.shp'.format(
+            category.replace(' ', '_')))
+        scored[category] = analysis.get_health_point_values(category, overlay,
+                                                            output_file,
+                                                            index=index)
+    return scored
+
+
+def _git(*args):
+    """
+    Helper function ('private') to run a git command in the repository of
+        this package, returning its output or None if it fails
+    """
+    try:
+        return subprocess.check_output(
+            ('git',) + args, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _process_tree():
+    """
+    Helper function ('private') to find this process and all of its
+        descendants, e.g. the Spark JVM and its Python workers
+    """
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the command name in parentheses may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    pids, todo = [], [os.getpid()]
+    while todo:
+        pid = todo.pop()
+        pids.append(pid)
+        todo.extend(children.get(pid, []))
+    return pids
+
+
+def _peak_rss(pids):
+    """
+    Helper function ('private') to add up the peak resident memory of
+        processes, in bytes
+    """
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except IOError:
+            continue
+    return total
+
+
+def _reset_peak_rss(pids):
+    """
+    Helper function ('private') to reset the peak resident memory of
+        processes to their current resident memory, where permitted
+    """
+    for pid in pids:
+        try:
+            with open('/proc/{}/clear_refs'.format(pid), 'w') as f:
+                f.write('5')
+        except IOError:
+            continue
+
+
+def _ui_stages(sc):
+    """
+    Helper function ('private') to read every stage of a context from the
+        monitoring REST API of its UI, or None if the UI is disabled
+    """
+    if not sc.uiWebUrl:
+        return None
+    url = '{}/api/v1/applications/{}/stages'.format(sc.uiWebUrl, sc.applicationId)
+    try:
+        with request.urlopen(url, timeout=30) as response:
+            return json.loads(response.read().decode())
+    except (URLError, IOError, ValueError):
+        return None
+
+
+class _Headless(object):
+    """
+    Helper class ('private') with the part of a GeoNotebook that `map_layer`
+        uses, so the map stage runs without a notebook
+    """
+
+    layers = []
+
+    def add_layer(self, data, name=None, **kwargs):
+        pass
+
+    def remove_layer(self, layer):
+        pass
+
+
+def main(argv=None):
+    """
+    Run a benchmark from the command line, and compare it to earlier results
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the overlay analysis on synthetic inputs')
+    parser.add_argument('directory', help='directory for inputs and results')
+    parser.add_argument('--scale', type=float, default=1,
+                        help='size of the study area and inputs, defaults to 1')
+    parser.add_argument('--backend', choices=['spark', 'numpy'], default='spark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--master', default=constants.BENCHMARK_SPARK_MASTER,
+                        help='Spark master url')
+    parser.add_argument('--memory', default=constants.SPARK_DRIVER_MEMORY,
+                        help='Spark driver memory')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results of an earlier run to compare to')
+    args = parser.parse_args(argv)
+
+    metrics.show_progress()
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    results = run(args.directory, args.scale, args.backend, args.seed, args.output,
+                  args.master, args.memory)
+    if args.compare is not None:
+        print(compare(args.compare, results).to_string())
+    return 1 if any('error' in s for s in results['stages']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,9 +4,8 @@ of user-specified geographies
 """
 
 import os
-import geopandas as gpd
 
-from overlay import constants
+from overlay import constants, lookup
 
 
 def get_study_area(geog_type, name, state='N/A',
@@ -17,7 +16,8 @@ def get_study_area(geog_type, name, state='N/A',
 
     Args:
         geog_type (str): one of 'msa' or 'county'
-        name (str): search name to use for msa or county 
+        name (str): search name, CBSA code or GEOID to use for msa or
+                county
         state (str): two letter state abbreviation. Ignore if 
                 for an MSA
         output_dir (str): output directory for study area shp
@@ -28,15 +28,12 @@ def get_study_area(geog_type, name, state='N/A',
 
     try:
         if geog_type == 'msa':
-            all_geog = gpd.read_file(constants.NATL_MSA_SHP)
-            boundary_geog = all_geog[
-                all_geog['NAME'].str.contains(name, case=False)]
+            boundary_geog = lookup.read_matching(constants.NATL_MSA_SHP, name)
             boundary_file_name = name + '_msa.shp'
         else:
-            all_geog = gpd.read_file(constants.NATL_COUNTY_SHP)
             state_code = constants.STATE_FIPS[state]
-            boundary_geog = all_geog[(all_geog['NAME'].str.contains(name, case=False))
-                                     & (all_geog['STATEFP'] == state_code)]
+            boundary_geog = lookup.read_matching(constants.NATL_COUNTY_SHP, name,
+                                                 state_code)
             boundary_file_name = name + '_' + state + '_county.shp'
 
         output = os.path.join(output_dir, boundary_file_name)
@@ -55,7 +52,7 @@ def get_msa_study_area(msa_search,
         study area boundary
 
     Args:
-        msa_name (str): search name to use for msas 
+        msa_search (str): search name or CBSA code to use for msas 
         msa_file_name (str): msa output file name without full path
         msa_output_dir (str): output directory for study area shp
         all_msas (str): path to national msa shapefile
@@ -63,8 +60,7 @@ def get_msa_study_area(msa_search,
     Returns:
         (str): the path to county output file
     """
-    msas = gpd.read_file(all_msas)
-    one_msa = msas[msas['NAME'].str.contains(msa_search, case=False)]
+    one_msa = lookup.read_matching(all_msas, msa_search)
     msa_output = os.path.join(msa_output_dir, msa_file_name)
     one_msa.to_file(msa_output)
     return msa_output
@@ -80,7 +76,7 @@ def get_county_study_area(county_name,
         study area boundary
 
     Args:
-        county_name (str): search name to use for counties
+        county_name (str): search name or GEOID to use for counties
         state_fips (str): state fips code 
             https://www.mcc.co.mercer.pa.us/dps/state_fips_code_listing.htm
         county_file_name (str): county output file name without full path
@@ -90,11 +86,9 @@ def get_county_study_area(county_name,
     Returns:
         (str): the path to county output file
     """
-    ct = gpd.read_file(all_counties)
-    # TODO: add leading zero to this fips code
     # TODO: account for queries that return multiple results
-    one_county = ct[(ct['NAME'].str.contains(county_name, case=False))
-                    & (ct['STATEFP'] == str(state_fips))]
+    one_county = lookup.read_matching(all_counties, county_name,
+                                      str(state_fips).zfill(2))
     county_ouptut = os.path.join(county_output_dir, county_file_name)
     one_county.to_file(county_ouptut)
     return county_ouptut
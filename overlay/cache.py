@@ -0,0 +1,386 @@
+"""
+Content-addressed disk cache for prepared input data
+
+Entries are keyed by a hash of the identity of their source files (path,
+    size and modification time), the study area geometry and the parameters
+    of the operation that produced them, so changed inputs never return a
+    stale result and identical requests never recompute. Entries are
+    written to a temporary directory of their own and moved into place
+    atomically, and a manifest tracks their size and last use so the least
+    recently used ones can be evicted past a disk budget. Manifest updates
+    hold a file lock, so threads and processes sharing a cache don't lose
+    each other's entries. The validators of url sources are kept in the
+    cache too, and their servers are only asked again once they are older
+    than a time to live, so a cached entry is found without a request.
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import threading
+import contextlib
+import logging
+
+from http.client import HTTPException
+from urllib.error import URLError
+
+from overlay import constants, download, metrics, utils
+
+logger = logging.getLogger(__name__)
+
+
+class Manifest(object):
+    """
+    JSON record of the entries of an on-disk cache, with their sizes and
+        last use
+
+    Attributes:
+        path (str): manifest file
+        max_bytes (int): size budget for all entries
+    """
+
+    def __init__(self, path, max_bytes, delete):
+        """
+        Open a manifest
+
+        Args:
+            path (str): manifest file
+            max_bytes (int): size budget for all entries
+            delete (function): removes the data of an entry given its key
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._delete = delete
+        self._lock = threading.Lock()
+
+    def touch(self, key):
+        """
+        Mark an entry as used
+
+        Args:
+            key (str): entry key
+
+        Returns:
+            (dict): the entry, or None if there is no such entry
+        """
+        with self._locked():
+            entries = self._read()
+            if key not in entries:
+                return None
+            entries[key]['last_used'] = time.time()
+            self._write(entries)
+            return entries[key]
+
+    def add(self, key, size, **description):
+        """
+        Record a new entry, then evict least recently used entries past the
+            size budget
+
+        Args:
+            key (str): entry key
+            size (int): bytes used by the entry
+            **description: attributes to list with the entry
+        """
+        now = time.time()
+        with self._locked():
+            entries = self._read()
+            entries[key] = dict(description, bytes=size,
+                                created=now, last_used=now)
+            total = sum(e['bytes'] for e in entries.values())
+            for k in sorted(entries, key=lambda k: entries[k]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                if k == key:
+                    continue
+                logger.info('Evicting {} from {}'.format(
+                    k, os.path.dirname(self.path)))
+                total -= entries[k]['bytes']
+                self._delete(k)
+                del entries[k]
+            self._write(entries)
+
+    def entries(self):
+        """
+        List the entries
+
+        Returns:
+            ([dict]): entries with their key, size and last use, most
+                recently used first
+        """
+        with self._locked():
+            entries = self._read()
+        listed = [dict(v, key=k) for k, v in entries.items()]
+        return sorted(listed, key=lambda e: e['last_used'], reverse=True)
+
+    def remove(self, keys=None):
+        """
+        Delete entries and their data
+
+        Args:
+            keys ([str]): keys to delete, defaults to all entries
+        """
+        with self._locked():
+            entries = self._read()
+            for key in list(entries.keys() if keys is None else keys):
+                if key in entries:
+                    self._delete(key)
+                    del entries[key]
+            self._write(entries)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Helper function ('private') to hold the manifest lock of this
+            process and the file lock shared with other processes
+        """
+        with self._lock:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        """
+        Helper function ('private') to load the manifest
+        """
+        return _read_json(self.path)
+
+    def _write(self, entries):
+        """
+        Helper function ('private') to atomically replace the manifest
+        """
+        _write_json(self.path, entries)
+
+
+class FileCache(object):
+    """
+    Content-addressed cache of directories of prepared input files
+
+    Attributes:
+        root (str): cache directory
+        manifest (Manifest): entry sizes and last use
+        remote_ttl (float): seconds the validators of a url source are
+            used for before its server is asked again, None to never ask
+            again
+    """
+
+    def __init__(self, root=constants.CACHE_DIR,
+                 max_bytes=constants.CACHE_MAX_BYTES,
+                 remote_ttl=constants.CACHE_REMOTE_TTL):
+        """
+        Open a cache, creating its directory if needed
+
+        Args:
+            root (str): cache directory
+            max_bytes (int): disk budget; least recently used entries are
+                evicted past it
+            remote_ttl (float): seconds the validators of a url source are
+                used for before its server is asked again, 0 to ask every
+                time and None to never ask again
+        """
+        self.root = root
+        self.remote_ttl = remote_ttl
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.manifest = Manifest(os.path.join(root, 'manifest.json'),
+                                 max_bytes,
+                                 lambda key: shutil.rmtree(self.path(key),
+                                                           ignore_errors=True))
+
+    def key(self, operation, sources, geometry=None, **params):
+        """
+        Build the key of an operation's output
+
+        Args:
+            operation (str): name of the operation, e.g. 'flood_clip'
+            sources ([str]): input files or directories, identified by path,
+                size and modification time, or urls, identified by the
+                ETag, Last-Modified and size their server reports, as of
+                the last check within `remote_ttl`. Anything else is used
+                as is.
+            geometry (shapely.geometry): study area geometry, defaults to
+                None
+            **params: operation parameters
+
+        Returns:
+            (str): cache key
+        """
+        identities = [utils.file_identity(s) if os.path.exists(s) else
+                      self.remote_identity(s) if '://' in s else s
+                      for s in sources]
+        geom_hash = None if geometry is None else utils.geometry_hash(geometry)
+        return '{}_{}'.format(operation, utils.hash_key(
+            identities, geom_hash, params))
+
+    def remote_identity(self, url):
+        """
+        Validators of a url source, from the cache if they were checked with
+            its server within `remote_ttl`, otherwise from its server. If
+            the server can't be reached, the last validators are used.
+
+        Args:
+            url (str): url of the source
+
+        Returns:
+            (list): identity of the url, as returned by
+                `download.remote_identity`
+        """
+        path = os.path.join(self.root, 'remote.json')
+        checked = _read_json(path)
+        last = checked.get(url)
+        if last is not None and (self.remote_ttl is None or
+                                 time.time() - last['checked'] < self.remote_ttl):
+            return last['identity']
+        try:
+            identity = download.remote_identity(url)
+        except (URLError, HTTPException, OSError) as e:
+            if last is None:
+                raise
+            logger.warning('Could not check {} for changes ({}), using its last check'.format(
+                url, e))
+            return last['identity']
+        # other processes may have checked other urls in the meantime
+        checked = _read_json(path)
+        checked[url] = {'identity': identity, 'checked': time.time()}
+        _write_json(path, checked)
+        return identity
+
+    def path(self, key):
+        """
+        Directory of an entry
+
+        Args:
+            key (str): cache key
+
+        Returns:
+            (str): entry directory
+        """
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """
+        Look up an entry
+
+        Args:
+            key (str): cache key
+
+        Returns:
+            (str): entry directory, or None on a cache miss
+        """
+        if not os.path.isdir(self.path(key)) or self.manifest.touch(key) is None:
+            metrics.count('cache_misses')
+            return None
+        metrics.count('cache_hits')
+        return self.path(key)
+
+    def put(self, key, write, **description):
+        """
+        Create an entry. `write` fills a temporary directory that is moved
+            into place once it returns, so readers never see partial output.
+            If another thread or process created the entry in the meantime,
+            its entry is kept and returned.
+
+        Args:
+            key (str): cache key
+            write (function): takes a directory and writes the entry's files
+                to it
+            **description: attributes to list with the entry
+
+        Returns:
+            (str): entry directory
+        """
+        # a staging directory per writer, so concurrent writers of a key
+        #   don't share one
+        tmp = '{}.tmp{}_{}'.format(self.path(key), os.getpid(), uuid.uuid4().hex)
+        os.makedirs(tmp)
+        try:
+            write(tmp)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        size = _directory_size(tmp)
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:
+            if not os.path.isdir(self.path(key)):
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            # another writer finished first: use its entry
+            shutil.rmtree(tmp, ignore_errors=True)
+            if self.manifest.touch(key) is None:
+                self.manifest.add(key, _directory_size(self.path(key)), **description)
+            metrics.count('cache_hits')
+            return self.path(key)
+        self.manifest.add(key, size, **description)
+        metrics.count('bytes_written', size)
+        return self.path(key)
+
+    def latest(self, **description):
+        """
+        Find the most recently used entry with the given attributes, e.g.
+            to fall back to when a key can't be computed offline
+
+        Args:
+            **description: attributes the entry was listed with
+
+        Returns:
+            (str): key of the entry, or None if there is none
+        """
+        for entry in self.manifest.entries():
+            if (all(entry.get(k) == v for k, v in description.items()) and
+                    os.path.isdir(self.path(entry['key']))):
+                return entry['key']
+        return None
+
+    def list(self):
+        """
+        List the cached entries
+
+        Returns:
+            ([dict]): entries, most recently used first
+        """
+        return self.manifest.entries()
+
+    def purge(self, keys=None):
+        """
+        Delete entries from the cache
+
+        Args:
+            keys ([str]): keys to delete, defaults to all entries
+        """
+        self.manifest.remove(keys)
+
+
+def _directory_size(directory):
+    """
+    Helper function ('private') to add up the size of the files in a
+        directory tree
+    """
+    return sum(os.path.getsize(os.path.join(d, f))
+               for d, _, fs in os.walk(directory) for f in fs)
+
+
+def _read_json(path):
+    """
+    Helper function ('private') to load a JSON file, empty if it is missing
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    """
+    Helper function ('private') to atomically replace a JSON file
+    """
+    tmp = '{}.tmp{}_{}'.format(path, os.getpid(), uuid.uuid4().hex)
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
@@ -0,0 +1,174 @@
+"""
+File-backed catalog of built hazard layers
+
+Layers are stored in a GeoTrellis file catalog under names derived from the
+    study area geometry, the identity of the input dataset and the layer
+    parameters, so a repeat analysis reads a layer back instead of
+    rebuilding it. A manifest next to the catalog tracks entry sizes and
+    last use, and the least recently used entries are evicted once the
+    catalog grows past its size budget.
+"""
+
+import os
+import glob
+import shutil
+import logging
+import geopyspark as gps
+
+from overlay import constants, metrics, utils
+from overlay.cache import Manifest
+from overlay.sparse import SparseTiledLayer, cells_rdd
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+
+class LayerCatalog(object):
+    """
+    Persistent store of tiled hazard layers
+
+    Attributes:
+        root (str): catalog directory
+        manifest (cache.Manifest): entry sizes and last use
+    """
+
+    def __init__(self, root=constants.CATALOG_DIR,
+                 max_bytes=constants.CATALOG_MAX_BYTES):
+        """
+        Open a catalog, creating its directory if needed
+
+        Args:
+            root (str): catalog directory
+            max_bytes (int): size budget; least recently used entries are
+                evicted past it
+        """
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.manifest = Manifest(os.path.join(root, MANIFEST),
+                                 max_bytes,
+                                 self._delete)
+
+    @property
+    def uri(self):
+        """
+        (str): GeoTrellis uri of the catalog
+        """
+        return 'file://' + os.path.abspath(self.root)
+
+    def key(self, overlay, layer, source, **params):
+        """
+        Build the key of a layer
+
+        Args:
+            overlay (analysis.Overlay): overlay the layer belongs to
+            layer (str): layer name, e.g. 'flood'
+            source (str or [str]): input file or directory the layer is
+                built from, or a list of them
+            **params: layer parameters, e.g. feet=5
+
+        Returns:
+            (str): catalog key
+        """
+        sources = source if isinstance(source, list) else [source]
+        return '{}_{}'.format(layer, utils.hash_key(
+            overlay.study_area['geom_hash'],
+            [utils.file_identity(s) for s in sources],
+            params))
+
+    def get(self, overlay, key):
+        """
+        Read a layer lazily from the catalog. Layers that were stored from a
+            sparse layer are read back into one: their tiles are compressed
+            again and partitioned by the overlay's partitioner, like the
+            layers the overlay builds.
+
+        Args:
+            overlay (analysis.Overlay): overlay the layer belongs to
+            key (str): catalog key
+
+        Returns:
+            (sparse.SparseTiledLayer or gps.TiledRasterLayer): the layer, or
+                None if it isn't cataloged
+        """
+        entry = self.manifest.touch(key)
+        if entry is None:
+            metrics.count('cache_misses')
+            return None
+        metrics.count('cache_hits')
+        logger.info('Reading {} from layer catalog'.format(key))
+        layer = gps.query(self.uri, key, entry['zoom'])
+        if not entry.get('sparse'):
+            return layer
+        tiles = overlay.partitioner.partition(cells_rdd(layer))
+        return SparseTiledLayer(tiles, layer.layer_metadata, layer.zoom_level)
+
+    def put(self, key, tiled_layer, **description):
+        """
+        Write a layer to the catalog, then evict least recently used entries
+            past the size budget
+
+        Args:
+            key (str): catalog key
+            tiled_layer (gps.TiledRasterLayer or sparse.SparseTiledLayer):
+                layer to store
+            **description: attributes to list with the entry, e.g. the
+                study area id
+        """
+        logger.info('Writing {} to layer catalog'.format(key))
+        is_sparse = isinstance(tiled_layer, SparseTiledLayer)
+        if is_sparse:
+            tiled_layer = tiled_layer.to_tiled_layer()
+        gps.write(self.uri, key, tiled_layer)
+        self.manifest.add(key, self._entry_bytes(key),
+                          zoom=tiled_layer.zoom_level, sparse=is_sparse,
+                          **description)
+
+    def list(self):
+        """
+        List the cataloged layers
+
+        Returns:
+            ([dict]): entries with their key, size and last use, most
+                recently used first
+        """
+        return self.manifest.entries()
+
+    def size(self):
+        """
+        Total size of the catalog
+
+        Returns:
+            (int): bytes used by all entries
+        """
+        return sum(e['bytes'] for e in self.list())
+
+    def purge(self, keys=None):
+        """
+        Delete entries from the catalog
+
+        Args:
+            keys ([str]): keys to delete, defaults to all entries
+        """
+        self.manifest.remove(keys)
+
+    def _delete(self, key):
+        """
+        Helper function ('private') to remove a layer's tiles and attributes
+        """
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        for f in glob.glob(os.path.join(self.root, 'attributes',
+                                        '{}__.__*'.format(key))):
+            os.remove(f)
+
+    def _entry_bytes(self, key):
+        """
+        Helper function ('private') to measure the disk use of a layer
+        """
+        files = [os.path.join(d, f)
+                 for d, _, fs in os.walk(os.path.join(self.root, key))
+                 for f in fs]
+        files += glob.glob(os.path.join(self.root, 'attributes',
+                                        '{}__.__*'.format(key)))
+        return sum(os.path.getsize(f) for f in files)
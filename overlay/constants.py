@@ -2,9 +2,7 @@
 Constant values for overlay abalysis
 """
 
-import geopyspark as gps
-
-# color map values
+# color ramp of overlay scores, from the lowest to the highest
 COLORS = [1023,
           185083135,
           521227263,
@@ -21,7 +19,12 @@ COLORS = [1023,
           4273898495,
           4259160063,
           4227645439]
-VALUES = list(range(0, 16))
+
+# weight of each hazard in the weighted overlay
+OVERLAY_WEIGHTS = {'flood': 1, 'sea_level_rise': 1, 'storm_surge': 1}
+
+# overlay scores at or above this count towards a zone's area at risk
+AT_RISK_SCORE = 8
 
 # data directory
 DATA_DIR = '/home/hadoop/notebooks/data/'
@@ -29,14 +32,56 @@ DATA_DIR = '/home/hadoop/notebooks/data/'
 # national storm surge layers for different categories of storm
 NATL_STORM_SURGE_1 = '/home/hadoop/notebooks/data/read/overlay-layers/storm-surge/US_Category1_MOM_Inundation_HighTide.tif'
 NATL_STORM_SURGE_2 = '/home/hadoop/notebooks/data/read/overlay-layers/storm-surge/US_Category2_MOM_Inundation_HighTide.tif'
-NATL_STORM_SURGE_3 = '/home/hadoop/notebooks/data/read/overlay-layers/storm-surge/US_Category4_MOM_Inundation_HighTide.tif'
+NATL_STORM_SURGE_3 = '/home/hadoop/notebooks/data/read/overlay-layers/storm-surge/US_Category3_MOM_Inundation_HighTide.tif'
 NATL_STORM_SURGE_4 = '/home/hadoop/notebooks/data/read/overlay-layers/storm-surge/US_Category4_MOM_Inundation_HighTide.tif'
 NATL_STORM_SURGE_5 = '/home/hadoop/notebooks/data/read/overlay-layers/storm-surge/US_Category5_MOM_Inundation_HighTide.tif'
+# all categories, in order, for the stacked storm surge layer
+NATL_STORM_SURGE = [NATL_STORM_SURGE_1,
+                    NATL_STORM_SURGE_2,
+                    NATL_STORM_SURGE_3,
+                    NATL_STORM_SURGE_4,
+                    NATL_STORM_SURGE_5]
+
+# storm surge reclassification (greater than or equal to each break)
+STORM_SURGE_VALUE_MAP = {2: 2, 5: 3, 8: 4, 11: 5, 14: 6, 17: 7, 20: 8}
+
+# lowest and highest score of each layer, from 1 for no hazard
+SCORE_RANGES = {'base': (1, 1),
+                'flood': (1, 5),
+                'sea_level_rise': (1, 5),
+                'storm_surge': (1, max(STORM_SURGE_VALUE_MAP.values()))}
 
 # national flood layer
 NATL_FLOOD_SHP = '/home/hadoop/notebooks/data/read/overlay-layers/flood/Fld_Haz_ar.shp'
 
-# sea level directory
+# partitioned stores of national vector inputs
+STORE_GRID_SIZE = 16
+STORE_BATCH_SIZE = 10000
+
+# polygons per batch when streaming sea level rise layers
+SLR_BATCH_SIZE = 10000
+
+# study area tiles per Spark partition
+TILES_PER_PARTITION = 8
+
+# Spark session defaults
+SPARK_APP_NAME = 'ClimateOverlay'
+SPARK_DRIVER_MEMORY = '12G'
+SPARK_EXECUTOR_MEMORY = '4G'
+SPARK_SERIALIZER = 'org.apache.spark.serializer.KryoSerializer'
+SPARK_KRYO_BUFFER_MAX = '512m'
+
+# benchmarks run on one machine, in Spark local mode
+BENCHMARK_SPARK_MASTER = 'local[*]'
+
+# files that make up a shapefile besides the .shp, for its identity
+SHAPEFILE_SIDECARS = ['.shx', '.dbf', '.prj', '.cpg']
+
+# bytes per request and retries of failed requests when downloading
+DOWNLOAD_BLOCK_SIZE = 8 * 1024 ** 2
+DOWNLOAD_RETRIES = 5
+
+# sea level rise geodatabases downloaded before they were kept in the cache
 SEA_LEVEL_DIR = '/home/hadoop/notebooks/data/read/overlay-layers/sea-level-rise/'
 
 # output directory for new boundary shps
@@ -71,6 +116,23 @@ STATE_FIPS = {
 # output directory
 OUTPUT_DIR = '/home/hadoop/notebooks/data/output/'
 
+# catalog of built hazard layers
+CATALOG_DIR = '/home/hadoop/notebooks/data/write/catalog/'
+CATALOG_MAX_BYTES = 20 * 1024 ** 3
+
+# cache of prepared input data
+CACHE_DIR = '/home/hadoop/notebooks/data/write/cache/'
+CACHE_MAX_BYTES = 50 * 1024 ** 3
+# seconds before the server of a url source is asked again whether it changed
+CACHE_REMOTE_TTL = 24 * 60 * 60
+
+# lookup indexes of boundary files in read-only directories
+LOOKUP_INDEX_DIR = '/home/hadoop/notebooks/data/write/lookup/'
+
+# cache of rendered map tiles
+TILE_CACHE_DIR = '/home/hadoop/notebooks/data/write/tiles/'
+TILE_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
 # matching name of each health facility type with corresponding shapefile
 HEALTH_RESOURCE_FILES = {'Hospitals': '/home/hadoop/notebooks/data/read/health/Hospitals.shp',
                          'Medical centers': '/home/hadoop/notebooks/data/read/health/MedicalCenters.shp',
@@ -0,0 +1,414 @@
+"""
+Download selected members of remote zip archives
+
+When the server supports HTTP range requests, the archive is read in place
+    through a seekable remote file, so only the central directory and the
+    wanted members are transferred and nothing but those members is written
+    to disk. Otherwise the archive is streamed to a `.part` file that later
+    attempts resume, then the wanted members are extracted from it. Member
+    CRCs and sizes are always checked, and an md5 of the whole archive can
+    be checked too. Concurrent requests for the same members of a url in
+    this process share one download.
+"""
+
+import io
+import os
+import re
+import time
+import shutil
+import hashlib
+import threading
+import logging
+
+from http.client import HTTPException
+from urllib import request
+from urllib.error import HTTPError, URLError
+from zipfile import ZipFile
+
+from overlay import constants, metrics
+
+logger = logging.getLogger(__name__)
+
+# members of a NOAA sea level rise archive that make up its geodatabase
+SLR_GDB_PATTERN = r'_final[^/]*\.gdb/'
+
+_url_locks = {}
+_url_locks_lock = threading.Lock()
+# extractions in progress, by url, directory, pattern and md5
+_pending = {}
+
+
+def url_lock(url):
+    """
+    Lock shared by everything in this process that downloads a url, so
+        concurrent requests for it wait for one download instead of
+        starting their own
+
+    Args:
+        url (str): url of the download
+
+    Returns:
+        (threading.RLock): the url's lock
+    """
+    with _url_locks_lock:
+        return _url_locks.setdefault(url, threading.RLock())
+
+
+class RangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file over a url, read with HTTP range requests of
+        one block at a time
+
+    Attributes:
+        url (str): url of the file
+        size (int): size of the file in bytes
+        block_size (int): bytes fetched per request
+        retries (int): retries of a failed request
+    """
+
+    def __init__(self, url, size, block_size=constants.DOWNLOAD_BLOCK_SIZE,
+                 retries=constants.DOWNLOAD_RETRIES):
+        self.url = url
+        self.size = size
+        self.block_size = block_size
+        self.retries = retries
+        self._pos = 0
+        self._block_start = 0
+        self._block = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        if pos < 0:
+            raise ValueError('Negative seek position {}'.format(pos))
+        self._pos = pos
+        return pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self._pos
+        n = max(0, min(n, self.size - self._pos))
+        chunks = []
+        while n > 0:
+            offset = self._pos - self._block_start
+            if not 0 <= offset < len(self._block):
+                end = min(self._pos + self.block_size, self.size) - 1
+                self._block = _get(self.url, self._pos, end, self.retries)
+                self._block_start = self._pos
+                offset = 0
+            chunk = self._block[offset:offset + n]
+            chunks.append(chunk)
+            self._pos += len(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def probe(url, retries=constants.DOWNLOAD_RETRIES):
+    """
+    Find the size of a remote file and whether its server answers range
+        requests
+
+    Args:
+        url (str): url of the file
+        retries (int): retries of a failed request
+
+    Returns:
+        (int, bool): size in bytes, or None if the server doesn't report it,
+            and True if range requests are supported
+    """
+    status, headers = _head(url, retries)
+    return _size(status, headers)
+
+
+def remote_identity(url, retries=constants.DOWNLOAD_RETRIES):
+    """
+    Describe the version of a remote file by the validators its server
+        sends, so a file that changes under the same url is told apart
+
+    Args:
+        url (str): url of the file
+        retries (int): retries of a failed request
+
+    Returns:
+        (list): [url, ETag, Last-Modified, size], with None for what the
+            server doesn't send
+    """
+    status, headers = _head(url, retries)
+    size, _ = _size(status, headers)
+    return [url, headers.get('ETag'), headers.get('Last-Modified'), size]
+
+
+def download(url, path, md5=None, block_size=constants.DOWNLOAD_BLOCK_SIZE,
+             retries=constants.DOWNLOAD_RETRIES):
+    """
+    Stream a url to a file. Data is written to `path + '.part'` first, and
+        an interrupted download resumes from the end of that file if the
+        server supports range requests.
+
+    Args:
+        url (str): url of the file
+        path (str): output file
+        md5 (str): expected md5 hex digest of the file, defaults to None
+        block_size (int): bytes read per write
+        retries (int): retries of a failed or interrupted transfer
+
+    Returns:
+        (str): path to the file
+    """
+    part = path + '.part'
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+        try:
+            with request.urlopen(request.Request(url, headers=headers)) as response:
+                if offset > 0 and response.status == 206:
+                    logger.info('Resuming download at {} bytes'.format(offset))
+                else:
+                    offset = 0
+                length = response.headers.get('Content-Length')
+                total = None if length is None else offset + int(length)
+                with open(part, 'ab' if offset > 0 else 'wb') as f:
+                    shutil.copyfileobj(response, f, block_size)
+                metrics.count('bytes_read', os.path.getsize(part) - offset)
+        except HTTPError as e:
+            if e.code == 416 and offset > 0:
+                # the part file is already complete
+                total = offset
+            else:
+                raise
+        except (URLError, HTTPException, ConnectionError, TimeoutError) as e:
+            if attempt == retries:
+                raise
+            logger.warning('Download interrupted ({}), retrying...'.format(e))
+            time.sleep(2 ** attempt)
+            continue
+
+        size = os.path.getsize(part)
+        if total is None or size == total:
+            break
+        if attempt == retries:
+            raise IOError('Downloaded {} of {} bytes of {}'.format(
+                size, total, url))
+        logger.warning('Download stopped at {} of {} bytes, resuming...'.format(
+            size, total))
+
+    if md5 is not None:
+        digest = _md5(part, block_size)
+        if digest != md5.lower():
+            os.remove(part)
+            raise IOError('md5 of {} is {}, expected {}'.format(url, digest, md5))
+    os.replace(part, path)
+    return path
+
+
+def extract_members(url, directory, pattern=SLR_GDB_PATTERN, md5=None,
+                    block_size=constants.DOWNLOAD_BLOCK_SIZE,
+                    retries=constants.DOWNLOAD_RETRIES):
+    """
+    Extract the members of a remote zip archive whose names match a pattern.
+        Members that are already in the directory with the right size are
+        skipped, so a failed extraction resumes where it stopped. Calls made
+        while the same members are being extracted wait for that extraction
+        and return its paths.
+
+    Args:
+        url (str): url of the zip archive
+        directory (str): output directory
+        pattern (str): regular expression searched for in member names,
+            defaults to the geodatabase of a NOAA sea level rise archive
+        md5 (str): expected md5 hex digest of the archive. Checking it
+            requires downloading the whole archive, defaults to None
+        block_size (int): bytes fetched per request
+        retries (int): retries of a failed request
+
+    Returns:
+        ([str]): paths to the extracted files
+    """
+    request_key = (url, os.path.abspath(directory), pattern, md5)
+    with _url_locks_lock:
+        pending = _pending.get(request_key)
+        first = pending is None
+        if first:
+            pending = _pending[request_key] = _Pending()
+    if not first:
+        #   another thread is already extracting these members
+        return pending.wait()
+
+    try:
+        pending.result = _extract_members(url, directory, pattern, md5,
+                                          block_size, retries)
+        return pending.result
+    except BaseException as e:
+        pending.error = e
+        raise
+    finally:
+        with _url_locks_lock:
+            del _pending[request_key]
+        pending.done.set()
+
+
+class _Pending(object):
+    """
+    Helper class ('private') holding the outcome of an extraction for the
+        threads waiting on it
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return list(self.result)
+
+
+def _extract_members(url, directory, pattern, md5, block_size, retries):
+    """
+    Helper function ('private') to download and extract the members for
+        `extract_members`
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with url_lock(url):
+        size, ranges = probe(url, retries)
+        if ranges and md5 is None:
+            logger.info('Reading {} members from remote archive...'.format(pattern))
+            with RangeFile(url, size, block_size, retries) as remote:
+                with ZipFile(remote) as archive:
+                    return _extract(archive, directory, pattern, block_size)
+
+        zip_path = os.path.join(directory, os.path.basename(
+            os.path.normpath(url)))
+        download(url, zip_path, md5, block_size, retries)
+        with ZipFile(zip_path) as archive:
+            paths = _extract(archive, directory, pattern, block_size)
+        os.remove(zip_path)
+        return paths
+
+
+def _extract(archive, directory, pattern, block_size):
+    """
+    Helper function ('private') to extract matching members of an open
+        archive, checking their size and CRC
+    """
+    members = [m for m in archive.infolist()
+               if re.search(pattern, m.filename) and not m.filename.endswith('/')]
+    if len(members) == 0:
+        raise ValueError('No members of the archive match {}'.format(pattern))
+
+    root = os.path.abspath(directory)
+    paths = []
+    for member in members:
+        path = os.path.abspath(os.path.join(root, member.filename))
+        if not path.startswith(root + os.sep):
+            raise ValueError('Unsafe member name {}'.format(member.filename))
+        paths.append(path)
+        if os.path.isfile(path) and os.path.getsize(path) == member.file_size:
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # ZipExtFile raises BadZipFile if the CRC doesn't match
+        with archive.open(member) as src, open(path + '.part', 'wb') as dst:
+            shutil.copyfileobj(src, dst, block_size)
+        if os.path.getsize(path + '.part') != member.file_size:
+            raise IOError('Extracted {} bytes of {}, expected {}'.format(
+                os.path.getsize(path + '.part'), member.filename,
+                member.file_size))
+        os.replace(path + '.part', path)
+    return paths
+
+
+def _head(url, retries):
+    """
+    Helper function ('private') to request the first byte of a url, for
+        its status and headers
+    """
+    def _fetch():
+        req = request.Request(url, headers={'Range': 'bytes=0-0'})
+        with request.urlopen(req) as response:
+            return response.status, response.headers
+
+    return _with_retries(_fetch, retries)
+
+
+def _size(status, headers):
+    """
+    Helper function ('private') to read the size of a remote file, and
+        whether its server answered a range request, from the response to
+        `_head`
+    """
+    match = re.match(r'bytes 0-0/(\d+)$', headers.get('Content-Range', ''))
+    if status == 206 and match is not None:
+        return int(match.group(1)), True
+    length = headers.get('Content-Length')
+    return (None if length is None else int(length)), False
+
+
+def _get(url, start, end, retries):
+    """
+    Helper function ('private') to fetch a byte range of a url
+    """
+    def _fetch():
+        req = request.Request(url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        with request.urlopen(req) as response:
+            if response.status != 206:
+                raise IOError('{} ignored a range request'.format(url))
+            data = response.read()
+        if len(data) != end - start + 1:
+            raise ConnectionError('Short read of bytes {}-{} of {}'.format(
+                start, end, url))
+        metrics.count('bytes_read', len(data))
+        return data
+
+    return _with_retries(_fetch, retries)
+
+
+def _with_retries(fetch, retries):
+    """
+    Helper function ('private') to call a function that makes a request,
+        retrying transient network errors with exponential backoff
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fetch()
+        except HTTPError:
+            raise
+        except (URLError, HTTPException, ConnectionError, TimeoutError) as e:
+            if attempt == retries:
+                raise
+            logger.warning('Request failed ({}), retrying...'.format(e))
+            time.sleep(2 ** attempt)
+
+
+def _md5(path, block_size):
+    """
+    Helper function ('private') to compute the md5 hex digest of a file
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,322 @@
+"""
+Weighted overlay expressions
+
+An overlay is described by an expression over named layers: arithmetic with
+    constants, reclassification and masking, e.g. the default weighted sum of
+    hazards `weighted_overlay({'flood': 1, 'storm_surge': 2})`. An expression
+    is compiled into a `Program`, a graph in which identical subexpressions
+    (such as the base mask) appear once. The engines read the tiles of every
+    input layer once and run the program on each tile, so the whole overlay
+    is computed in one pass instead of one layer per operation, and a new
+    hazard adds one more input instead of more intermediate layers. The
+    range of scores a program can produce follows from the ranges of its
+    inputs, for histograms and color maps of the result.
+"""
+
+import numpy as np
+
+from overlay import constants, kernels
+
+# binary operations of expressions
+OPERATIONS = {'add': np.add,
+              'subtract': np.subtract,
+              'multiply': np.multiply}
+
+
+class Expression(object):
+    """
+    Node of an overlay expression. Expressions combine with each other and
+        with numbers through +, - and *.
+
+    Attributes:
+        args ([Expression]): expressions this node is computed from
+    """
+
+    args = []
+
+    @property
+    def key(self):
+        """
+        (tuple): structure of the expression, equal for equal expressions
+        """
+        raise NotImplementedError
+
+    def evaluate(self, *arrays):
+        """
+        Compute the node from the cells of its arguments
+
+        Args:
+            *arrays (np.ndarray): int32 cells of each of `args`
+
+        Returns:
+            (np.ndarray): int32 cells
+        """
+        raise NotImplementedError
+
+    def bounds(self, *ranges):
+        """
+        Find the lowest and highest value of the node from those of its
+            arguments
+
+        Args:
+            *ranges ((int, int)): lowest and highest value of each of `args`
+
+        Returns:
+            ((int, int)): lowest and highest value
+        """
+        raise NotImplementedError
+
+    def __add__(self, other):
+        return Apply('add', self, _wrap(other))
+
+    def __radd__(self, other):
+        return Apply('add', _wrap(other), self)
+
+    def __sub__(self, other):
+        return Apply('subtract', self, _wrap(other))
+
+    def __rsub__(self, other):
+        return Apply('subtract', _wrap(other), self)
+
+    def __mul__(self, other):
+        return Apply('multiply', self, _wrap(other))
+
+    def __rmul__(self, other):
+        return Apply('multiply', _wrap(other), self)
+
+
+class Layer(Expression):
+    """
+    Input layer, by name
+
+    Attributes:
+        name (str): layer name, e.g. 'flood' or 'base'
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def key(self):
+        return ('layer', self.name)
+
+
+class Constant(Expression):
+    """
+    Constant value
+
+    Attributes:
+        value (int): the value
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    @property
+    def key(self):
+        return ('constant', self.value)
+
+    def evaluate(self):
+        return self.value
+
+    def bounds(self):
+        return (self.value, self.value)
+
+
+class Apply(Expression):
+    """
+    Binary operation that propagates no data
+
+    Attributes:
+        operation (str): one of the keys of `OPERATIONS`
+    """
+
+    def __init__(self, operation, a, b):
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation: {}'.format(operation))
+        self.operation = operation
+        self.args = [a, b]
+
+    @property
+    def key(self):
+        return (self.operation,) + tuple(a.key for a in self.args)
+
+    def evaluate(self, a, b):
+        return kernels.combine(a, b, OPERATIONS[self.operation])
+
+    def bounds(self, a, b):
+        ends = [int(OPERATIONS[self.operation](x, y)) for x in a for y in b]
+        return (min(ends), max(ends))
+
+
+class Reclassify(Expression):
+    """
+    Reclassification with a break map, as `kernels.reclassify`
+
+    Attributes:
+        value_map (dict): breaks to new values
+        strategy (str): classification strategy
+        replace_nodata_with (int): value for no data cells
+    """
+
+    def __init__(self, arg, value_map, strategy=kernels.EXACT,
+                 replace_nodata_with=None):
+        self.args = [arg]
+        self.value_map = value_map
+        self.strategy = strategy
+        self.replace_nodata_with = replace_nodata_with
+
+    @property
+    def key(self):
+        return ('reclassify', self.args[0].key,
+                tuple(sorted(self.value_map.items())),
+                self.strategy, self.replace_nodata_with)
+
+    def evaluate(self, cells):
+        return kernels.reclassify(cells, self.value_map, self.strategy,
+                                  self.replace_nodata_with)
+
+    def bounds(self, cells):
+        values = list(self.value_map.values())
+        if self.replace_nodata_with is not None:
+            values.append(self.replace_nodata_with)
+        return (min(values), max(values))
+
+
+class Mask(Expression):
+    """
+    Mask by a layer that is 1 inside and no data outside, as `kernels.mask`
+    """
+
+    def __init__(self, arg, mask=None):
+        self.args = [arg, Layer('base') if mask is None else mask]
+
+    @property
+    def key(self):
+        return ('mask',) + tuple(a.key for a in self.args)
+
+    def evaluate(self, cells, mask):
+        return kernels.mask(cells, mask)
+
+    def bounds(self, cells, mask):
+        return cells
+
+
+class Program(object):
+    """
+    Compiled expression: its distinct nodes in evaluation order
+
+    Attributes:
+        expression (Expression): the compiled expression
+        inputs ([str]): names of the input layers
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self._nodes = []
+        self._args = []
+        positions = {}
+
+        def _add(node):
+            if node.key in positions:
+                return positions[node.key]
+            args = [_add(a) for a in node.args]
+            positions[node.key] = len(self._nodes)
+            self._nodes.append(node)
+            self._args.append(args)
+            return positions[node.key]
+
+        _add(expression)
+        self.inputs = [n.name for n in self._nodes if isinstance(n, Layer)]
+        # release each intermediate result after its last use
+        self._last_use = {}
+        for i, args in enumerate(self._args):
+            for a in args:
+                self._last_use[a] = i
+
+    def run(self, arrays):
+        """
+        Evaluate the program on one block of cells
+
+        Args:
+            arrays (dict): input layer name to its int32 cells
+
+        Returns:
+            (np.ndarray): int32 cells
+        """
+        results = {}
+        for i, (node, args) in enumerate(zip(self._nodes, self._args)):
+            if isinstance(node, Layer):
+                results[i] = arrays[node.name]
+            else:
+                results[i] = node.evaluate(*[results[a] for a in args])
+            for a in set(args):
+                if self._last_use[a] == i:
+                    del results[a]
+        cells = results[len(self._nodes) - 1]
+        if np.ndim(cells) == 0:
+            shape = next(iter(arrays.values())).shape
+            cells = np.full(shape, cells, dtype=np.int32)
+        return cells
+
+    def score_range(self, ranges=constants.SCORE_RANGES):
+        """
+        Find the lowest and highest score the program can produce
+
+        Args:
+            ranges (dict): input layer name to its lowest and highest score,
+                defaults to the scores of the built layers
+
+        Returns:
+            ((int, int)): lowest and highest score
+        """
+        results = []
+        for node, args in zip(self._nodes, self._args):
+            if isinstance(node, Layer):
+                if node.name not in ranges:
+                    raise ValueError('No score range for layer {}'.format(node.name))
+                results.append(tuple(ranges[node.name]))
+            else:
+                results.append(node.bounds(*[results[a] for a in args]))
+        return results[-1]
+
+
+def weighted_overlay(weights, mask='base'):
+    """
+    Weighted sum of hazard layers. Hazards score 1 (no hazard) to 5, so each
+        contributes its weight times its score above 1, and the sum is masked
+        by the base layer. With weights of 1 this is the sum of the hazards
+        minus their count.
+
+    Args:
+        weights (dict): hazard layer name to whole number weight
+        mask (str): name of the mask layer, defaults to 'base'
+
+    Returns:
+        (Expression): the weighted overlay
+    """
+    if len(weights) == 0:
+        raise ValueError('A weighted overlay needs at least one layer')
+    total = None
+    for name in sorted(weights):
+        term = (Layer(name) - 1) * weights[name]
+        total = term if total is None else total + term
+    return Mask(total, Layer(mask))
+
+
+def default_score_range():
+    """
+    Lowest and highest score of the weighted overlay of the built hazards
+        with their default weights
+
+    Returns:
+        ((int, int)): lowest and highest score
+    """
+    return Program(weighted_overlay(constants.OVERLAY_WEIGHTS)).score_range()
+
+
+def _wrap(value):
+    """
+    Helper function ('private') to use numbers as constant expressions
+    """
+    return value if isinstance(value, Expression) else Constant(value)
@@ -0,0 +1,131 @@
+"""
+Index of the national health facility layers
+
+Every category in `constants.HEALTH_RESOURCE_FILES` is read once into one
+    table with a `category` column and a spatial index, so the facilities of
+    all categories in a study area are found with one index query and scored
+    with one sampling pass.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from overlay import constants, metrics, sampling
+
+logger = logging.getLogger(__name__)
+
+_default_index = None
+
+
+class FacilityIndex(object):
+    """
+    Health facilities of all categories with an STRtree over their locations
+
+    Attributes:
+        facilities (gpd.GeoDataFrame): facilities of all categories, with the
+            category of each in a `category` column
+        tree (shapely.strtree.STRtree): index of the facility geometries
+    """
+
+    def __init__(self, files=constants.HEALTH_RESOURCE_FILES):
+        """
+        Read and index facility layers
+
+        Args:
+            files (dict): category name to point shapefile, defaults to
+                `constants.HEALTH_RESOURCE_FILES`
+        """
+        frames = []
+        for category, path in files.items():
+            logger.info('Reading {} facilities...'.format(category.lower()))
+            frame = gpd.read_file(path)
+            metrics.count('features_read', len(frame))
+            frame['category'] = category
+            frames.append(frame)
+        self.facilities = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True),
+                                           crs=frames[0].crs)
+        self.facilities = self.facilities[self.facilities.geometry.notnull()]
+        self.facilities = self.facilities.reset_index(drop=True)
+
+        geoms = list(self.facilities.geometry)
+        self.tree = STRtree(geoms)
+        # shapely 1.x trees return geometries instead of indexes
+        self._positions = {id(g): i for i, g in enumerate(geoms)}
+
+    @property
+    def categories(self):
+        """
+        ([str]): indexed facility categories
+        """
+        return list(self.facilities['category'].unique())
+
+    def within(self, geometry, categories=None):
+        """
+        Find the facilities within a polygon
+
+        Args:
+            geometry (shapely.geometry.Polygon): polygon in the crs of the
+                facility layers
+            categories ([str]): categories to keep, defaults to all of them
+
+        Returns:
+            (gpd.GeoDataFrame): facilities within the polygon
+        """
+        found = self.facilities.iloc[self._query(geometry)]
+        if categories is not None:
+            found = found[found['category'].isin(categories)]
+        return found
+
+    def score(self, overlay, categories=None):
+        """
+        Score the facilities in an overlay's study area with its overlay
+            layer, sampling every category in one pass
+
+        Args:
+            overlay (analysis.Overlay): overlay with an overlay layer
+            categories ([str]): categories to score, defaults to all of them
+
+        Returns:
+            (gpd.GeoDataFrame, dict): scored facilities of all categories
+                with a `risk_score` column, and the same split by category
+                with the columns that category has no values in dropped
+        """
+        scored = self.within(overlay.study_area['geom_wm'][0], categories).copy()
+        scored['risk_score'] = sampling.sample(overlay.overlay, scored, fill=0.0)
+        metrics.count('features_scored', len(scored))
+        by_category = {category: group.dropna(axis=1, how='all')
+                       for category, group in scored.groupby('category')}
+        return scored, by_category
+
+    def _query(self, geometry):
+        """
+        Helper function ('private') to find the positions of the facilities
+            within a polygon
+        """
+        try:
+            # shapely 2.x: positions of the geometries the polygon contains
+            return np.sort(self.tree.query(geometry, predicate='contains'))
+        except TypeError:
+            prepared = prep(geometry)
+            return np.sort([self._positions[id(g)]
+                            for g in self.tree.query(geometry)
+                            if prepared.contains(g)]).astype(np.int64)
+
+
+def default_index():
+    """
+    Index of `constants.HEALTH_RESOURCE_FILES`, built on first use and then
+        kept for the rest of the session
+
+    Returns:
+        (FacilityIndex): the index
+    """
+    global _default_index
+    if _default_index is None:
+        _default_index = FacilityIndex()
+    return _default_index
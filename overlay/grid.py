@@ -0,0 +1,180 @@
+"""
+The zoom 12 web mercator tile grid that every overlay layer is laid out on
+"""
+
+import math
+import numpy as np
+
+from affine import Affine
+from rasterio import features
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+# half the width of the web mercator world, in meters
+WORLD_EXTENT = 20037508.342789244
+
+
+class Grid(object):
+    """
+    Block of tiles from the global web mercator layout that covers a
+        bounding box
+
+    Attributes:
+        zoom (int): zoom level of the global layout
+        tile_size (int): width and height of a tile in cells
+        col_min (int): layout column of the first tile
+        row_min (int): layout row of the first tile
+        cols (int): number of tile columns
+        rows (int): number of tile rows
+        cell_size (float): width and height of a cell in meters
+        extent ([float]): xmin, ymin, xmax, ymax of the grid in EPSG:3857
+    """
+
+    def __init__(self, bbox_wm, zoom=12, tile_size=256):
+        """
+        Construct the grid of tiles covering a bounding box
+
+        Args:
+            bbox_wm ([float]): xmin, ymin, xmax, ymax in EPSG:3857
+            zoom (int): zoom level of the global layout
+            tile_size (int): width and height of a tile in cells
+        """
+        self.zoom = zoom
+        self.tile_size = tile_size
+        self.tile_span = 2 * WORLD_EXTENT / 2 ** zoom
+        self.cell_size = self.tile_span / tile_size
+
+        self.col_min = self._col(bbox_wm[0])
+        self.row_min = self._row(bbox_wm[3])
+        self.cols = self._col(bbox_wm[2]) - self.col_min + 1
+        self.rows = self._row(bbox_wm[1]) - self.row_min + 1
+
+        xmin = -WORLD_EXTENT + self.col_min * self.tile_span
+        ymax = WORLD_EXTENT - self.row_min * self.tile_span
+        self.extent = [xmin,
+                       ymax - self.rows * self.tile_span,
+                       xmin + self.cols * self.tile_span,
+                       ymax]
+
+    def _col(self, x):
+        """
+        Helper function ('private') to find the layout column of an x value
+        """
+        return min(int(math.floor((x + WORLD_EXTENT) / self.tile_span)),
+                   2 ** self.zoom - 1)
+
+    def _row(self, y):
+        """
+        Helper function ('private') to find the layout row of a y value
+        """
+        return min(int(math.floor((WORLD_EXTENT - y) / self.tile_span)),
+                   2 ** self.zoom - 1)
+
+    @property
+    def shape(self):
+        """
+        (int, int): rows and columns of cells in the grid
+        """
+        return (self.rows * self.tile_size, self.cols * self.tile_size)
+
+    @property
+    def transform(self):
+        """
+        (affine.Affine): cell to EPSG:3857 transform of the grid
+        """
+        return Affine(self.cell_size, 0, self.extent[0],
+                      0, -self.cell_size, self.extent[3])
+
+    def keys(self):
+        """
+        Layout columns and rows of every tile in the grid
+
+        Returns:
+            ([(int, int)]): col, row pairs
+        """
+        return [(self.col_min + c, self.row_min + r)
+                for r in range(self.rows) for c in range(self.cols)]
+
+    def tile_slice(self, col, row):
+        """
+        Array slices of one tile of the grid
+
+        Args:
+            col (int): layout column of the tile
+            row (int): layout row of the tile
+
+        Returns:
+            ((slice, slice)): row and column slices
+        """
+        r = (row - self.row_min) * self.tile_size
+        c = (col - self.col_min) * self.tile_size
+        return (slice(r, r + self.tile_size), slice(c, c + self.tile_size))
+
+    def tile_extent(self, col, row):
+        """
+        Extent of one tile of the layout
+
+        Args:
+            col (int): layout column of the tile
+            row (int): layout row of the tile
+
+        Returns:
+            ([float]): xmin, ymin, xmax, ymax in EPSG:3857
+        """
+        xmin = -WORLD_EXTENT + col * self.tile_span
+        ymax = WORLD_EXTENT - row * self.tile_span
+        return [xmin, ymax - self.tile_span, xmin + self.tile_span, ymax]
+
+    def covering_keys(self, geom_wm):
+        """
+        Layout columns and rows of the tiles of the grid that a geometry
+            touches, found by rasterizing the geometry onto the grid at one
+            cell per tile
+
+        Args:
+            geom_wm (shapely.geometry): geometry in EPSG:3857
+
+        Returns:
+            ([(int, int)]): col, row pairs
+        """
+        if geom_wm is None or geom_wm.is_empty:
+            return []
+        touched = features.rasterize([(geom_wm, 1)],
+                                     out_shape=(self.rows, self.cols),
+                                     transform=Affine(self.tile_span, 0, self.extent[0],
+                                                      0, -self.tile_span, self.extent[3]),
+                                     fill=0,
+                                     all_touched=True,
+                                     dtype='uint8')
+        rows, cols = np.nonzero(touched)
+        return [(self.col_min + int(c), self.row_min + int(r))
+                for r, c in zip(rows, cols)]
+
+    def point_keys(self, xs, ys):
+        """
+        Layout columns and rows of the tiles of the grid that points fall in
+
+        Args:
+            xs (np.ndarray): point x coordinates in EPSG:3857
+            ys (np.ndarray): point y coordinates in EPSG:3857
+
+        Returns:
+            ([(int, int)]): col, row pairs, without points outside the grid
+        """
+        cols = np.floor((np.asarray(xs) + WORLD_EXTENT) / self.tile_span).astype(np.int64)
+        rows = np.floor((WORLD_EXTENT - np.asarray(ys)) / self.tile_span).astype(np.int64)
+        inside = ((cols >= self.col_min) & (cols < self.col_min + self.cols) &
+                  (rows >= self.row_min) & (rows < self.row_min + self.rows))
+        return sorted(set(zip(cols[inside].tolist(), rows[inside].tolist())))
+
+    def cover(self, keys):
+        """
+        Union of the extents of tiles of the layout
+
+        Args:
+            keys ([(int, int)]): col, row pairs
+
+        Returns:
+            (shapely.geometry): the tiles' area in EPSG:3857
+        """
+        return unary_union([box(*self.tile_extent(col, row)) for col, row in keys])
@@ -6,7 +6,10 @@ Set up jupyter notebook widgets to run boundary delineation and overlay analysis
 import ipywidgets as widgets
 from IPython.display import display
 
-from overlay import analysis, boundaries, constants
+from overlay import analysis, boundaries, constants, metrics
+
+# show the analysis' progress messages in the notebook
+metrics.show_progress()
 
 
 class boundary_input():
@@ -79,8 +82,12 @@ class overlay_input():
         l4 = widgets.HTML(
             value='Specify a category of storm to use in evaluating storm surge risk' +
             ' (<a href="https://www.nhc.noaa.gov/nationalsurge/#datahub">more information about storm surge</a>)')
-        self.storm_val = widgets.IntSlider(
-            value=storm, min=1, max=5, step=1, layout=l)
+        self.storm_val = widgets.SelectionSlider(
+            options=[('1', 1), ('2', 2), ('3', 3), ('4', 4), ('5', 5),
+                     ('worst case', None)],
+            value=storm, layout=l)
+        self.storm_val.observe(self.handle_storm, names='value')
+        self.overlay = None
         l5 = widgets.HTML(
             value='Go to the <a href="https://coast.noaa.gov/slrdata/">NOAA Sea Level Rise data download site</a>' +
             ' and copy the link to the dataset that covers your study area. Paste it below. If you have not already ' +
@@ -99,12 +106,25 @@ class overlay_input():
         """
         Run overlay analysis and add to map
         """
-        storm_file = '/home/hadoop/notebooks/data/read/overlay-layers/storm-surge/US_Category{}_MOM_Inundation_HighTide.tif'.format(
-            str(self.storm_val.value))
-        analysis.overlay_analysis(self.geonotebook,
-                                  self.overlay_name.value,
-                                  self.boundary_shp.value,
-                                  self.input_points.value,
-                                  self.sea_url.value,
-                                  storm_file,
-                                  constants.NATL_FLOOD_SHP)
+        result = analysis.overlay_analysis(self.geonotebook,
+                                           self.overlay_name.value,
+                                           self.boundary_shp.value,
+                                           self.input_points.value,
+                                           self.sea_url.value,
+                                           constants.NATL_STORM_SURGE,
+                                           constants.NATL_FLOOD_SHP,
+                                           storm_category=self.storm_val.value)
+        self.overlay = None if result is None else result[0]
+
+    def handle_storm(self, change):
+        """
+        Switch the storm category of an overlay that has already been run by
+            selecting its band, and update the map
+        """
+        if self.overlay is None or self.overlay.storm_surge_stack is None:
+            return
+        self.overlay.select_storm_category(change['new'])
+        self.overlay.overlay_layers()
+        analysis.map_layer(self.geonotebook, self.overlay.overlay,
+                           key=self.overlay.overlay_key,
+                           score_range=self.overlay.score_range)
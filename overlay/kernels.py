@@ -0,0 +1,217 @@
+"""
+NumPy map algebra shared by the overlay backends
+
+All functions work on int32 arrays in which `NODATA` marks missing cells,
+    and follow GeoTrellis semantics for reclassification and local
+    operations so that the Spark and NumPy backends agree cell for cell.
+"""
+
+import functools
+import numpy as np
+
+NODATA = np.iinfo(np.int32).min
+
+EXACT = 'exact'
+GREATER_THAN_OR_EQUAL_TO = 'greater_than_or_equal_to'
+LESS_THAN_OR_EQUAL_TO = 'less_than_or_equal_to'
+
+
+def from_tile(cells, no_data_value):
+    """
+    Convert tile cells with their own no data value to an int32 array that
+        uses `NODATA`
+
+    Args:
+        cells (np.ndarray): tile cells
+        no_data_value (number): the tile's no data value, None if the tile
+            has none
+
+    Returns:
+        (np.ndarray): int32 cells
+    """
+    if np.issubdtype(cells.dtype, np.floating):
+        missing = np.isnan(cells)
+        if no_data_value is not None and not np.isnan(no_data_value):
+            missing |= cells == no_data_value
+        cells = np.where(missing, 0, cells)
+    elif no_data_value is not None:
+        missing = cells == no_data_value
+    else:
+        missing = np.zeros(cells.shape, dtype=bool)
+    # cast first: small integer tiles can't hold NODATA
+    return np.where(missing, NODATA, cells.astype(np.int32))
+
+
+def to_tile(cells, no_data_value, dtype):
+    """
+    Convert an int32 array that uses `NODATA` to tile cells with their own
+        no data value
+
+    Args:
+        cells (np.ndarray): int32 cells
+        no_data_value (number): no data value of the output tile
+        dtype (np.dtype): data type of the output tile
+
+    Returns:
+        (np.ndarray): tile cells
+    """
+    return np.where(cells == NODATA, no_data_value, cells).astype(dtype)
+
+
+def reclassify(cells, value_map, strategy=EXACT, replace_nodata_with=None):
+    """
+    Reclassify cells with a break map. Cells that match no break become
+        no data, and cells that were no data become `replace_nodata_with`
+        if it is given.
+
+    Args:
+        cells (np.ndarray): int32 cells
+        value_map (dict): breaks to new values
+        strategy (str): one of `EXACT`, `GREATER_THAN_OR_EQUAL_TO` or
+            `LESS_THAN_OR_EQUAL_TO`
+        replace_nodata_with (int): value for no data cells, defaults to None
+
+    Returns:
+        (np.ndarray): reclassified int32 cells
+    """
+    breaks = np.array(sorted(value_map), dtype=np.int64)
+    values = np.array([value_map[b] for b in sorted(value_map)] + [NODATA],
+                      dtype=np.int32)
+    data = cells.astype(np.int64)
+
+    if strategy == EXACT:
+        idx = np.searchsorted(breaks, data)
+        idx = np.where((idx < len(breaks)) &
+                       (breaks[np.minimum(idx, len(breaks) - 1)] == data),
+                       idx, len(breaks))
+    elif strategy == GREATER_THAN_OR_EQUAL_TO:
+        idx = np.searchsorted(breaks, data, side='right') - 1
+        idx = np.where(idx < 0, len(breaks), idx)
+    elif strategy == LESS_THAN_OR_EQUAL_TO:
+        idx = np.searchsorted(breaks, data, side='left')
+    else:
+        raise ValueError('Unknown classification strategy: {}'.format(strategy))
+
+    result = values[idx]
+    missing = cells == NODATA
+    result[missing] = NODATA if replace_nodata_with is None else replace_nodata_with
+    return result
+
+
+def local_max(*arrays):
+    """
+    Cell-wise maximum that ignores no data, as GeoTrellis'
+        aggregate_by_cell(MAX) does
+
+    Args:
+        *arrays (np.ndarray): int32 cells of equal or broadcastable shape
+
+    Returns:
+        (np.ndarray): int32 cells, no data where every input is no data
+    """
+    # NODATA is the smallest int32, so a plain maximum already ignores it
+    return functools.reduce(np.maximum, arrays)
+
+
+def local_min(*arrays):
+    """
+    Cell-wise minimum that ignores no data, as GeoTrellis'
+        aggregate_by_cell(MIN) does
+
+    Args:
+        *arrays (np.ndarray): int32 cells of equal or broadcastable shape
+
+    Returns:
+        (np.ndarray): int32 cells, no data where every input is no data
+    """
+    top = np.iinfo(np.int32).max
+    result = functools.reduce(np.minimum, [np.where(a == NODATA, top, a) for a in arrays])
+    return np.where(result == top, NODATA, result).astype(np.int32)
+
+
+def combine(a, b, op):
+    """
+    Apply a binary operation to two arrays, or an array and a scalar,
+        propagating no data
+
+    Args:
+        a (np.ndarray or int): int32 cells or scalar
+        b (np.ndarray or int): int32 cells or scalar
+        op (function): NumPy binary operation such as `np.add`
+
+    Returns:
+        (np.ndarray): int32 cells
+    """
+    missing = (np.asarray(a) == NODATA) | (np.asarray(b) == NODATA)
+    return np.where(missing, NODATA, op(a, b)).astype(np.int32)
+
+
+def mask(cells, base):
+    """
+    Multiply cells by the base mask, dropping cells outside of it
+
+    Args:
+        cells (np.ndarray): int32 cells
+        base (np.ndarray): int32 base cells, 1 inside the study area and no
+            data outside
+
+    Returns:
+        (np.ndarray): int32 cells
+    """
+    return combine(cells, base, np.multiply)
+
+
+def union_with_base(cells, base, value_map={5: 5, 1: 1}, strategy=EXACT):
+    """
+    Combine a hazard with its base mask and convert no data values to 1:
+        union-max with the base, reclassify, then mask by the base
+
+    Args:
+        cells (np.ndarray): int32 hazard cells
+        base (np.ndarray): int32 base cells
+        value_map (dict): breaks to new values
+        strategy (str): classification strategy
+
+    Returns:
+        (np.ndarray): int32 cells
+    """
+    combined = local_max(cells, base)
+    reclassed = reclassify(combined, value_map, strategy, replace_nodata_with=1)
+    return mask(reclassed, base)
+
+
+def reclassify_with_base(cells, base, value_map, strategy=EXACT):
+    """
+    Reclassify a hazard, converting no data values to 1, then mask it by the
+        base mask
+
+    Args:
+        cells (np.ndarray): int32 hazard cells
+        base (np.ndarray): int32 base cells
+        value_map (dict): breaks to new values
+        strategy (str): classification strategy
+
+    Returns:
+        (np.ndarray): int32 cells
+    """
+    reclassed = reclassify(cells, value_map, strategy, replace_nodata_with=1)
+    return mask(reclassed, base)
+
+
+def threshold_with_base(cells, base, threshold, value=5):
+    """
+    Flag cells at or below a threshold with `value` and every other cell of
+        the base mask with 1, e.g. to derive the sea level rise hazard of one
+        scenario from the minimum feet of rise that inundates each cell
+
+    Args:
+        cells (np.ndarray): int32 cells
+        base (np.ndarray): int32 base cells
+        threshold (int): largest cell value to flag
+        value (int): value of flagged cells, defaults to 5
+
+    Returns:
+        (np.ndarray): int32 cells
+    """
+    value_map = {threshold: value, np.iinfo(np.int32).max: 1}
+    return reclassify_with_base(cells, base, value_map, LESS_THAN_OR_EQUAL_TO)
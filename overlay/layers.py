@@ -6,10 +6,31 @@ import os
 import numpy as np
 import geopandas as gpd
 import geopyspark as gps
-import fiona
 
-from osgeo import ogr
-from shapely.geometry import MultiPolygon, shape
+from affine import Affine
+from pyspark import SparkContext
+from rasterio import features
+from shapely import wkb
+
+from overlay import constants, kernels, metrics, rasters, sparse, vector
+
+# compressed tile of a layer with no tile at a key
+NODATA_TILE = np.full(sparse.CONSTANT_SHAPE, kernels.NODATA, dtype=np.int32)
+
+
+def base(overlay):
+    """
+    Create the tiled base layer: 1 inside the study area, no data outside.
+        Tiles within the study area compress to a single value. The base is
+        partitioned by the overlay's partitioner and cached, since every
+        layer is joined with it.
+    """
+    base_raster = gps.rasterize(
+        overlay.study_area['geom_wgs'], 4326, 14, 1, gps.CellType.INT8)
+    base_tiled = _tile_to_layout(base_raster, overlay)
+    tiles = overlay.partitioner.partition(sparse.cells_rdd(base_tiled)).cache()
+    return sparse.SparseTiledLayer(tiles, base_tiled.layer_metadata,
+                                   base_tiled.zoom_level)
 
 
 def flood_hazard(overlay, flood_shp):
@@ -19,26 +40,25 @@ def flood_hazard(overlay, flood_shp):
     if flood_shp is None:
         return None
     else:
-        # read flood shp
-        shapes = gpd.read_file(flood_shp)
-        flood_poly = [s for s in shapes.geometry if s is not None]
+        # read the flood zones that reach the study area's tiles, clipped
+        #   to them
+        cover = overlay.study_area['cover_wgs']
+        shapes = gpd.read_file(flood_shp, mask=gpd.GeoSeries(
+            [cover], crs={'init': 'epsg:4326'}))
+        metrics.count('features_read', len(shapes))
+        flood_poly = vector.clip(shapes.geometry, cover)
+        if len(flood_poly) == 0:
+            return _union_with_base(SparkContext.getOrCreate().emptyRDD(), overlay)
 
         # rasterize
         flood_raster = gps.rasterize(
             flood_poly, 4326, 12, 5, gps.CellType.INT8)
 
-        # reclassify values to fit on 1-7 scale
-        flood_reclass = flood_raster.reclassify(value_map={5: 5},
-                                                data_type=int,
-                                                replace_nodata_with=1,
-                                                classification_strategy=gps.ClassificationStrategy.EXACT)
-
         # layout
-        flood_tiled = flood_reclass.tile_to_layout(
-            gps.GlobalLayout(zoom=12), 3857)
+        flood_tiled = _tile_to_layout(flood_raster, overlay)
 
-        # convert to an appropriate format for the overlay
-        return _union_with_base(flood_tiled, overlay)
+        # reclassify values to fit on 1-7 scale and mask by the base
+        return _union_with_base(flood_tiled.to_numpy_rdd(), overlay)
 
 
 def sea_level_rise(overlay, gdb, feet=5):
@@ -48,37 +68,46 @@ def sea_level_rise(overlay, gdb, feet=5):
     if gdb is None:
         return None
     else:
-        # open geodatabase
-        driver = ogr.GetDriverByName("OpenFileGDB")
-        g = driver.Open(gdb)
-
         # find appropriate layer name
-        suffix = 'slr_{}ft'.format(str(feet))
-        for x in range(g.GetLayerCount()):
-            layer_name = g.GetLayerByIndex(x).GetName()
-            if layer_name.endswith(suffix):
-                break
-
-        # read sea level rise polygons
-        sea_poly = []
-        with fiona.open(gdb, layer=layer_name) as source:
-            slr_crs = source.crs['init']
-            for p in source:
-                sea_poly += MultiPolygon(shape(p['geometry']))
+        layer_name = vector.slr_layer_name(gdb, feet)
 
-        # rasterize
-        sea_raster = gps.rasterize(sea_poly, 4326, 12, 5, gps.CellType.INT8)
+        # stream the sea level rise polygons in the study area
+        sea_tiles = _rasterize_batches(overlay, gdb, layer_name, 5,
+                                       SparkContext.getOrCreate().emptyRDD(),
+                                       _max_tiles)
+
+        # reclassify values to fit on 1-7 scale and mask by the base
+        return _union_with_base(sea_tiles, overlay)
 
-        # reclassify values to fit on 1-7 scale
-        sea_reclass = sea_raster.reclassify(value_map={5: 5},
-                                            data_type=int,
-                                            replace_nodata_with=1,
-                                            classification_strategy=gps.ClassificationStrategy.EXACT)
 
-        # convert layout
-        sea_tiled = sea_reclass.tile_to_layout(gps.GlobalLayout(zoom=12), 3857)
+def sea_level_rise_depths(overlay, gdb):
+    """
+    Create a tiled layer of the minimum feet of sea level rise that inundates
+        each cell, from all of the `slr_*ft` layers of a geodatabase in one
+        pass. Cells that no scenario inundates are no data.
+    """
+    if gdb is None:
+        return None
+    else:
+        depth_tiles = SparkContext.getOrCreate().emptyRDD()
+        for feet, layer_name in sorted(vector.slr_layer_names(gdb).items()):
+            depth_tiles = _rasterize_batches(overlay, gdb, layer_name, feet,
+                                             depth_tiles, _min_tiles)
 
-        return _union_with_base(sea_tiled, overlay)
+        # mask by the base
+        return _map_with_base(depth_tiles, overlay, kernels.mask)
+
+
+def sea_level_rise_from_depths(overlay, depths, feet=5):
+    """
+    Derive the tiled sea level rise layer of one scenario from a layer built
+        by `sea_level_rise_depths`
+    """
+    if depths is None:
+        return None
+    return _map_with_base(sparse.cells_rdd(depths), overlay,
+                          lambda cells, base: kernels.threshold_with_base(
+                              cells, base, feet))
 
 
 def storm_surge(overlay, storm_surge_tiff):
@@ -86,40 +115,285 @@ def storm_surge(overlay, storm_surge_tiff):
     Create a tiled storm surge layer
     """
 
-    # read in tiff
-    storm_raster = gps.geotiff.get(gps.LayerType.SPATIAL,
-                                   storm_surge_tiff,
-                                   max_tile_size=128,
-                                   num_partitions=32)
+    # read the study area window of the tiff
+    storm_raster = rasters.read_window(storm_surge_tiff,
+                                       overlay.study_area['bbox_wgs'],
+                                       max_tile_size=128,
+                                       num_partitions=overlay.partitioner.num_partitions,
+                                       within=overlay.study_area['cover_wgs'])
+    if storm_raster is None:
+        return None
+
+    # convert to same layout as the base
+    storm_tiled = _tile_to_layout(storm_raster, overlay)
+
+    # reclassify storm surge and mask by the base
+    return _map_with_base(storm_tiled.to_numpy_rdd(), overlay,
+                          lambda cells, base: kernels.reclassify_with_base(
+                              cells, base,
+                              constants.STORM_SURGE_VALUE_MAP,
+                              kernels.GREATER_THAN_OR_EQUAL_TO))
+
+
+def storm_surge_stack(overlay, storm_surge_tiffs):
+    """
+    Create a tiled storm surge layer with one band per storm category, read,
+        tiled and reclassified in one pass
+    """
+
+    # read the study area window of every tiff as bands of one layer
+    storm_raster = rasters.read_window_stack(storm_surge_tiffs,
+                                             overlay.study_area['bbox_wgs'],
+                                             max_tile_size=128,
+                                             num_partitions=overlay.partitioner.num_partitions,
+                                             within=overlay.study_area['cover_wgs'])
+    if storm_raster is None:
+        return None
+
+    # convert to same layout as the base
+    storm_tiled = _tile_to_layout(storm_raster, overlay)
+
+    # reclassify every band and mask by the base
+    return _map_with_base(storm_tiled.to_numpy_rdd(), overlay,
+                          lambda cells, base: kernels.reclassify_with_base(
+                              cells, base,
+                              constants.STORM_SURGE_VALUE_MAP,
+                              kernels.GREATER_THAN_OR_EQUAL_TO),
+                          bands=len(storm_surge_tiffs))
+
+
+def select_storm_category(stack, category=None):
+    """
+    Select the storm surge layer of one category from a layer built by
+        `storm_surge_stack`, or the worst case across categories
+    """
+    if stack is None:
+        return None
+    if category is not None:
+        return stack.bands(category - 1)
+
+    def _worst(tile):
+        cells = kernels.local_max(*kernels.from_tile(tile.cells, tile.no_data_value))
+        return gps.Tile.from_numpy_array(
+            kernels.to_tile(cells, tile.no_data_value, tile.cells.dtype)[np.newaxis],
+            tile.no_data_value)
+
+    return gps.TiledRasterLayer.from_numpy_rdd(gps.LayerType.SPATIAL,
+                                               stack.to_numpy_rdd().mapValues(_worst),
+                                               stack.layer_metadata,
+                                               zoom_level=stack.zoom_level)
+
+
+def clip(tiled, overlay):
+    """
+    Mask a layer built for a larger area to an overlay's study area
+    """
+    return _map_with_base(sparse.cells_rdd(tiled), overlay, kernels.mask,
+                          cell_type=tiled.layer_metadata.cell_type)
+
+
+def zones(overlay, geoms_wm):
+    """
+    Create a tiled zone layer: the number of the geometry each cell of the
+        base falls in, from 1 for the first geometry, and no data outside
+        every geometry. Each base tile is rasterized on the executor that
+        holds it, so the layer keeps the overlay's partitioner. Where
+        geometries overlap, cells take the number of the one that comes last.
+    """
+    bounds = np.array([g.bounds if g is not None and not g.is_empty
+                       else (np.inf, np.inf, -np.inf, -np.inf) for g in geoms_wm])
+    shapes = SparkContext.getOrCreate().broadcast(
+        [None if g is None or g.is_empty else wkb.dumps(g) for g in geoms_wm])
+    grid = overlay.grid
+    rows, cols = overlay.base.tile_shape
+
+    def _rasterize_zones(tiles):
+        polygons = {}
+        for key, base_cells in tiles:
+            xmin, ymin, xmax, ymax = grid.tile_extent(key.col, key.row)
+            hits = np.nonzero((bounds[:, 0] < xmax) & (bounds[:, 2] > xmin) &
+                              (bounds[:, 1] < ymax) & (bounds[:, 3] > ymin))[0]
+            if len(hits) == 0:
+                continue
+            for i in hits:
+                if i not in polygons:
+                    polygons[i] = wkb.loads(shapes.value[i])
+            cells = features.rasterize(
+                [(polygons[i], int(i) + 1) for i in hits],
+                out_shape=(rows, cols),
+                transform=Affine((xmax - xmin) / cols, 0, xmin,
+                                 0, -(ymax - ymin) / rows, ymax),
+                fill=kernels.NODATA,
+                dtype='int32')
+            yield key, sparse.compress(kernels.mask(cells, base_cells))
+
+    tiles = overlay.base.tiles.mapPartitions(_rasterize_zones, preservesPartitioning=True)
+    return sparse.SparseTiledLayer(tiles,
+                                   sparse.with_cell_type(overlay.base.layer_metadata,
+                                                         sparse.RESULT_CELL_TYPE),
+                                   overlay.base.zoom_level)
+
+
+def weighted_overlay(overlay, program, layers, keys=None):
+    """
+    Evaluate a compiled overlay expression in one pass: the tiles of every
+        input layer are grouped by key by the overlay's partitioner, which
+        only shuffles inputs that aren't partitioned by it yet, and the whole
+        program runs on each group. Only tiles of the base layer are kept,
+        and inputs without a tile at a key are passed all no data cells.
+        If `keys` is given, only the tiles at those (col, row) keys are read
+        and evaluated. The result is int32, since sums of weighted scores
+        can exceed the range of the base's cell type.
+    """
+    names = ['base'] + [n for n in program.inputs if n != 'base']
+    sources = [overlay.base] + [layers[n] for n in names[1:]]
+    sc = SparkContext.getOrCreate()
+    wanted = None if keys is None else sc.broadcast(set(keys))
+
+    inputs = []
+    for layer in sources:
+        cells = sparse.cells_rdd(layer)
+        if wanted is not None:
+            cells = cells.filter(lambda key_cells: (key_cells[0].col, key_cells[0].row) in wanted.value)
+        inputs.append(cells)
+
+    def _evaluate(cells):
+        cells = dict(cells)
+        arrays = {}
+        for i, name in enumerate(names):
+            arrays[name] = cells.get(i, NODATA_TILE)
+        return sparse.compress(program.run(arrays))
 
-    # specify value map
-    rmap = {}
-    i = 2
-    for x in range(1, 21, 3):
-        rmap[x + 1] = int(i)
-        i += 1
+    evaluated = (overlay.partitioner.cogroup(inputs)
+                 .filter(lambda key_cells: any(i == 0 for i, _ in key_cells[1]))
+                 .mapValues(_evaluate))
+    return sparse.SparseTiledLayer(evaluated,
+                                   sparse.with_cell_type(overlay.base.layer_metadata,
+                                                         sparse.RESULT_CELL_TYPE),
+                                   overlay.base.zoom_level)
 
-    # reclassify storm surge
-    storm_reclass = storm_raster.reclassify(value_map=rmap,
-                                            data_type=int,
-                                            replace_nodata_with=1,
-                                            classification_strategy=gps.ClassificationStrategy.GREATER_THAN_OR_EQUAL_TO)
 
-    # convert to same layout as
-    storm_tiled = storm_reclass.tile_to_layout(gps.GlobalLayout(zoom=12), 3857)
-    return storm_tiled * overlay.base
+def _union_with_base(tiles, overlay, value_map={5: 5, 1: 1}, classification_strategy=kernels.EXACT):
+    """
+    Helper function ('private') to combine a layer's tiles with it's base
+            layer and convert no data values to 1
+    """
+    return _map_with_base(tiles, overlay,
+                          lambda cells, base: kernels.union_with_base(
+                              cells, base, value_map, classification_strategy))
+
+
+def _map_with_base(tiles, overlay, kernel, bands=None, cell_type=None):
+    """
+    Helper function ('private') to apply a kernel to each tile of an RDD of
+            (SpatialKey, Tile) or (SpatialKey, cells) and the matching base
+            tile in a single pass. The tiles are moved to the overlay's
+            partitioner, so the join with the base is narrow. Base tiles
+            without a layer tile are passed an all no data tile, and layer
+            tiles outside the study area's tiles are dropped before they are
+            moved. The result is a sparse layer. If `bands` is given, the
+            kernel is passed and returns all bands of a tile as one (bands,
+            rows, cols) array instead of the first band, and the result is
+            a full multiband layer. The result has the base's cell type
+            unless `cell_type` is given.
+    """
+    base = overlay.base
+    shape = base.tile_shape
+    keys = SparkContext.getOrCreate().broadcast(set(overlay.tile_keys))
+    metadata = base.layer_metadata
+    if cell_type is not None:
+        metadata = sparse.with_cell_type(metadata, cell_type)
+    dtype, no_data_value = sparse.cell_type_no_data(metadata.cell_type)
+
+    def _apply(tiles):
+        tiles = dict(tiles)
+        base_cells, tile = tiles[0], tiles.get(1)
+        if tile is None:
+            cells = NODATA_TILE if bands is None else np.full((bands, 1, 1), kernels.NODATA,
+                                                              dtype=np.int32)
+        elif isinstance(tile, np.ndarray):
+            cells = tile
+        else:
+            cells = kernels.from_tile(tile.cells[0] if bands is None else tile.cells,
+                                      tile.no_data_value)
+        result = kernel(cells, base_cells)
+        if bands is None:
+            return sparse.compress(result)
+        result = kernels.to_tile(np.broadcast_to(result, (bands,) + shape),
+                                 no_data_value, dtype)
+        return gps.Tile.from_numpy_array(result, no_data_value)
+
+    # drop tiles outside the study area before they are shuffled
+    tiles = tiles.filter(lambda key_tile: (key_tile[0].col, key_tile[0].row) in keys.value)
+    joined = (overlay.partitioner.cogroup([base.tiles, tiles])
+              .filter(lambda key_tiles: any(i == 0 for i, _ in key_tiles[1]))
+              .mapValues(_apply))
+    if bands is None:
+        return sparse.SparseTiledLayer(joined, metadata, base.zoom_level)
+    return gps.TiledRasterLayer.from_numpy_rdd(gps.LayerType.SPATIAL,
+                                               joined,
+                                               metadata,
+                                               zoom_level=base.zoom_level)
+
+
+def _tile_to_layout(raster, overlay):
+    """
+    Helper function ('private') to tile a raster layer to the zoom 12 global
+            layout, in as many Z-order partitions as the overlay's
+            partitioner has
+    """
+    return raster.tile_to_layout(gps.GlobalLayout(zoom=12), 3857,
+                                 partition_strategy=gps.SpatialPartitionStrategy(
+                                     num_partitions=overlay.partitioner.num_partitions))
+
+
+def _rasterize_batches(overlay, gdb, layer_name, value, tiles, merge):
+    """
+    Helper function ('private') to stream the polygons of a geodatabase layer
+            that overlap the study area's tiles, clipped to those tiles,
+            rasterize each batch with a value and merge its tiles into an
+            RDD of (SpatialKey, Tile) partitioned by the overlay's
+            partitioner
+    """
+    partitioner = overlay.partitioner
+    for poly in vector.read_batches(gdb, overlay.study_area['bbox_wgs'],
+                                    layer=layer_name,
+                                    within=overlay.study_area['cover_wgs']):
+        raster = gps.rasterize(poly, 4326, 12, value, gps.CellType.INT8)
+        batch_tiles = partitioner.partition(_tile_to_layout(raster, overlay).to_numpy_rdd())
+        # only the batch is shuffled: the merged tiles keep their partitions
+        tiles = (partitioner.partition(tiles)
+                 .union(batch_tiles)
+                 .reduceByKey(merge, partitioner.num_partitions, partitioner))
+        # truncate the lineage so each batch's geometries can be released
+        tiles.localCheckpoint()
+        tiles.count()
+    return tiles
+
+
+def _max_tiles(a, b):
+    """
+    Helper function ('private') to merge two tiles of the same key with a
+            cell-wise maximum
+    """
+    return _merge_tiles(a, b, kernels.local_max)
+
+
+def _min_tiles(a, b):
+    """
+    Helper function ('private') to merge two tiles of the same key with a
+            cell-wise minimum
+    """
+    return _merge_tiles(a, b, kernels.local_min)
 
 
-def _union_with_base(tiled, overlay, value_map={5: 5, 1: 1}, classification_strategy=gps.ClassificationStrategy.EXACT):
+def _merge_tiles(a, b, op):
     """
-    Helper function ('private') to combine a layer with it's base layer and
-            convert no data values to 1
+    Helper function ('private') to merge two tiles of the same key cell by
+            cell, keeping the first tile's data type and no data value
     """
-    unioned_base = gps.geotrellis.union(layers=[tiled, overlay.base])
-    agg_base = unioned_base.aggregate_by_cell(
-        operation=gps.geotrellis.constants.Operation.MAX)
-    agg_reclass = agg_base.reclassify(value_map=value_map,
-                                      data_type=int,
-                                      replace_nodata_with=1,
-                                      classification_strategy=classification_strategy)
-    return agg_reclass * overlay.base
+    cells = op(kernels.from_tile(a.cells[0], a.no_data_value),
+               kernels.from_tile(b.cells[0], b.no_data_value))
+    return gps.Tile.from_numpy_array(
+        kernels.to_tile(cells, a.no_data_value, a.cells.dtype)[np.newaxis],
+        a.no_data_value)
@@ -0,0 +1,381 @@
+"""
+Create the overlay layers as in-memory NumPy arrays
+
+This is a single-node alternative to the GeoPySpark layers in
+    `overlay.layers` for study areas that fit in memory. It exposes the same
+    functions, lays every layer out on the same zoom 12 web mercator grid,
+    and uses the map algebra in `overlay.kernels`. Geometries are rasterized
+    and rasters resampled the way the GeoPySpark layers are, so both
+    backends produce the same cells. Only `LocalLayer.to_tiled_layer` needs
+    GeoPySpark, and imports it when it is called, so the backend runs on
+    machines without Spark.
+"""
+
+import math
+import numpy as np
+import geopandas as gpd
+import rasterio
+
+from affine import Affine
+from rasterio import features
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from overlay import constants, kernels, metrics, vector
+
+# xmin, ymin, xmax, ymax of the global EPSG:4326 layout geometries are
+#   rasterized on, the world extent GeoTrellis uses for the crs
+LAYOUT_EXTENT_WGS = [-180, -89.99999, 179.99999, 89.99999]
+
+
+class LocalLayer(object):
+    """
+    Overlay layer held as one array over the study area grid
+
+    Attributes:
+        cells (np.ndarray): int32 cells, `kernels.NODATA` where missing
+        grid (grid.Grid): tile grid the cells are laid out on
+    """
+
+    def __init__(self, cells, grid):
+        self.cells = cells
+        self.grid = grid
+
+    def _combine(self, other, op, reverse=False):
+        """
+        Helper function ('private') to apply a binary operation with another
+            layer or a scalar
+        """
+        other_cells = other.cells if isinstance(other, LocalLayer) else other
+        if reverse:
+            return LocalLayer(kernels.combine(other_cells, self.cells, op), self.grid)
+        return LocalLayer(kernels.combine(self.cells, other_cells, op), self.grid)
+
+    def __add__(self, other):
+        return self._combine(other, np.add)
+
+    def __radd__(self, other):
+        return self._combine(other, np.add, reverse=True)
+
+    def __sub__(self, other):
+        return self._combine(other, np.subtract)
+
+    def __rsub__(self, other):
+        return self._combine(other, np.subtract, reverse=True)
+
+    def __mul__(self, other):
+        return self._combine(other, np.multiply)
+
+    def __rmul__(self, other):
+        return self._combine(other, np.multiply, reverse=True)
+
+    def get_point_values(self, points):
+        """
+        Get the cell values at a list of points in EPSG:3857, in the same
+            form as `TiledRasterLayer.get_point_values`
+
+        Args:
+            points ([shapely.geometry.Point]): points to sample
+
+        Returns:
+            ([(shapely.geometry.Point, [float])]): each point with its value,
+                nan where the cell is no data or outside the grid
+        """
+        xs = np.array([p.x for p in points])
+        ys = np.array([p.y for p in points])
+        cols = np.floor((xs - self.grid.extent[0]) / self.grid.cell_size).astype(int)
+        rows = np.floor((self.grid.extent[3] - ys) / self.grid.cell_size).astype(int)
+        inside = ((rows >= 0) & (rows < self.cells.shape[0]) &
+                  (cols >= 0) & (cols < self.cells.shape[1]))
+
+        values = np.full(len(points), np.nan)
+        sampled = self.cells[rows[inside], cols[inside]]
+        values[inside] = np.where(sampled == kernels.NODATA, np.nan, sampled)
+        return [(p, [v]) for p, v in zip(points, values)]
+
+    def to_tiled_layer(self):
+        """
+        Convert to a GeoPySpark tiled layer on the zoom 12 global layout,
+            for display and other Spark-only operations
+
+        Returns:
+            (gps.TiledRasterLayer): the layer
+        """
+        import geopyspark as gps
+        from pyspark import SparkContext
+
+        tiles = []
+        for col, row in self.grid.keys():
+            cells = self.cells[self.grid.tile_slice(col, row)]
+            if (cells == kernels.NODATA).all():
+                continue
+            extent = gps.Extent(*self.grid.tile_extent(col, row))
+            tiles.append((gps.ProjectedExtent(extent, epsg=3857),
+                          gps.Tile.from_numpy_array(cells[np.newaxis],
+                                                    kernels.NODATA)))
+        rdd = SparkContext.getOrCreate().parallelize(tiles)
+        raster = gps.RasterLayer.from_numpy_rdd(gps.LayerType.SPATIAL, rdd)
+        return raster.tile_to_layout(gps.GlobalLayout(zoom=12), 3857)
+
+
+def base(overlay):
+    """
+    Create the base layer: 1 inside the study area, no data outside
+    """
+    return LocalLayer(_rasterize(overlay.study_area['geom_wgs'], overlay.grid, 1, 14),
+                      overlay.grid)
+
+
+def flood_hazard(overlay, flood_shp):
+    """
+    Create a flood hazard layer
+    """
+    if flood_shp is None:
+        return None
+    else:
+        # read the flood zones that reach the study area's tiles, clipped
+        #   to them
+        cover = overlay.study_area['cover_wgs']
+        shapes = gpd.read_file(flood_shp, mask=gpd.GeoSeries(
+            [cover], crs={'init': 'epsg:4326'}))
+        metrics.count('features_read', len(shapes))
+        flood_poly = vector.clip(shapes.geometry, cover)
+
+        # rasterize, then reclassify values to fit on 1-7 scale
+        flood_raster = _rasterize(flood_poly, overlay.grid, 5, 12)
+        return LocalLayer(kernels.union_with_base(flood_raster, overlay.base.cells),
+                          overlay.grid)
+
+
+def sea_level_rise(overlay, gdb, feet=5):
+    """
+    Create a sea level rise layer
+    """
+    if gdb is None:
+        return None
+    else:
+        layer_name = vector.slr_layer_name(gdb, feet)
+
+        # stream the sea level rise polygons in the study area, burning each
+        #   batch into the same raster, then reclassify values to fit on
+        #   1-7 scale
+        sea_raster = np.full(overlay.grid.shape, kernels.NODATA, dtype=np.int32)
+        for sea_poly in vector.read_batches(gdb, overlay.study_area['bbox_wgs'],
+                                            layer=layer_name,
+                                            within=overlay.study_area['cover_wgs']):
+            _rasterize(sea_poly, overlay.grid, 5, 12, out=sea_raster)
+        return LocalLayer(kernels.union_with_base(sea_raster, overlay.base.cells),
+                          overlay.grid)
+
+
+def sea_level_rise_depths(overlay, gdb):
+    """
+    Create a layer of the minimum feet of sea level rise that inundates each
+        cell, from all of the `slr_*ft` layers of a geodatabase in one pass.
+        Cells that no scenario inundates are no data.
+    """
+    if gdb is None:
+        return None
+    else:
+        # burn the highest rise first so lower rises overwrite it
+        depths = np.full(overlay.grid.shape, kernels.NODATA, dtype=np.int32)
+        for feet, layer_name in sorted(vector.slr_layer_names(gdb).items(),
+                                       reverse=True):
+            for sea_poly in vector.read_batches(gdb, overlay.study_area['bbox_wgs'],
+                                                layer=layer_name,
+                                                within=overlay.study_area['cover_wgs']):
+                _rasterize(sea_poly, overlay.grid, feet, 12, out=depths)
+        return LocalLayer(kernels.mask(depths, overlay.base.cells), overlay.grid)
+
+
+def sea_level_rise_from_depths(overlay, depths, feet=5):
+    """
+    Derive the sea level rise layer of one scenario from a layer built by
+        `sea_level_rise_depths`
+    """
+    if depths is None:
+        return None
+    return LocalLayer(kernels.threshold_with_base(depths.cells,
+                                                  overlay.base.cells, feet),
+                      overlay.grid)
+
+
+def storm_surge(overlay, storm_surge_tiff):
+    """
+    Create a storm surge layer
+    """
+    storm_raster = _reproject(storm_surge_tiff, overlay.grid)
+
+    # reclassify storm surge and mask by the base
+    return LocalLayer(kernels.reclassify_with_base(storm_raster,
+                                                   overlay.base.cells,
+                                                   constants.STORM_SURGE_VALUE_MAP,
+                                                   kernels.GREATER_THAN_OR_EQUAL_TO),
+                      overlay.grid)
+
+
+def storm_surge_stack(overlay, storm_surge_tiffs):
+    """
+    Create a storm surge layer with one band per storm category. The cells
+        of the returned layer are a (bands, rows, cols) array.
+    """
+    storm_raster = np.stack([_reproject(t, overlay.grid) for t in storm_surge_tiffs])
+
+    # reclassify every band and mask by the base
+    return LocalLayer(kernels.reclassify_with_base(storm_raster,
+                                                   overlay.base.cells,
+                                                   constants.STORM_SURGE_VALUE_MAP,
+                                                   kernels.GREATER_THAN_OR_EQUAL_TO),
+                      overlay.grid)
+
+
+def select_storm_category(stack, category=None):
+    """
+    Select the storm surge layer of one category from a layer built by
+        `storm_surge_stack`, or the worst case across categories
+    """
+    if stack is None:
+        return None
+    if category is not None:
+        return LocalLayer(stack.cells[category - 1], stack.grid)
+    return LocalLayer(kernels.local_max(*stack.cells), stack.grid)
+
+
+def clip(layer, overlay):
+    """
+    Mask a layer built for a larger area to an overlay's study area
+    """
+    grid = overlay.grid
+    row = (grid.row_min - layer.grid.row_min) * grid.tile_size
+    col = (grid.col_min - layer.grid.col_min) * grid.tile_size
+    cells = layer.cells[row:row + grid.shape[0], col:col + grid.shape[1]]
+    return LocalLayer(kernels.mask(cells, overlay.base.cells), grid)
+
+
+def zones(overlay, geoms_wm):
+    """
+    Create a zone layer: the number of the geometry each cell of the base
+        falls in, from 1 for the first geometry, and no data outside every
+        geometry. Where geometries overlap, cells take the number of the one
+        that comes last.
+    """
+    grid = overlay.grid
+    cells = np.full(grid.shape, kernels.NODATA, dtype=np.int32)
+    shapes = [(g, i + 1) for i, g in enumerate(geoms_wm)
+              if g is not None and not g.is_empty]
+    if len(shapes) > 0:
+        features.rasterize(shapes, out=cells, transform=grid.transform)
+    return LocalLayer(kernels.mask(cells, overlay.base.cells), grid)
+
+
+def weighted_overlay(overlay, program, layers, keys=None):
+    """
+    Evaluate a compiled overlay expression over the whole grid in one pass,
+        or only over the tiles at the given (col, row) keys
+    """
+    grid = overlay.grid
+    arrays = {'base': overlay.base.cells}
+    arrays.update({n: layers[n].cells for n in program.inputs if n != 'base'})
+    if keys is None:
+        return LocalLayer(program.run(arrays), grid)
+    cells = np.full(grid.shape, kernels.NODATA, dtype=np.int32)
+    for col, row in set(keys) & set(grid.keys()):
+        window = grid.tile_slice(col, row)
+        cells[window] = program.run({n: a[window] for n, a in arrays.items()})
+    return LocalLayer(cells, grid)
+
+
+def _reproject(tiff, grid):
+    """
+    Helper function ('private') to resample the first band of a raster onto
+        the grid as int32 cells. As in the tiles GeoPySpark reads, a raster
+        without a no data value has none: its zeros are data, and cells
+        outside it are 0 in tiles that overlap it and no data elsewhere.
+    """
+    with rasterio.open(tiff) as src:
+        if src.nodata is not None:
+            cells = np.full(grid.shape, src.nodata, dtype=src.dtypes[0])
+            reproject(rasterio.band(src, 1), cells,
+                      dst_transform=grid.transform,
+                      dst_crs='EPSG:3857',
+                      dst_nodata=src.nodata,
+                      resampling=Resampling.nearest)
+            return kernels.from_tile(cells, src.nodata)
+
+        cells = np.zeros(grid.shape, dtype=src.dtypes[0])
+        reproject(rasterio.band(src, 1), cells,
+                  dst_transform=grid.transform,
+                  dst_crs='EPSG:3857',
+                  resampling=Resampling.nearest)
+        covered = np.zeros(grid.shape, dtype=np.uint8)
+        reproject(np.ones(src.shape, dtype=np.uint8), covered,
+                  src_transform=src.transform,
+                  src_crs=src.crs,
+                  dst_transform=grid.transform,
+                  dst_crs='EPSG:3857',
+                  dst_nodata=0,
+                  resampling=Resampling.nearest)
+    cells = kernels.from_tile(cells, None)
+    for col, row in grid.keys():
+        window = grid.tile_slice(col, row)
+        if not covered[window].any():
+            cells[window] = kernels.NODATA
+    return cells
+
+
+def _rasterize(geoms, grid, value, zoom, out=None):
+    """
+    Helper function ('private') to burn EPSG:4326 geometries into an int32
+        array over the grid, no data elsewhere, as `gps.rasterize` and
+        `tile_to_layout` do: the geometries are rasterized on the zoom level
+        of the global EPSG:4326 layout, then resampled onto the grid by
+        nearest neighbor. Works a tile at a time to bound the memory of the
+        finer layout. Burns into `out` in place if it is given.
+    """
+    if out is None:
+        out = np.full(grid.shape, kernels.NODATA, dtype=np.int32)
+    geoms = [g for g in geoms if g is not None and not g.is_empty]
+    if len(geoms) == 0:
+        return out
+    bounds = np.array([g.bounds for g in geoms])
+
+    # the layout has 2 ** zoom by 2 ** zoom tiles of 256 cells
+    layout_xmin, layout_ymin, layout_xmax, layout_ymax = LAYOUT_EXTENT_WGS
+    cell_x = (layout_xmax - layout_xmin) / 2 ** zoom / 256
+    cell_y = (layout_ymax - layout_ymin) / 2 ** zoom / 256
+    for col, row in grid.keys():
+        west, south, east, north = transform_bounds(
+            'EPSG:3857', 'EPSG:4326', *grid.tile_extent(col, row))
+        near = ((bounds[:, 0] <= east) & (bounds[:, 2] >= west) &
+                (bounds[:, 1] <= north) & (bounds[:, 3] >= south))
+        if not near.any():
+            continue
+
+        # the cells of the layout under the tile, with a margin of one
+        src_col = int(math.floor((west - layout_xmin) / cell_x)) - 1
+        src_row = int(math.floor((layout_ymax - north) / cell_y)) - 1
+        src_shape = (int(math.ceil((layout_ymax - south) / cell_y)) + 1 - src_row,
+                     int(math.ceil((east - layout_xmin) / cell_x)) + 1 - src_col)
+        src_transform = Affine(cell_x, 0, layout_xmin + src_col * cell_x,
+                               0, -cell_y, layout_ymax - src_row * cell_y)
+        burned = features.rasterize([(geoms[i], value) for i in np.flatnonzero(near)],
+                                    out_shape=src_shape,
+                                    transform=src_transform,
+                                    fill=kernels.NODATA,
+                                    dtype=np.int32)
+
+        window = grid.tile_slice(col, row)
+        xmin, _, _, ymax = grid.tile_extent(col, row)
+        cells = np.full((grid.tile_size, grid.tile_size), kernels.NODATA,
+                        dtype=np.int32)
+        reproject(burned, cells,
+                  src_transform=src_transform,
+                  src_crs='EPSG:4326',
+                  src_nodata=kernels.NODATA,
+                  dst_transform=Affine(grid.cell_size, 0, xmin,
+                                       0, -grid.cell_size, ymax),
+                  dst_crs='EPSG:3857',
+                  dst_nodata=kernels.NODATA,
+                  resampling=Resampling.nearest)
+        hit = cells != kernels.NODATA
+        out[window][hit] = cells[hit]
+    return out
@@ -0,0 +1,234 @@
+"""
+Find boundary features by name or code without reading the whole file
+
+A lookup index is a JSON file next to a boundary shapefile that lists the
+    feature id, normalized name and places in the name, and the codes
+    (GEOID, CBSAFP, STATEFP) of every feature. Searches run against the
+    index, and only the matching features are read from the shapefile, by
+    random access. Indexes are rebuilt when their shapefile changes and kept
+    in memory for the rest of the session. When the shapefile's directory is
+    read-only, the index is written to `constants.LOOKUP_INDEX_DIR` instead,
+    or only kept in memory if that can't be written either.
+"""
+
+import os
+import re
+import json
+import difflib
+import logging
+import fiona
+import geopandas as gpd
+
+from overlay import constants, utils
+
+logger = logging.getLogger(__name__)
+
+# attributes of TIGER/Line boundary files that are indexed
+INDEX_FIELDS = ['NAME', 'GEOID', 'CBSAFP', 'STATEFP', 'COUNTYFP']
+
+_indexes = {}
+
+
+class BoundaryIndex(object):
+    """
+    Lookup index of a boundary shapefile
+
+    Attributes:
+        shp (str): path to the boundary shapefile
+        identity ([str, int, float]): path, size and modification time of
+            the shapefile when the index was loaded
+        records ([dict]): feature id, normalized name and indexed attributes
+            of every feature
+    """
+
+    def __init__(self, shp):
+        """
+        Load the lookup index of a shapefile, building it if it is missing or
+            older than the shapefile
+
+        Args:
+            shp (str): path to the boundary shapefile
+        """
+        self.shp = shp
+        self.identity = utils.file_identity(shp)
+        index = None
+        for path in _index_paths(shp):
+            if os.path.isfile(path):
+                with open(path) as f:
+                    index = json.load(f)
+                if index.get('source') == self.identity:
+                    break
+                index = None
+        if index is None:
+            index = self._build()
+        self.records = index['records']
+
+    def find(self, query, state_fips=None, cutoff=0.8):
+        """
+        Find the features matching a name or a code. Matches are tried in
+            order: a GEOID or CBSA code, the exact name, names that start
+            with or contain the query, and finally the closest name by
+            fuzzy matching.
+
+        Args:
+            query (str): name or code to search for, e.g. 'houston' or
+                '26420'
+            state_fips (str): only match features in this state, defaults
+                to None
+            cutoff (float): similarity a fuzzy match needs, between 0 and 1
+
+        Returns:
+            ([int]): feature ids of the best matches, empty if nothing
+                matches
+        """
+        records = self.records
+        if state_fips is not None:
+            records = [r for r in records if r.get('STATEFP') == str(state_fips)]
+
+        code = str(query).strip()
+        matches = [r for r in records
+                   if code in (r.get('GEOID'), r.get('CBSAFP'))]
+        if len(matches) == 0:
+            name = normalize(query)
+            matches = [r for r in records if r['name'] == name]
+        if len(matches) == 0:
+            matches = [r for r in records if r['name'].startswith(name)]
+            matches += [r for r in records
+                        if name in r['name'] and not r['name'].startswith(name)]
+        if len(matches) == 0:
+            # compare with whole names and with each place in them, e.g.
+            #   'houston' in 'Houston-The Woodlands-Sugar Land, TX'
+            names = {}
+            for r in records:
+                for n in [r['name']] + r['places']:
+                    names.setdefault(n, r)
+            close = difflib.get_close_matches(name, list(names), n=1, cutoff=cutoff)
+            matches = [names[n] for n in close]
+        return [r['fid'] for r in matches]
+
+    def read(self, fids):
+        """
+        Read features by id, without reading the rest of the shapefile
+
+        Args:
+            fids ([int]): feature ids
+
+        Returns:
+            (gpd.GeoDataFrame): the features
+        """
+        with fiona.open(self.shp) as source:
+            features = [source[fid] for fid in fids]
+            crs = source.crs
+        return gpd.GeoDataFrame.from_features(features, crs=crs)
+
+    def _build(self):
+        """
+        Helper function ('private') to index the attributes of every feature
+            and write the index next to the shapefile, or to the lookup index
+            directory if the shapefile's directory is read-only
+        """
+        logger.info('Building lookup index for {}...'.format(os.path.basename(self.shp)))
+        records = []
+        with fiona.open(self.shp, ignore_geometry=True) as source:
+            fields = [f for f in INDEX_FIELDS if f in source.schema['properties']]
+            for fid, feature in source.items():
+                properties = feature['properties']
+                record = {f: properties[f] for f in fields}
+                record['fid'] = fid
+                record['name'] = normalize(properties.get('NAME') or '')
+                record['places'] = [normalize(p) for p in
+                                    re.split(r'[-,]', properties.get('NAME') or '')
+                                    if normalize(p) != '']
+                records.append(record)
+        index = {'source': self.identity, 'records': records}
+        for path in _index_paths(self.shp):
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(index, f)
+                os.replace(path + '.tmp', path)
+                return index
+            except OSError:
+                continue
+        logger.warning('Could not write a lookup index for {}, keeping it in memory'.format(
+            self.shp))
+        return index
+
+
+def index_path(shp):
+    """
+    Location of the lookup index of a shapefile
+
+    Args:
+        shp (str): path to the boundary shapefile
+
+    Returns:
+        (str): path to the index
+    """
+    return os.path.splitext(shp)[0] + '.lookup.json'
+
+
+def _index_paths(shp):
+    """
+    Helper function ('private') to list the places the lookup index of a
+        shapefile can be: next to it, then in the lookup index directory
+    """
+    fallback = os.path.join(constants.LOOKUP_INDEX_DIR, '{}_{}.lookup.json'.format(
+        os.path.splitext(os.path.basename(shp))[0],
+        utils.hash_key(os.path.abspath(shp))))
+    return [index_path(shp), fallback]
+
+
+def normalize(name):
+    """
+    Normalize a place name for matching: lower case, with punctuation
+        replaced by spaces and runs of spaces collapsed
+
+    Args:
+        name (str): place name
+
+    Returns:
+        (str): normalized name
+    """
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', str(name).lower()).split())
+
+
+def boundary_index(shp):
+    """
+    Lookup index of a shapefile, loaded once per session and reloaded if the
+        shapefile changes
+
+    Args:
+        shp (str): path to the boundary shapefile
+
+    Returns:
+        (BoundaryIndex): the index
+    """
+    key = os.path.abspath(shp)
+    index = _indexes.get(key)
+    if index is None or index.identity != utils.file_identity(shp):
+        index = BoundaryIndex(shp)
+        _indexes[key] = index
+    return index
+
+
+def read_matching(shp, query, state_fips=None):
+    """
+    Read the boundary features that best match a name or code
+
+    Args:
+        shp (str): path to the boundary shapefile
+        query (str): name or code to search for
+        state_fips (str): only match features in this state, defaults to
+            None
+
+    Returns:
+        (gpd.GeoDataFrame): matching features
+    """
+    index = boundary_index(shp)
+    fids = index.find(query, state_fips)
+    if len(fids) == 0:
+        raise ValueError('No features of {} match {}'.format(
+            os.path.basename(shp), query))
+    return index.read(fids)
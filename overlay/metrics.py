@@ -0,0 +1,532 @@
+"""
+Stage timings and counters of overlay runs
+
+A `Report` records what one run of the analysis did: a timing span for
+    every stage, with the stages run inside another nested under it (e.g.
+    'prep_data/flood'), and counters of features, bytes read and written,
+    cache hits and misses and rendered tiles, attributed to the innermost
+    stage they were counted in, plus gauges such as the number of tiles and
+    partitions of the study area. Each `Overlay` records into the report
+    that is active when it is created, or a report of its own.
+
+Stages are timed with the `timed` decorator or the `span` context manager,
+    and counted with `count` and `gauge`, from anywhere in the package. They
+    record into the report passed to them, or else the report of the stage
+    running on the same thread, and do nothing when there is none, so
+    instrumented functions work the same outside of a run. Runs on other
+    threads never record into each other's reports: stages that run in
+    worker threads are nested under the stage that started them only if the
+    worker is wrapped with `bind`.
+
+Progress messages are logged to the 'overlay' logger. Each message that
+    the logger lets through is kept in the report of the stage that logged
+    it. The package does not print anything by itself: notebooks and command
+    line tools call `show_progress` to print the messages as `>> ` lines.
+
+Reports export to JSON and to the Prometheus text exposition format, e.g.
+    for a node exporter textfile collector, so runs can be compared across
+    many production runs. A profiler hook, e.g. `cprofile_hook`, runs each
+    top-level stage of a report under a profiler.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import logging
+import cProfile
+import datetime
+import functools
+import threading
+import contextlib
+
+# counters recorded by the package, with their descriptions
+COUNTERS = {'features_read': 'Vector features read from input layers',
+            'features_scored': 'Health facilities scored with the overlay',
+            'bytes_read': 'Bytes read from remote archives and input rasters',
+            'bytes_written': 'Bytes written to caches and tile directories',
+            'cache_hits': 'Lookups answered by an input, layer or tile cache',
+            'cache_misses': 'Lookups that missed an input, layer or tile cache',
+            'tiles_rendered': 'Map tiles rendered to PNG'}
+
+# gauges recorded by the package, with their descriptions
+GAUGES = {'tiles': 'Zoom 12 tiles the study area touches',
+          'partitions': 'Spark partitions of the layers of the study area'}
+
+# logger of the package's progress messages, the parent of every module's
+#   logger
+logger = logging.getLogger('overlay')
+
+_profiler = None
+_local = threading.local()
+_progress = None
+
+
+class Report(object):
+    """
+    Timings and counters of one run
+
+    Attributes:
+        name (str): run name, e.g. the overlay id
+        run_id (str): unique id of the run
+        labels (dict): labels added to every exported metric
+        started (str): UTC start time of the run, ISO 8601
+        spans ([dict]): finished spans in the order they finished, with the
+            'stage' path, the 'start' offset in seconds from the start of
+            the run, 'seconds', the 'thread' the span ran on, its own
+            'counters', and the 'error' it raised, if any
+        counters (dict): totals of every counter
+        gauges (dict): last value of every gauge
+        messages ([dict]): messages logged during the run, with the 'time'
+            offset in seconds from the start of the run, the 'stage' they
+            were logged in, their 'level' and the 'message'
+        profiler (function): hook that takes the report and the path of a
+            top-level stage and returns a context manager to run the stage
+            in, or None
+    """
+
+    def __init__(self, name, labels=None, profiler=None):
+        """
+        Start a report
+
+        Args:
+            name (str): run name
+            labels (dict): labels added to every exported metric, defaults
+                to None
+            profiler (function): profiler hook, defaults to the hook set
+                with `set_profiler`
+        """
+        self.name = name
+        self.run_id = uuid.uuid4().hex
+        self.labels = dict(labels or {})
+        self.started = datetime.datetime.utcnow().isoformat() + 'Z'
+        self.spans = []
+        self.counters = {}
+        self.gauges = {}
+        self.messages = []
+        self.profiler = profiler or _profiler
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """
+        Time a stage. Counts made on this thread while it runs are
+            attributed to it.
+
+        Args:
+            stage (str): stage name, nested under the running stage of this
+                report on the same thread
+
+        Yields:
+            (dict): the span's record
+        """
+        stack = _stack()
+        parent = next((s for s in reversed(stack) if s[0] is self), None)
+        path = stage if parent is None else '{}/{}'.format(parent[1], stage)
+        record = {'stage': path,
+                  'start': time.perf_counter() - self._start,
+                  'thread': threading.current_thread().name,
+                  'counters': {}}
+        profile = (self.profiler(self, path)
+                   if self.profiler is not None and parent is None
+                   else contextlib.ExitStack())
+        stack.append((self, path, record))
+        start = time.perf_counter()
+        try:
+            with profile:
+                yield record
+        except Exception as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self.spans.append(record)
+
+    def count(self, name, value=1):
+        """
+        Add to a counter, and to the counter of the running stage of this
+            report on the same thread
+
+        Args:
+            name (str): counter name, e.g. one of `COUNTERS`
+            value (number): amount to add, defaults to 1
+        """
+        stack = _stack()
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            for report, _, record in reversed(stack):
+                if report is self:
+                    counters = record['counters']
+                    counters[name] = counters.get(name, 0) + value
+                    break
+
+    def gauge(self, name, value):
+        """
+        Set a gauge
+
+        Args:
+            name (str): gauge name, e.g. one of `GAUGES`
+            value (number): the value
+        """
+        with self._lock:
+            self.gauges[name] = value
+
+    def log(self, level, message):
+        """
+        Keep a message logged during the run, in the running stage of this
+            report on the same thread
+
+        Args:
+            level (str): level name, e.g. 'INFO'
+            message (str): the message
+        """
+        stage = next((path for report, path, _ in reversed(_stack())
+                      if report is self), None)
+        with self._lock:
+            self.messages.append({'time': time.perf_counter() - self._start,
+                                  'stage': stage,
+                                  'level': level,
+                                  'message': message})
+
+    def stages(self):
+        """
+        Sum the spans of every stage
+
+        Returns:
+            (dict): stage path to its number of 'calls', 'errors', total
+                'seconds' and 'counters', in the order the stages started
+        """
+        stages = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s['start'])
+        for span in spans:
+            stage = stages.setdefault(span['stage'], {'calls': 0, 'errors': 0,
+                                                      'seconds': 0.0, 'counters': {}})
+            stage['calls'] += 1
+            stage['errors'] += int('error' in span)
+            stage['seconds'] += span['seconds']
+            for name, value in span['counters'].items():
+                stage['counters'][name] = stage['counters'].get(name, 0) + value
+        return stages
+
+    def to_dict(self):
+        """
+        Report as plain data
+
+        Returns:
+            (dict): run name, id, labels, start time and seconds since, the
+                counters and gauges, the summed `stages`, every span and
+                every message
+        """
+        stages = self.stages()
+        with self._lock:
+            return {'name': self.name,
+                    'run_id': self.run_id,
+                    'labels': dict(self.labels),
+                    'started': self.started,
+                    'seconds': time.perf_counter() - self._start,
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'stages': stages,
+                    'spans': list(self.spans),
+                    'messages': list(self.messages)}
+
+    def to_json(self, path=None):
+        """
+        Export the report as JSON
+
+        Args:
+            path (str): file to write to, defaults to None
+
+        Returns:
+            (str): the JSON
+        """
+        text = json.dumps(self.to_dict(), indent=2, default=str)
+        if path is not None:
+            _write(path, text)
+        return text
+
+    def to_prometheus(self, path=None, prefix='overlay'):
+        """
+        Export the report in the Prometheus text exposition format: the
+            seconds, calls and errors of every stage, every counter by
+            stage, and every gauge, labeled with the run name and id and
+            `labels`
+
+        Args:
+            path (str): file to write to, e.g. in the directory of a node
+                exporter textfile collector, defaults to None
+            prefix (str): prefix of the metric names, defaults to 'overlay'
+
+        Returns:
+            (str): the metrics
+        """
+        stages = self.stages()
+        data = self.to_dict()
+        labels = dict(self.labels, run=self.name, run_id=self.run_id)
+        lines = []
+
+        def _metric(name, kind, description, samples):
+            name = _metric_name('{}_{}'.format(prefix, name))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for sample_labels, value in samples:
+                lines.append('{}{{{}}} {}'.format(
+                    name, _labels(dict(labels, **sample_labels)), repr(float(value))))
+
+        for field, description in (('seconds', 'Wall time of a stage, over all of its calls'),
+                                   ('calls', 'Number of times a stage ran'),
+                                   ('errors', 'Number of times a stage raised')):
+            _metric('stage_' + field, 'gauge', description,
+                    [({'stage': stage}, values[field]) for stage, values in stages.items()])
+        _metric('run_seconds', 'gauge', 'Wall time of the run so far',
+                [({}, data['seconds'])])
+        for name in sorted(data['counters']):
+            samples = [({'stage': stage}, values['counters'][name])
+                       for stage, values in stages.items() if name in values['counters']]
+            # counts made outside of any stage of this report
+            outside = data['counters'][name] - sum(value for _, value in samples)
+            if outside:
+                samples.append(({'stage': ''}, outside))
+            _metric(name + '_total', 'counter', COUNTERS.get(name, name), samples)
+        for name in sorted(data['gauges']):
+            _metric(name, 'gauge', GAUGES.get(name, name), [({}, data['gauges'][name])])
+
+        text = '\n'.join(lines) + '\n'
+        if path is not None:
+            _write(path, text)
+        return text
+
+
+def active():
+    """
+    Report of the stage that is running on this thread
+
+    Returns:
+        (Report): the report, or None if no stage is running on this thread
+    """
+    stack = _stack()
+    if stack:
+        return stack[-1][0]
+    return None
+
+
+def span(stage, report=None):
+    """
+    Time a stage in a report, if there is one
+
+    Args:
+        stage (str): stage name
+        report (Report): report to record into, defaults to the `active`
+            report
+
+    Returns:
+        (context manager): the span, or a context manager that does nothing
+    """
+    report = report or active()
+    if report is None:
+        return contextlib.ExitStack()
+    return report.span(stage)
+
+
+def timed(stage):
+    """
+    Decorator that runs a function as a stage of the `active` report, or of
+        the report of the first argument that has one (e.g. an `Overlay`
+        and its methods), or of a new report named after the stage
+
+    Args:
+        stage (str): stage name
+
+    Returns:
+        (function): the decorator
+    """
+    def _decorator(function):
+        @functools.wraps(function)
+        def _timed(*args, **kwargs):
+            report = active()
+            if report is None:
+                report = next((a.report for a in list(args) + list(kwargs.values())
+                               if isinstance(getattr(a, 'report', None), Report)),
+                              None) or Report(stage)
+            with report.span(stage):
+                return function(*args, **kwargs)
+        return _timed
+    return _decorator
+
+
+def bind(function):
+    """
+    Wrap a function to run on another thread as part of the stage that is
+        running on this one, so its spans are nested under that stage and
+        its counts attributed to it
+
+    Args:
+        function (function): function to run on a worker thread
+
+    Returns:
+        (function): the wrapped function
+    """
+    parent = list(_stack())
+
+    @functools.wraps(function)
+    def _bound(*args, **kwargs):
+        stack = _stack()
+        saved = list(stack)
+        stack[:] = parent
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack[:] = saved
+    return _bound
+
+
+def count(name, value=1, report=None):
+    """
+    Add to a counter of a report, if there is one
+
+    Args:
+        name (str): counter name, e.g. one of `COUNTERS`
+        value (number): amount to add, defaults to 1
+        report (Report): report to record into, defaults to the `active`
+            report
+    """
+    report = report or active()
+    if report is not None:
+        report.count(name, value)
+
+
+def gauge(name, value, report=None):
+    """
+    Set a gauge of a report, if there is one
+
+    Args:
+        name (str): gauge name, e.g. one of `GAUGES`
+        value (number): the value
+        report (Report): report to record into, defaults to the `active`
+            report
+    """
+    report = report or active()
+    if report is not None:
+        report.gauge(name, value)
+
+
+class ReportHandler(logging.Handler):
+    """
+    Logging handler that keeps each message in the report of the stage
+        running on the thread that logged it
+    """
+
+    def emit(self, record):
+        report = active()
+        if report is not None:
+            report.log(record.levelname, record.getMessage())
+
+
+def show_progress(stream=sys.stdout):
+    """
+    Print the package's progress messages as `>> ` lines, e.g. in a
+        notebook, and let them through the 'overlay' logger so reports keep
+        them too. Calling it again replaces the stream.
+
+    Args:
+        stream (file): stream to print to, or None to stop printing them
+    """
+    global _progress
+    if _progress is not None:
+        logger.removeHandler(_progress)
+        _progress = None
+    if stream is not None:
+        logger.setLevel(logging.INFO)
+        _progress = logging.StreamHandler(stream)
+        _progress.setFormatter(logging.Formatter('>> %(message)s'))
+        logger.addHandler(_progress)
+
+
+def set_profiler(hook):
+    """
+    Set the profiler hook of the reports created from now on
+
+    Args:
+        hook (function): takes a report and the path of a top-level stage
+            and returns a context manager to run the stage in, e.g.
+            `cprofile_hook(directory)`, or None to stop profiling
+    """
+    global _profiler
+    _profiler = hook
+
+
+def cprofile_hook(directory):
+    """
+    Profiler hook that runs each top-level stage under cProfile and writes
+        its statistics to `<run id>_<stage>.prof` in a directory, to read
+        with `pstats` or snakeviz. cProfile only sees the thread the stage
+        started on.
+
+    Args:
+        directory (str): output directory
+
+    Returns:
+        (function): the hook
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    @contextlib.contextmanager
+    def _profile(report, stage):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(directory, '{}_{}.prof'.format(
+                report.run_id, stage.replace('/', '.'))))
+    return _profile
+
+
+def _stack():
+    """
+    Helper function ('private') to get the running spans of this thread, as
+        (report, stage path, record) tuples
+    """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _metric_name(name):
+    """
+    Helper function ('private') to make a valid Prometheus metric name
+    """
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+
+
+def _labels(labels):
+    """
+    Helper function ('private') to format Prometheus labels, escaping their
+        values
+    """
+    return ','.join('{}="{}"'.format(
+        _metric_name(key),
+        str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in sorted(labels.items()))
+
+
+def _write(path, text):
+    """
+    Helper function ('private') to replace a file in one step, so collectors
+        never read a partial export
+    """
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+logger.addHandler(logging.NullHandler())
+logger.addHandler(ReportHandler())
@@ -0,0 +1,115 @@
+"""
+One spatial partitioner per study area for the tiles of every layer
+
+PySpark only joins two pair RDDs without a shuffle when both are partitioned
+    by the same partitioner into the same number of partitions. Each overlay
+    owns one `SpatialPartitioner`, sized from the number of tiles its study
+    area touches, and every layer's tiles are moved to it once. Grouping
+    tiles of several layers by key is then a narrow operation.
+"""
+
+import functools
+import math
+
+from pyspark.rdd import portable_hash
+
+from overlay import constants
+
+
+class SpatialPartitioner(object):
+    """
+    Partition function that assigns runs of tiles along a Z-order curve to
+        the same partition, so partitions hold compact blocks of tiles and
+        are of equal size. Keys outside the study area are hashed.
+
+    Attributes:
+        num_partitions (int): number of partitions
+    """
+
+    def __init__(self, keys, tiles_per_partition=constants.TILES_PER_PARTITION):
+        """
+        Build the partitioner of a study area
+
+        Args:
+            keys ([(int, int)]): layout columns and rows of the tiles the
+                study area touches
+            tiles_per_partition (int): number of tiles in each partition
+        """
+        keys = sorted(set(keys), key=lambda key: _z_order(*key))
+        self.num_partitions = partition_count(len(keys), tiles_per_partition)
+        self._partitions = {key: i * self.num_partitions // len(keys)
+                            for i, key in enumerate(keys)}
+
+    def __call__(self, key):
+        partition = self._partitions.get((key[0], key[1]))
+        if partition is None:
+            return portable_hash((key[0], key[1]))
+        return partition
+
+    def __eq__(self, other):
+        return (isinstance(other, SpatialPartitioner) and
+                self.num_partitions == other.num_partitions and
+                self._partitions == other._partitions)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.num_partitions, len(self._partitions)))
+
+    def partition(self, rdd):
+        """
+        Move the tiles of an RDD to this partitioner. RDDs that are already
+            partitioned by it are returned as is.
+
+        Args:
+            rdd (pyspark.RDD): (SpatialKey, value) pairs
+
+        Returns:
+            (pyspark.RDD): the partitioned pairs
+        """
+        return rdd.partitionBy(self.num_partitions, self)
+
+    def cogroup(self, rdds):
+        """
+        Group the values of several RDDs by key. Only RDDs that are not
+            partitioned by this partitioner yet are shuffled.
+
+        Args:
+            rdds ([pyspark.RDD]): (SpatialKey, value) pairs
+
+        Returns:
+            (pyspark.RDD): (SpatialKey, [(int, value)]) with the position in
+                `rdds` of the RDD each value came from
+        """
+        tagged = [self.partition(rdd).mapValues(lambda value, i=i: (i, value))
+                  for i, rdd in enumerate(rdds)]
+        # unions of RDDs with the same partitioner keep it
+        union = functools.reduce(lambda a, b: a.union(b), tagged)
+        return union.groupByKey(self.num_partitions, self)
+
+
+def partition_count(num_tiles, tiles_per_partition=constants.TILES_PER_PARTITION):
+    """
+    Number of partitions for a study area
+
+    Args:
+        num_tiles (int): number of tiles the study area touches
+        tiles_per_partition (int): number of tiles in each partition
+
+    Returns:
+        (int): number of partitions, at least 1
+    """
+    return max(1, int(math.ceil(num_tiles / float(tiles_per_partition))))
+
+
+def _z_order(col, row):
+    """
+    Helper function ('private') to interleave the bits of a tile's column
+        and row into its position on a Z-order curve
+    """
+    code = 0
+    for bit in range(16):
+        code |= ((col >> bit) & 1) << (2 * bit)
+        code |= ((row >> bit) & 1) << (2 * bit + 1)
+    return code
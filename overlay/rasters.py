@@ -0,0 +1,210 @@
+"""
+Read study area windows of national rasters directly into raster layers
+"""
+
+import os
+import math
+import logging
+import contextlib
+import numpy as np
+import rasterio
+import geopyspark as gps
+
+from pyspark import SparkContext
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from shapely.geometry import box
+from shapely.prepared import prep
+
+from overlay import constants, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def cog_path(national_tif):
+    """
+    Location of the tiled, overviewed copy of a national raster
+
+    Args:
+        national_tif (str): path to national GeoTIFF
+
+    Returns:
+        (str): path to the tiled copy
+    """
+    return os.path.splitext(national_tif)[0] + '_cog.tif'
+
+
+def has_cog(national_tif):
+    """
+    Check whether an up-to-date tiled copy of a national raster exists
+
+    Args:
+        national_tif (str): path to national GeoTIFF
+
+    Returns:
+        (bool): True if the tiled copy is newer than the national raster
+    """
+    output = cog_path(national_tif)
+    return (os.path.isfile(output) and
+            os.path.getmtime(output) >= os.path.getmtime(national_tif))
+
+
+def build_cog(national_tif, block_size=256, overview_levels=(2, 4, 8, 16, 32),
+              overwrite=False):
+    """
+    Write a Cloud Optimized GeoTIFF style copy of a national raster:
+        internally tiled, compressed and with overviews, so window reads only
+        touch the blocks that cover the window
+
+    Args:
+        national_tif (str): path to national GeoTIFF
+        block_size (int): width and height of internal tiles
+        overview_levels ((int)): decimation factors of the overviews
+        overwrite (bool): rebuild the copy even if it is up to date
+
+    Returns:
+        (str): path to the tiled copy
+    """
+    output = cog_path(national_tif)
+    if has_cog(national_tif) and not overwrite:
+        logger.info('Tiled copy of {} already exists'.format(
+            os.path.basename(national_tif)))
+        return output
+
+    logger.info('Writing tiled copy of {}...'.format(
+        os.path.basename(national_tif)))
+    tmp = output + '.tmp'
+    with rasterio.open(national_tif) as src:
+        profile = src.profile.copy()
+        profile.update(driver='GTiff',
+                       tiled=True,
+                       blockxsize=block_size,
+                       blockysize=block_size,
+                       compress='deflate',
+                       BIGTIFF='IF_SAFER')
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            for _, window in dst.block_windows(1):
+                dst.write(src.read(window=window), window=window)
+            dst.build_overviews(list(overview_levels), Resampling.nearest)
+            dst.update_tags(ns='rio_overview', resampling='nearest')
+    os.replace(tmp, output)
+    return output
+
+
+def build_storm_surge_cogs(overwrite=False):
+    """
+    Write tiled copies of all national storm surge rasters in `constants`
+
+    Args:
+        overwrite (bool): rebuild copies even if they are up to date
+
+    Returns:
+        ([str]): paths to the tiled copies
+    """
+    return [build_cog(t, overwrite=overwrite) for t in constants.NATL_STORM_SURGE]
+
+
+def read_window(tif, bbox_wgs, max_tile_size=128, num_partitions=None, within=None):
+    """
+    Read the window of a raster that covers a study area bounding box into
+        a raster layer, without writing an intermediate file
+
+    Args:
+        tif (str): path to GeoTIFF
+        bbox_wgs ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        max_tile_size (int): maximum width and height of the tiles the
+            window is split into
+        num_partitions (int): number of partitions of the layer, defaults to
+            Spark's default parallelism
+        within (shapely.geometry): if given, only the tiles that overlap
+            this area, in EPSG:4326, are read, defaults to None
+
+    Returns:
+        (gps.RasterLayer): the window as an untiled raster layer, or None if
+            the window does not overlap the raster
+    """
+    return read_window_stack([tif], bbox_wgs, max_tile_size, num_partitions, within)
+
+
+def read_window_stack(tifs, bbox_wgs, max_tile_size=128, num_partitions=None,
+                      within=None):
+    """
+    Read the windows of rasters on the same grid that cover a study area
+        bounding box into one raster layer, with the first band of each
+        raster as a band of the layer. Only the chunks of the window are
+        planned on the driver; the executors read the cells, so the rasters
+        must be readable at the same paths on every executor.
+
+    Args:
+        tifs ([str]): paths to GeoTIFFs with the same crs, transform, size
+            and no data value
+        bbox_wgs ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        max_tile_size (int): maximum width and height of the tiles the
+            window is split into. Tiles start at multiples of it, so they
+            fall within the internal blocks written by `build_cog`.
+        num_partitions (int): number of partitions of the layer, defaults to
+            Spark's default parallelism
+        within (shapely.geometry): if given, only the tiles that overlap
+            this area, in EPSG:4326, are read, defaults to None
+
+    Returns:
+        (gps.RasterLayer): the windows as an untiled multiband raster layer,
+            or None if the window does not overlap the rasters
+    """
+    srcs = [rasterio.open(t) for t in tifs]
+    try:
+        src = srcs[0]
+        for other in srcs[1:]:
+            if (other.crs != src.crs or other.transform != src.transform or
+                    other.shape != src.shape or other.nodata != src.nodata):
+                raise ValueError('{} is not on the same grid as {}'.format(
+                    other.name, src.name))
+
+        left, bottom, right, top = transform_bounds(
+            'EPSG:4326', src.crs, *bbox_wgs)
+        row_start, col_start = src.index(left, top)
+        row_stop, col_stop = src.index(right, bottom, op=math.ceil)
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        row_stop = min(row_stop, src.height)
+        col_stop = min(col_stop, src.width)
+        row_start -= row_start % max_tile_size
+        col_start -= col_start % max_tile_size
+
+        chunks = []
+        epsg = src.crs.to_epsg()
+        no_data = src.nodata
+        item_size = np.dtype(src.dtypes[0]).itemsize
+        area = None if within is None else prep(within)
+        for row in range(row_start, row_stop, max_tile_size):
+            for col in range(col_start, col_stop, max_tile_size):
+                chunk = Window(col, row,
+                               min(max_tile_size, col_stop - col),
+                               min(max_tile_size, row_stop - row))
+                bounds = src.window_bounds(chunk)
+                if area is not None and not area.intersects(
+                        box(*transform_bounds(src.crs, 'EPSG:4326', *bounds))):
+                    continue
+                chunks.append((col, row, chunk.width, chunk.height, bounds))
+    finally:
+        for s in srcs:
+            s.close()
+
+    if len(chunks) == 0:
+        return None
+    metrics.count('bytes_read', sum(width * height for _, _, width, height, _
+                                    in chunks) * item_size * len(tifs))
+
+    def _read_chunks(descriptors):
+        with contextlib.ExitStack() as stack:
+            opened = [stack.enter_context(rasterio.open(t)) for t in tifs]
+            for col, row, width, height, bounds in descriptors:
+                window = Window(col, row, width, height)
+                cells = np.stack([s.read(1, window=window) for s in opened])
+                yield (gps.ProjectedExtent(gps.Extent(*bounds), epsg=epsg),
+                       gps.Tile.from_numpy_array(cells, no_data))
+
+    rdd = (SparkContext.getOrCreate()
+           .parallelize(chunks, num_partitions)
+           .mapPartitions(_read_chunks))
+    return gps.RasterLayer.from_numpy_rdd(gps.LayerType.SPATIAL, rdd)
@@ -0,0 +1,196 @@
+"""
+Sample overlay layers at large numbers of points
+
+Points are grouped by the layout key of the tile they fall in, so every
+    tile is read once and its values are gathered for all of its points with
+    one NumPy fancy index. On the Spark backend the groups are broadcast to
+    the executors and only the sampled values come back to the driver. The
+    tiles of a sparse layer are filtered by key before anything else, and
+    sampled without expanding compressed tiles. A layer and a zone layer
+    on the same partitioner are sampled together from their tiles grouped by
+    key.
+"""
+
+import numpy as np
+
+from pyspark import SparkContext
+
+from overlay import kernels, sparse
+from overlay.local import LocalLayer
+
+
+def sample(layer, points, fill=np.nan):
+    """
+    Get the cell values of a layer at many points
+
+    Args:
+        layer (gps.TiledRasterLayer, sparse.SparseTiledLayer or
+            local.LocalLayer): layer to sample
+        points (gpd.GeoDataFrame, gpd.GeoSeries or [shapely.geometry.Point]):
+            points in EPSG:3857
+        fill (float): value for points on no data cells or outside the
+            layer, defaults to nan
+
+    Returns:
+        (np.ndarray): float64 values aligned with the points
+    """
+    xs, ys = _coordinates(points)
+    if isinstance(layer, LocalLayer):
+        values = _sample_local(layer, xs, ys)
+    else:
+        values = _sample_tiled([layer], xs, ys)[0]
+    values[np.isnan(values)] = fill
+    return values
+
+
+def sample_zones(layer, zones, points, partitioner=None, fill=np.nan):
+    """
+    Get the cell values of a layer and the zones of many points in one
+        pass, e.g. to score the facilities of many study areas at once
+
+    Args:
+        layer (sparse.SparseTiledLayer or local.LocalLayer): layer to sample
+        zones (sparse.SparseTiledLayer or local.LocalLayer): zone layer on
+            the same layout, as built by `layers.zones` or `local.zones`
+        points (gpd.GeoDataFrame, gpd.GeoSeries or [shapely.geometry.Point]):
+            points in EPSG:3857
+        partitioner (partitioning.SpatialPartitioner): partitioner of the
+            tiles of both tiled layers, which groups them by key without a
+            shuffle, defaults to None
+        fill (float): value for points on no data cells or outside the
+            layer, defaults to nan
+
+    Returns:
+        (np.ndarray, np.ndarray): float64 values aligned with the points,
+            and the int64 zone of each point, 0 outside every zone
+    """
+    xs, ys = _coordinates(points)
+    if isinstance(layer, LocalLayer):
+        values, zone_values = _sample_local(layer, xs, ys), _sample_local(zones, xs, ys)
+    else:
+        values, zone_values = _sample_tiled([layer, zones], xs, ys, partitioner)
+    values[np.isnan(values)] = fill
+    zone_values[np.isnan(zone_values)] = 0
+    return values, zone_values.astype(np.int64)
+
+
+def _coordinates(points):
+    """
+    Helper function ('private') to get the x and y coordinates of points
+    """
+    if hasattr(points, 'geometry'):
+        return np.asarray(points.geometry.x), np.asarray(points.geometry.y)
+    return (np.array([p.x for p in points], dtype=np.float64),
+            np.array([p.y for p in points], dtype=np.float64))
+
+
+def group_by_tile(xs, ys, extent, layout_cols, layout_rows, tile_cols, tile_rows):
+    """
+    Find the tile and the cell within it of every point, grouped by tile
+
+    Args:
+        xs (np.ndarray): point x coordinates
+        ys (np.ndarray): point y coordinates
+        extent ([float]): xmin, ymin, xmax, ymax of the layout
+        layout_cols (int): tile columns of the layout
+        layout_rows (int): tile rows of the layout
+        tile_cols (int): cell columns of a tile
+        tile_rows (int): cell rows of a tile
+
+    Returns:
+        (dict): (col, row) of each tile with points to a tuple of the
+            indexes of its points and their cell rows and columns in it.
+            Points outside the layout are left out.
+    """
+    cell_width = (extent[2] - extent[0]) / (layout_cols * tile_cols)
+    cell_height = (extent[3] - extent[1]) / (layout_rows * tile_rows)
+    cols = np.floor((xs - extent[0]) / cell_width).astype(np.int64)
+    rows = np.floor((extent[3] - ys) / cell_height).astype(np.int64)
+    inside = ((cols >= 0) & (cols < layout_cols * tile_cols) &
+              (rows >= 0) & (rows < layout_rows * tile_rows))
+
+    index = np.nonzero(inside)[0]
+    key_cols, cell_cols = np.divmod(cols[index], tile_cols)
+    key_rows, cell_rows = np.divmod(rows[index], tile_rows)
+
+    codes, inverse = np.unique(key_rows * layout_cols + key_cols,
+                               return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse))[:-1]
+    groups = {}
+    for code, members in zip(codes, np.split(order, bounds)):
+        key_row, key_col = divmod(int(code), layout_cols)
+        groups[(key_col, key_row)] = (index[members],
+                                      cell_rows[members],
+                                      cell_cols[members])
+    return groups
+
+
+def _sample_local(layer, xs, ys):
+    """
+    Helper function ('private') to sample an in-memory layer
+    """
+    grid = layer.grid
+    values = np.full(len(xs), np.nan)
+    groups = group_by_tile(xs, ys, grid.extent, grid.cols, grid.rows,
+                           grid.tile_size, grid.tile_size)
+    for (col, row), (index, cell_rows, cell_cols) in groups.items():
+        tile = layer.cells[grid.tile_slice(grid.col_min + col, grid.row_min + row)]
+        sampled = tile[cell_rows, cell_cols]
+        values[index] = np.where(sampled == kernels.NODATA, np.nan, sampled)
+    return values
+
+
+def _sample_tiled(layers, xs, ys, partitioner=None):
+    """
+    Helper function ('private') to sample GeoPySpark or sparse tiled layers
+        on the same layout, reading each tile with points once on the
+        executors. The tiles of several layers are grouped by key with
+        their partitioner.
+    """
+    layout = layers[0].layer_metadata.layout_definition
+    extent, tile_layout = layout.extent, layout.tileLayout
+    groups = group_by_tile(xs, ys,
+                           [extent.xmin, extent.ymin, extent.xmax, extent.ymax],
+                           tile_layout.layoutCols, tile_layout.layoutRows,
+                           tile_layout.tileCols, tile_layout.tileRows)
+    values = np.full((len(layers), len(xs)), np.nan)
+    if len(groups) == 0:
+        return values
+
+    lookup = SparkContext.getOrCreate().broadcast(groups)
+    tile_shape = (tile_layout.tileRows, tile_layout.tileCols)
+
+    def _read(tile, cell_rows, cell_cols):
+        if isinstance(tile, np.ndarray):
+            # int32 cells of a sparse layer, read through a view of the full
+            #   tile if they are compressed
+            cells = np.broadcast_to(tile, tile_shape)[cell_rows, cell_cols]
+            no_data_value = kernels.NODATA
+        else:
+            cells = tile.cells[0][cell_rows, cell_cols]
+            no_data_value = tile.no_data_value
+        sampled = cells.astype(np.float64)
+        if no_data_value is not None:
+            sampled[cells == no_data_value] = np.nan
+        return sampled
+
+    def _gather(key_tiles):
+        key, tiles = key_tiles
+        index, cell_rows, cell_cols = lookup.value[(key.col, key.row)]
+        return index, [(i, _read(tile, cell_rows, cell_cols)) for i, tile in tiles]
+
+    inputs = [(layer.tiles if isinstance(layer, sparse.SparseTiledLayer)
+               else layer.to_numpy_rdd())
+              .filter(lambda key_tile: (key_tile[0].col, key_tile[0].row) in lookup.value)
+              for layer in layers]
+    if len(inputs) == 1:
+        grouped = inputs[0].mapValues(lambda tile: [(0, tile)])
+    else:
+        grouped = partitioner.cogroup(inputs)
+    gathered = grouped.map(_gather).collect()
+    lookup.unpersist()
+    for index, sampled in gathered:
+        for i, cells in sampled:
+            values[i, index] = cells
+    return values
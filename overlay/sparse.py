@@ -0,0 +1,214 @@
+"""
+Tiled layers that store uniform tiles as a single value
+
+Most zoom 12 tiles of a hazard layer are uniform: all 1 (no hazard) inside
+    the study area, or all no data outside it. A `SparseTiledLayer` holds
+    its tiles as int32 cells in the `kernels.NODATA` convention, with every
+    uniform tile compressed to a 1 x 1 array. NumPy broadcasting combines
+    compressed tiles with each other and with full tiles, so the map algebra
+    in `overlay.kernels` and `overlay.expression` works on them unchanged and
+    a result stays compressed wherever all of its inputs were. Tiles are only
+    expanded to full GeoPySpark tiles when the layer is written, displayed or
+    read by a GeoPySpark operation.
+"""
+
+import numpy as np
+import geopyspark as gps
+
+from overlay import kernels
+
+# shape of a compressed tile
+CONSTANT_SHAPE = (1, 1)
+
+# cell type of layers computed from several others, e.g. weighted sums: the
+#   int32 cells of a sparse layer with `kernels.NODATA` as no data
+RESULT_CELL_TYPE = 'int32'
+
+# data types of GeoTrellis cell types
+CELL_DTYPES = {'bool': np.uint8,
+               'int8': np.int8,
+               'uint8': np.uint8,
+               'int16': np.int16,
+               'uint16': np.uint16,
+               'int32': np.int32,
+               'float32': np.float32,
+               'float64': np.float64}
+
+
+def compress(cells):
+    """
+    Compress a tile to a 1 x 1 array if all of its cells are equal
+
+    Args:
+        cells (np.ndarray): 2D int32 cells, full or already compressed
+
+    Returns:
+        (np.ndarray): the cells, or their one value as a 1 x 1 array
+    """
+    if cells.shape == CONSTANT_SHAPE:
+        return cells
+    first = cells.flat[0]
+    if (cells == first).all():
+        return np.full(CONSTANT_SHAPE, first, dtype=np.int32)
+    return cells
+
+
+def expand(cells, shape):
+    """
+    Expand a possibly compressed tile to its full shape
+
+    Args:
+        cells (np.ndarray): int32 cells
+        shape ((int, int)): rows and columns of a full tile
+
+    Returns:
+        (np.ndarray): full int32 cells
+    """
+    if cells.shape == tuple(shape):
+        return cells
+    return np.broadcast_to(cells, shape).copy()
+
+
+def cell_type_no_data(cell_type):
+    """
+    Data type and no data value of a GeoTrellis cell type, e.g. 'int8',
+        'int16raw' or 'int32ud-1'
+
+    Args:
+        cell_type (str): cell type name
+
+    Returns:
+        (np.dtype, number): data type, and no data value or None for raw
+            cell types
+    """
+    name = str(cell_type).lower()
+    for base in sorted(CELL_DTYPES, key=len, reverse=True):
+        if name.startswith(base):
+            dtype = np.dtype(CELL_DTYPES[base])
+            suffix = name[len(base):]
+            break
+    else:
+        raise ValueError('Unknown cell type: {}'.format(cell_type))
+    if suffix == 'raw' or base == 'bool':
+        return dtype, None
+    if suffix.startswith('ud'):
+        return dtype, dtype.type(suffix[2:])
+    if np.issubdtype(dtype, np.floating):
+        return dtype, np.nan
+    # GeoTrellis' constant no data: the minimum of signed types, 0 of unsigned
+    return dtype, np.iinfo(dtype).min
+
+
+def with_cell_type(layer_metadata, cell_type):
+    """
+    Copy layer metadata with another cell type, for a layer whose values
+        don't fit the cell type of the layer it was derived from
+
+    Args:
+        layer_metadata (gps.Metadata): metadata to copy
+        cell_type (str): GeoTrellis cell type name, e.g. 'int32'
+
+    Returns:
+        (gps.Metadata): the metadata
+    """
+    return gps.Metadata(layer_metadata.bounds, layer_metadata.crs, cell_type,
+                        layer_metadata.extent, layer_metadata.layout_definition)
+
+
+def cells_rdd(layer):
+    """
+    Cells of every tile of a layer, compressed
+
+    Args:
+        layer (SparseTiledLayer or gps.TiledRasterLayer): single band layer
+
+    Returns:
+        (pyspark.RDD): (SpatialKey, np.ndarray) of int32 cells
+    """
+    if isinstance(layer, SparseTiledLayer):
+        return layer.tiles
+    return layer.to_numpy_rdd().mapValues(
+        lambda tile: compress(kernels.from_tile(tile.cells[0], tile.no_data_value)))
+
+
+class SparseTiledLayer(object):
+    """
+    Single band tiled layer with uniform tiles stored as one value
+
+    Attributes:
+        tiles (pyspark.RDD): (SpatialKey, np.ndarray) of int32 cells, 1 x 1
+            for uniform tiles
+        layer_metadata (gps.Metadata): metadata of the expanded layer
+        zoom_level (int): zoom level of the layout
+        tile_shape ((int, int)): rows and columns of a full tile
+    """
+
+    def __init__(self, tiles, layer_metadata, zoom_level):
+        self.tiles = tiles
+        self.layer_metadata = layer_metadata
+        self.zoom_level = zoom_level
+        tile_layout = layer_metadata.layout_definition.tileLayout
+        self.tile_shape = (tile_layout.tileRows, tile_layout.tileCols)
+
+    @classmethod
+    def from_layer(cls, tiled_layer):
+        """
+        Compress a GeoPySpark tiled layer
+
+        Args:
+            tiled_layer (gps.TiledRasterLayer): single band layer
+
+        Returns:
+            (SparseTiledLayer): the layer
+        """
+        return cls(cells_rdd(tiled_layer), tiled_layer.layer_metadata,
+                   tiled_layer.zoom_level)
+
+    def to_numpy_rdd(self):
+        """
+        Expand every tile, in the same form as
+            `TiledRasterLayer.to_numpy_rdd`
+
+        Returns:
+            (pyspark.RDD): (SpatialKey, gps.Tile)
+        """
+        shape = self.tile_shape
+        dtype, no_data_value = cell_type_no_data(self.layer_metadata.cell_type)
+
+        def _expand(cells):
+            tile = kernels.to_tile(expand(cells, shape), no_data_value, dtype)
+            return gps.Tile.from_numpy_array(tile[np.newaxis], no_data_value)
+
+        return self.tiles.mapValues(_expand)
+
+    def to_tiled_layer(self):
+        """
+        Expand to a GeoPySpark tiled layer, for writing, display and other
+            GeoPySpark operations
+
+        Returns:
+            (gps.TiledRasterLayer): the layer
+        """
+        return gps.TiledRasterLayer.from_numpy_rdd(gps.LayerType.SPATIAL,
+                                                   self.to_numpy_rdd(),
+                                                   self.layer_metadata,
+                                                   zoom_level=self.zoom_level)
+
+    def pyramid(self):
+        """
+        Pyramid of the expanded layer, for display
+
+        Returns:
+            (gps.Pyramid): the pyramid
+        """
+        return self.to_tiled_layer().pyramid()
+
+    def density(self):
+        """
+        Count the full and compressed tiles
+
+        Returns:
+            (int, int): number of full tiles and of all tiles
+        """
+        full = self.tiles.map(lambda key_cells: int(key_cells[1].shape != CONSTANT_SHAPE))
+        return full.sum(), self.tiles.count()
@@ -0,0 +1,254 @@
+"""
+Partitioned columnar copies of the national vector inputs
+
+Each national shapefile is ingested once into a directory of parquet files
+    next to it. Features are assigned to the cells of a fixed grid laid over
+    the dataset's extent, every cell is written to its own parquet file with
+    WKB geometries, and a manifest records the bounding box and feature
+    count of each partition. Reads only open the partitions whose bounding
+    boxes overlap the area of interest.
+"""
+
+import os
+import json
+import shutil
+import logging
+import fiona
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from shapely import wkb
+from shapely.geometry import shape
+
+from overlay import constants
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = '_manifest.json'
+
+# fiona field types to arrow types
+FIELD_TYPES = {
+    'int': pa.int64(),
+    'int32': pa.int64(),
+    'int64': pa.int64(),
+    'float': pa.float64(),
+    'str': pa.string(),
+    'date': pa.string(),
+    'time': pa.string(),
+    'datetime': pa.string(),
+    'bool': pa.bool_()
+}
+
+
+def store_path(source):
+    """
+    Location of the partitioned store for a national input
+
+    Args:
+        source (str): path to national shapefile
+
+    Returns:
+        (str): path to the store directory
+    """
+    return os.path.splitext(source)[0] + '.parquet'
+
+
+def has_store(source):
+    """
+    Check whether an up-to-date partitioned store exists for a shapefile
+
+    Args:
+        source (str): path to national shapefile
+
+    Returns:
+        (bool): True if the store was ingested from the current source file
+    """
+    manifest_file = os.path.join(store_path(source), MANIFEST)
+    if not os.path.isfile(manifest_file) or not os.path.isfile(source):
+        return False
+    manifest = _read_manifest(source)
+    return (manifest['source_size'] == os.path.getsize(source) and
+            manifest['source_mtime'] == os.path.getmtime(source))
+
+
+def ingest(source, grid_size=constants.STORE_GRID_SIZE,
+           batch_size=constants.STORE_BATCH_SIZE, overwrite=False):
+    """
+    Convert a national shapefile into a grid-partitioned parquet store.
+        Features are streamed from the source, so memory use is bounded by
+        `batch_size` rows per partition.
+
+    Args:
+        source (str): path to national shapefile
+        grid_size (int): number of grid cells along each axis
+        batch_size (int): rows buffered per partition before a write
+        overwrite (bool): rebuild the store even if it is up to date
+
+    Returns:
+        (str): path to the store directory
+    """
+    output_dir = store_path(source)
+    if has_store(source) and not overwrite:
+        logger.info('Partitioned store already exists for {}'.format(
+            os.path.basename(source)))
+        return output_dir
+
+    logger.info('Ingesting {} into partitioned store...'.format(
+        os.path.basename(source)))
+    tmp_dir = output_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    with fiona.open(source) as src:
+        crs = src.crs
+        crs = crs.to_dict() if hasattr(crs, 'to_dict') else dict(crs)
+        fields = src.schema['properties']
+        schema = pa.schema(
+            [(name, FIELD_TYPES[ftype.split(':')[0]])
+             for name, ftype in fields.items()] +
+            [('fid', pa.int64()), ('xmin', pa.float64()), ('ymin', pa.float64()),
+             ('xmax', pa.float64()), ('ymax', pa.float64()),
+             ('geometry', pa.binary())])
+        xmin, ymin, xmax, ymax = src.bounds
+        cell_w = (xmax - xmin) / grid_size or 1.0
+        cell_h = (ymax - ymin) / grid_size or 1.0
+
+        writers = {}
+        buffers = {}
+        partitions = {}
+
+        def _flush(cell):
+            table = pa.Table.from_pandas(pd.DataFrame(buffers[cell]),
+                                         schema=schema,
+                                         preserve_index=False)
+            if cell not in writers:
+                path = os.path.join(tmp_dir, 'part-{}-{}.parquet'.format(*cell))
+                writers[cell] = pq.ParquetWriter(path, schema)
+            writers[cell].write_table(table)
+            buffers[cell] = []
+
+        for fid, feature in enumerate(src):
+            if feature['geometry'] is None:
+                continue
+            geom = shape(feature['geometry'])
+            bounds = geom.bounds
+            cx = (bounds[0] + bounds[2]) / 2
+            cy = (bounds[1] + bounds[3]) / 2
+            cell = (min(int((cx - xmin) / cell_w), grid_size - 1),
+                    min(int((cy - ymin) / cell_h), grid_size - 1))
+
+            row = dict(feature['properties'])
+            row.update(fid=fid, xmin=bounds[0], ymin=bounds[1],
+                       xmax=bounds[2], ymax=bounds[3], geometry=geom.wkb)
+            buffers.setdefault(cell, []).append(row)
+
+            # keep per-partition bounding box statistics
+            stats = partitions.setdefault(
+                cell, {'bbox': list(bounds), 'count': 0})
+            stats['bbox'] = [min(stats['bbox'][0], bounds[0]),
+                             min(stats['bbox'][1], bounds[1]),
+                             max(stats['bbox'][2], bounds[2]),
+                             max(stats['bbox'][3], bounds[3])]
+            stats['count'] += 1
+
+            if len(buffers[cell]) >= batch_size:
+                _flush(cell)
+
+        for cell in buffers:
+            if len(buffers[cell]) > 0:
+                _flush(cell)
+        for writer in writers.values():
+            writer.close()
+
+    manifest = {
+        'source': source,
+        'source_size': os.path.getsize(source),
+        'source_mtime': os.path.getmtime(source),
+        'crs': crs,
+        'columns': list(fields.keys()),
+        'partitions': [dict(file='part-{}-{}.parquet'.format(*cell), **stats)
+                       for cell, stats in sorted(partitions.items())]
+    }
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.rename(tmp_dir, output_dir)
+    logger.info('Wrote {} partitions to {}'.format(
+        len(partitions), output_dir))
+    return output_dir
+
+
+def ingest_national_inputs(overwrite=False):
+    """
+    Ingest every national vector input listed in `constants`
+
+    Args:
+        overwrite (bool): rebuild stores even if they are up to date
+
+    Returns:
+        ([str]): paths to the store directories
+    """
+    sources = ([constants.NATL_FLOOD_SHP,
+                constants.NATL_MSA_SHP,
+                constants.NATL_COUNTY_SHP] +
+               list(constants.HEALTH_RESOURCE_FILES.values()))
+    return [ingest(s, overwrite=overwrite) for s in sources]
+
+
+def read_bbox(source, bbox, geometry=None):
+    """
+    Read the features of an ingested dataset whose bounding boxes overlap
+        `bbox`, only opening the partitions that overlap it
+
+    Args:
+        source (str): path to national shapefile the store was built from
+        bbox ([float]): xmin, ymin, xmax, ymax in the dataset's crs
+        geometry (shapely.geometry): if given, only keep features that
+            intersect it, defaults to None
+
+    Returns:
+        (gpd.GeoDataFrame): features in the bounding box
+    """
+    manifest = _read_manifest(source)
+    files = [p['file'] for p in manifest['partitions']
+             if _overlaps(p['bbox'], bbox)]
+    frames = []
+    for f in files:
+        df = pq.read_table(os.path.join(store_path(source), f)).to_pandas()
+        frames.append(df[(df.xmin <= bbox[2]) & (df.xmax >= bbox[0]) &
+                         (df.ymin <= bbox[3]) & (df.ymax >= bbox[1])])
+    subset = _to_geodataframe(frames, manifest)
+    if geometry is not None:
+        subset = subset[subset.geometry.intersects(geometry)]
+    return subset
+
+
+def _read_manifest(source):
+    """
+    Helper function ('private') to load a store manifest
+    """
+    with open(os.path.join(store_path(source), MANIFEST)) as f:
+        return json.load(f)
+
+
+def _overlaps(a, b):
+    """
+    Helper function ('private') to test two xmin, ymin, xmax, ymax boxes
+        for overlap
+    """
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+
+def _to_geodataframe(frames, manifest):
+    """
+    Helper function ('private') to turn parquet rows back into features
+    """
+    if len(frames) == 0:
+        return gpd.GeoDataFrame(geometry=[], crs=manifest['crs'])
+    df = pd.concat(frames, ignore_index=True)
+    geometry = [wkb.loads(g) for g in df['geometry']]
+    df = df[manifest['columns']]
+    return gpd.GeoDataFrame(df, geometry=geometry, crs=manifest['crs'])
@@ -0,0 +1,419 @@
+"""
+Generate synthetic overlay inputs, from one study area's worth up to
+    national datasets at any scale, and check the NumPy backend against the
+    Spark backend on them
+"""
+
+import os
+import shutil
+import logging
+import fiona
+import numpy as np
+import geopandas as gpd
+import rasterio
+
+from rasterio.transform import from_origin
+from shapely.affinity import scale
+from shapely.geometry import Point, Polygon, box, mapping
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from overlay import constants, kernels
+
+logger = logging.getLogger(__name__)
+
+# a small stretch of the Texas coast, xmin, ymin, xmax, ymax in EPSG:4326
+DEFAULT_BBOX = [-95.2, 29.2, -94.8, 29.5]
+
+
+def make_study_area(path, bbox=DEFAULT_BBOX):
+    """
+    Write an irregular study area polygon: an ellipse inscribed in a
+        bounding box
+
+    Args:
+        path (str): output shapefile
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+
+    Returns:
+        (str): path to the shapefile
+    """
+    center = Point((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+    poly = scale(center.buffer(1, resolution=32),
+                 xfact=0.45 * (bbox[2] - bbox[0]),
+                 yfact=0.45 * (bbox[3] - bbox[1]))
+    study_area = gpd.GeoDataFrame({'NAME': ['synthetic']},
+                                  geometry=[poly],
+                                  crs={'init': 'epsg:4326'})
+    study_area.to_file(path)
+    return path
+
+
+def make_flood(path, bbox=DEFAULT_BBOX, count=50, seed=0, zone_size=None):
+    """
+    Write randomly placed rectangular flood hazard zones
+
+    Args:
+        path (str): output shapefile
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        count (int): number of zones
+        seed (int): random seed
+        zone_size ((float, float)): smallest and largest width and height
+            of a zone in degrees, defaults to 1% and 5% of the bounding box
+
+    Returns:
+        (str): path to the shapefile
+    """
+    rng = np.random.RandomState(seed)
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    zones = []
+    for _ in range(count):
+        x, y = bbox[0] + rng.rand() * width, bbox[1] + rng.rand() * height
+        if zone_size is None:
+            w, h = rng.uniform(0.01, 0.05) * width, rng.uniform(0.01, 0.05) * height
+        else:
+            w, h = rng.uniform(*zone_size), rng.uniform(*zone_size)
+        zones.append(box(x, y, x + w, y + h))
+    flood = gpd.GeoDataFrame({'FLD_ZONE': ['AE'] * count},
+                             geometry=zones,
+                             crs={'init': 'epsg:4326'})
+    flood.to_file(path)
+    return path
+
+
+def make_storm_surge(path, bbox=DEFAULT_BBOX, cell_size=0.0005, seed=0,
+                     max_depth=25):
+    """
+    Write a storm surge raster with inundation values that rise towards the
+        southern edge, and no data inland
+
+    Args:
+        path (str): output GeoTIFF
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        cell_size (float): cell size in degrees
+        seed (int): random seed
+        max_depth (int): inundation at the southern edge, at most 25,
+            defaults to 25
+
+    Returns:
+        (str): path to the GeoTIFF
+    """
+    rng = np.random.RandomState(seed)
+    pad = 0.05
+    cols = int(np.ceil((bbox[2] - bbox[0] + 2 * pad) / cell_size))
+    rows = int(np.ceil((bbox[3] - bbox[1] + 2 * pad) / cell_size))
+    gradient = np.linspace(0, max_depth, rows)[:, np.newaxis]
+    values = gradient + rng.normal(0, 3, (rows, cols))
+    cells = np.where(values < 1, 255, np.clip(values, 1, 25)).astype(np.uint8)
+
+    with rasterio.open(path, 'w',
+                       driver='GTiff',
+                       width=cols,
+                       height=rows,
+                       count=1,
+                       dtype='uint8',
+                       nodata=255,
+                       crs='EPSG:4326',
+                       transform=from_origin(bbox[0] - pad, bbox[3] + pad,
+                                             cell_size, cell_size)) as dst:
+        dst.write(cells, 1)
+    return path
+
+
+def make_storm_surge_categories(directory, bbox=DEFAULT_BBOX, categories=5,
+                                cell_size=0.0005, seed=0):
+    """
+    Write one storm surge raster per storm category, with deeper inundation
+        for stronger storms
+
+    Args:
+        directory (str): output directory
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        categories (int): number of categories, defaults to 5
+        cell_size (float): cell size in degrees
+        seed (int): random seed
+
+    Returns:
+        ([str]): paths to the GeoTIFFs, from category 1 up
+    """
+    return [make_storm_surge(os.path.join(directory, 'storm_surge_cat{}.tif'.format(c)),
+                             bbox, cell_size, seed + c,
+                             max_depth=int(round(25.0 * c / categories)))
+            for c in range(1, categories + 1)]
+
+
+def make_sea_level_rise(path, bbox=DEFAULT_BBOX, feet=range(11), count=50,
+                        seed=0, prefix='TX_Synthetic'):
+    """
+    Write a sea level rise geodatabase laid out like NOAA's: one
+        `<prefix>_slr_<n>ft` layer of inundation polygons per foot of rise.
+        Each layer holds a band along the southern edge with a ragged
+        northern shore that moves inland with the rise, and low lying
+        ponds that grow with it.
+
+    Args:
+        path (str): output geodatabase, e.g. `TX_Synthetic_slr_final_dist.gdb`
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        feet ([int]): feet of rise to write a layer for, defaults to 0 to 10
+        count (int): number of ponds, 0.001 to 0.004 degrees across
+        seed (int): random seed
+        prefix (str): layer name prefix
+
+    Returns:
+        (str): path to the geodatabase
+    """
+    rng = np.random.RandomState(seed)
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    xs = np.linspace(bbox[0], bbox[2], max(2, 4 * count))
+    shore = rng.uniform(-0.02, 0.02, len(xs)) * height
+    ponds = [(bbox[0] + rng.rand() * width, bbox[1] + rng.rand() * height,
+              rng.uniform(0.001, 0.004)) for _ in range(count)]
+    schema = {'geometry': 'Polygon', 'properties': {'gridcode': 'int'}}
+    for ft in feet:
+        edge = bbox[1] + (0.05 + 0.04 * ft) * height + shore
+        band = Polygon([(bbox[0], bbox[1])] + list(zip(xs, edge)) + [(bbox[2], bbox[1])])
+        polys = [band] + [Point(x, y).buffer(r * (1 + 0.2 * ft), resolution=8)
+                          for x, y, r in ponds]
+        with fiona.open(path, 'w',
+                        driver='OpenFileGDB',
+                        schema=schema,
+                        crs='EPSG:4326',
+                        layer='{}_slr_{}ft'.format(prefix, ft)) as dst:
+            dst.writerecords({'geometry': mapping(p), 'properties': {'gridcode': 1}}
+                             for p in polys)
+    return path
+
+
+def make_sea_level_rise_archive(path, bbox=DEFAULT_BBOX, feet=range(11), count=50,
+                                seed=0):
+    """
+    Write a zip archive laid out like a NOAA sea level rise download, to be
+        read by `Overlay.prep_data` from a file:// url
+
+    Args:
+        path (str): output archive, named like `TX_Synthetic_slr_data_dist.zip`
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        feet ([int]): feet of rise to write a layer for, defaults to 0 to 10
+        count (int): number of ponds
+        seed (int): random seed
+
+    Returns:
+        (str): path to the archive
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    zip_dir_name = os.path.basename(path).replace('.zip', '')
+    gdb_name = (zip_dir_name + '.gdb').replace('data', 'final')
+    prefix = zip_dir_name.split('_slr')[0]
+    gdb = make_sea_level_rise(os.path.join(directory, gdb_name), bbox, feet,
+                              count, seed, prefix)
+    with ZipFile(path, 'w', ZIP_DEFLATED) as archive:
+        for name in sorted(os.listdir(gdb)):
+            archive.write(os.path.join(gdb, name), '{}/{}'.format(gdb_name, name))
+    shutil.rmtree(gdb)
+    return path
+
+
+def make_counties(path, bbox=DEFAULT_BBOX, rows=3, cols=3, state_fips='48'):
+    """
+    Write a grid of county boundaries with the attributes of the TIGER/Line
+        county file
+
+    Args:
+        path (str): output shapefile
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        rows (int): rows of counties
+        cols (int): columns of counties
+        state_fips (str): state code of every county
+
+    Returns:
+        (str): path to the shapefile
+    """
+    width, height = (bbox[2] - bbox[0]) / cols, (bbox[3] - bbox[1]) / rows
+    records = {'NAME': [], 'STATEFP': [], 'COUNTYFP': [], 'GEOID': []}
+    geoms = []
+    for i in range(rows * cols):
+        x, y = bbox[0] + (i % cols) * width, bbox[1] + (i // cols) * height
+        county_fips = '{:03d}'.format(2 * i + 901)
+        records['NAME'].append('Synthetic {}'.format(i + 1))
+        records['STATEFP'].append(state_fips)
+        records['COUNTYFP'].append(county_fips)
+        records['GEOID'].append(state_fips + county_fips)
+        geoms.append(box(x, y, x + width, y + height))
+    counties = gpd.GeoDataFrame(records, geometry=geoms, crs={'init': 'epsg:4326'})
+    counties.to_file(path)
+    return path
+
+
+def make_facilities(directory, bbox=DEFAULT_BBOX, count=200, seed=0,
+                    categories=None):
+    """
+    Write randomly placed health facilities, one point shapefile in
+        EPSG:3857 per category like the national health layers
+
+    Args:
+        directory (str): output directory
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        count (int): number of facilities of each category
+        seed (int): random seed
+        categories ([str]): facility categories, defaults to the categories
+            of `constants.HEALTH_RESOURCE_FILES`
+
+    Returns:
+        (dict): category name to shapefile, in the form of
+            `constants.HEALTH_RESOURCE_FILES`
+    """
+    if categories is None:
+        categories = sorted(constants.HEALTH_RESOURCE_FILES)
+    rng = np.random.RandomState(seed)
+    files = {}
+    for category in categories:
+        xs = rng.uniform(bbox[0], bbox[2], count)
+        ys = rng.uniform(bbox[1], bbox[3], count)
+        points = gpd.GeoDataFrame({'ID': np.arange(count),
+                                   'NAME': ['{} {}'.format(category, i)
+                                            for i in range(count)]},
+                                  geometry=[Point(x, y) for x, y in zip(xs, ys)],
+                                  crs={'init': 'epsg:4326'})
+        file_name = os.path.basename(constants.HEALTH_RESOURCE_FILES.get(
+            category, category.replace(' ', '') + '.shp'))
+        files[category] = os.path.join(directory, file_name)
+        points.to_crs({'init': 'epsg:3857'}).to_file(files[category])
+    return files
+
+
+def scale_bbox(scale, bbox=DEFAULT_BBOX):
+    """
+    Grow or shrink a bounding box about its center so its area changes by
+        a factor
+
+    Args:
+        scale (float): factor of the area
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+
+    Returns:
+        ([float]): the scaled bounding box
+    """
+    factor = np.sqrt(scale) / 2
+    x, y = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    return [x - width * factor, y - height * factor,
+            x + width * factor, y + height * factor]
+
+
+def make_sources(directory, scale=1, seed=0):
+    """
+    Write a full set of synthetic national datasets, in the form
+        `Overlay.prep_data` and the facility and zonal functions read them,
+        for a study area whose area and feature counts grow with `scale`
+
+    Args:
+        directory (str): output directory
+        scale (float): size of the study area and number of features,
+            relative to `DEFAULT_BBOX`
+        seed (int): random seed
+
+    Returns:
+        (dict): paths to the 'study_area' and 'counties' shapefiles, the
+            'flood' shapefile, the 'sea_level_rise_url' of the archive, the
+            'storm_surge' GeoTIFFs of every category and the 'facilities'
+            shapefile of every category
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    bbox = scale_bbox(scale)
+    # national layers reach past the study area
+    pad = 0.1 * (bbox[2] - bbox[0])
+    national = [bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad]
+    count = max(1, int(round(50 * scale)))
+    sea_zip = make_sea_level_rise_archive(
+        os.path.join(directory, 'TX_Synthetic_slr_data_dist.zip'),
+        national, count=count, seed=seed)
+    return {
+        'study_area': make_study_area(os.path.join(directory, 'study_area.shp'), bbox),
+        'counties': make_counties(os.path.join(directory, 'counties.shp'), national,
+                                  rows=int(np.ceil(3 * np.sqrt(scale))),
+                                  cols=int(np.ceil(3 * np.sqrt(scale)))),
+        'flood': make_flood(os.path.join(directory, 'flood.shp'), national,
+                            count=count, seed=seed, zone_size=(0.004, 0.02)),
+        'sea_level_rise_url': 'file://' + os.path.abspath(sea_zip),
+        'storm_surge': make_storm_surge_categories(directory, national, seed=seed),
+        'facilities': make_facilities(directory, national, count=4 * count, seed=seed)
+    }
+
+
+def make_inputs(directory, bbox=DEFAULT_BBOX, seed=0):
+    """
+    Write a full set of synthetic inputs for one study area
+
+    Args:
+        directory (str): output directory
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        seed (int): random seed
+
+    Returns:
+        (str, dict): path to the study area shapefile, and input files in the
+            form returned by `Overlay.prep_data`
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    study_area = make_study_area(os.path.join(directory, 'study_area.shp'), bbox)
+    gdb = os.path.join(directory, 'TX_Synthetic_slr_final_dist.gdb')
+    if os.path.isdir(gdb):
+        shutil.rmtree(gdb)
+    input_data = {
+        'flood': make_flood(os.path.join(directory, 'flood.shp'), bbox, seed=seed),
+        'sea_level': make_sea_level_rise(gdb, bbox, seed=seed),
+        'storm_surge': make_storm_surge(os.path.join(directory, 'storm_surge.tif'),
+                                        bbox, seed=seed)
+    }
+    return study_area, input_data
+
+
+def compare_backends(directory, bbox=DEFAULT_BBOX, seed=0):
+    """
+    Build the overlay for a synthetic study area with both the Spark and the
+        NumPy backend and compare the base, every hazard layer and the
+        overlay cell for cell
+
+    Args:
+        directory (str): directory for the synthetic inputs
+        bbox ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        seed (int): random seed
+
+    Returns:
+        (dict): for each layer, the number of cells compared and the number
+            that differ between the backends
+    """
+    from overlay.analysis import Overlay
+
+    study_area, input_data = make_inputs(directory, bbox, seed)
+    overlays = {}
+    for backend in ('spark', 'numpy'):
+        ov = Overlay('synthetic_{}'.format(backend), study_area, backend)
+        ov.build_layers(input_data)
+        ov.overlay_layers()
+        overlays[backend] = ov
+
+    grid = overlays['numpy'].grid
+    comparison = {}
+    for name in ('base', 'flood', 'sea_level_rise', 'storm_surge', 'overlay'):
+        expected = getattr(overlays['numpy'], name).cells
+        actual = _to_grid(getattr(overlays['spark'], name), grid)
+        mismatched = int((expected != actual).sum())
+        comparison[name] = {'cells': int(expected.size), 'mismatched': mismatched}
+        logger.info('{}: {} of {} cells differ'.format(
+            name, mismatched, expected.size))
+    return comparison
+
+
+def _to_grid(tiled, grid):
+    """
+    Helper function ('private') to collect a tiled layer into an int32 array
+        over a grid
+    """
+    cells = np.full(grid.shape, kernels.NODATA, dtype=np.int32)
+    keys = set(grid.keys())
+    for key, tile in tiled.to_numpy_rdd().collect():
+        if (key.col, key.row) in keys:
+            cells[grid.tile_slice(key.col, key.row)] = kernels.from_tile(
+                tile.cells[0], tile.no_data_value)
+    return cells
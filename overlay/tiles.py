@@ -0,0 +1,208 @@
+"""
+Render overlay layers to map tiles cached on disk
+
+Overlay scores are a small known domain, so layers are colored with one
+    break per score of the overlay's score range, on the `constants.COLORS`
+    ramp, instead of breaks from a histogram. Every zoom level of the
+    layer's pyramid is rendered to z/x/y PNG files once, stored in a
+    `cache.FileCache` under the layer's key, and served from disk, so
+    viewing a layer again doesn't touch Spark.
+
+The tile server binds to the loopback interface unless it is given another
+    address. That works when the notebook server proxies the tiles to the
+    browser, or the browser runs on the same machine. If the browser fetches
+    tiles from the server across the network, e.g. from GeoNotebook on an
+    EMR master, bind to an address it can reach, e.g. '0.0.0.0', and only
+    open the port to the browser, e.g. through an SSH tunnel.
+"""
+
+import os
+import re
+import threading
+import logging
+import geopyspark as gps
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from overlay import constants, expression, metrics
+from overlay.cache import FileCache
+from overlay.local import LocalLayer
+
+logger = logging.getLogger(__name__)
+
+# url path of a tile served by DiskTMS
+TILE_PATH = re.compile(r'^/tile/(\d+)/(\d+)/(\d+\.png)$')
+
+
+def fixed_color_map(score_range=None):
+    """
+    Color map with one color per overlay score
+
+    Args:
+        score_range ((int, int)): lowest and highest score, e.g.
+            `Overlay.score_range`, defaults to the range of the default
+            weighted overlay
+
+    Returns:
+        (gps.ColorMap): color map from each score to a color of
+            `constants.COLORS`
+    """
+    breaks, colors = score_colors(score_range)
+    return gps.ColorMap.from_colors(breaks, colors)
+
+
+def score_colors(score_range=None):
+    """
+    Breaks and colors of `fixed_color_map`: every score from the lowest to
+        the highest, and colors spread evenly over `constants.COLORS`
+
+    Args:
+        score_range ((int, int)): lowest and highest score, defaults to the
+            range of the default weighted overlay
+
+    Returns:
+        ([int], [int]): breaks and colors
+    """
+    if score_range is None:
+        score_range = expression.default_score_range()
+    breaks = list(range(score_range[0], score_range[1] + 1))
+    last = len(constants.COLORS) - 1
+    colors = [constants.COLORS[int(round(i * last / max(len(breaks) - 1, 1)))]
+              for i in range(len(breaks))]
+    return breaks, colors
+
+
+@metrics.timed('render')
+def render(tiled_layer, directory, color_map):
+    """
+    Render every zoom level of a layer's pyramid to z/x/y PNG files
+
+    Args:
+        tiled_layer (gps.TiledRasterLayer or local.LocalLayer): layer to
+            render
+        directory (str): output directory
+        color_map (gps.ColorMap): color map of the tiles
+
+    Returns:
+        (int): number of tiles written
+    """
+    if isinstance(tiled_layer, LocalLayer):
+        tiled_layer = tiled_layer.to_tiled_layer()
+    logger.info('Creating pyramid layer...')
+    pyramid_layer = tiled_layer.pyramid()
+    count = 0
+    for zoom, level in sorted(pyramid_layer.levels.items()):
+        logger.info('Rendering map tiles at zoom {}...'.format(zoom))
+        for key, png in level.to_png_rdd(color_map).toLocalIterator():
+            tile_dir = os.path.join(directory, str(zoom), str(key.col))
+            if not os.path.isdir(tile_dir):
+                os.makedirs(tile_dir)
+            with open(os.path.join(tile_dir, '{}.png'.format(key.row)), 'wb') as f:
+                f.write(png)
+            count += 1
+            metrics.count('tiles_rendered')
+    return count
+
+
+def cached_tms(tiled_layer, key, cache=None, score_range=None, host=None):
+    """
+    Tile server for a layer colored with `fixed_color_map`, rendering its
+        tiles to the tile cache if they aren't there yet
+
+    Args:
+        tiled_layer (gps.TiledRasterLayer or local.LocalLayer): layer to
+            serve
+        key (str): key that identifies the layer's contents, e.g.
+            `Overlay.overlay_key`
+        cache (cache.FileCache): tile cache, defaults to the cache in
+            `constants.TILE_CACHE_DIR`
+        score_range ((int, int)): lowest and highest score of the layer,
+            defaults to the range of the default weighted overlay
+        host (str): address the tile server binds to when GeoNotebook
+            starts it, defaults to the loopback interface. See the module
+            docstring for remote notebooks.
+
+    Returns:
+        (DiskTMS): tile server for the cached tiles
+    """
+    if cache is None:
+        cache = FileCache(constants.TILE_CACHE_DIR, constants.TILE_CACHE_MAX_BYTES)
+    breaks, colors = score_colors(score_range)
+    tile_key = cache.key('tiles', [], layer=key, breaks=breaks, colors=colors)
+    directory = cache.get(tile_key)
+    if directory is not None:
+        logger.info('Reading map tiles from cache')
+    else:
+        directory = cache.put(tile_key,
+                              lambda d: render(tiled_layer, d,
+                                               fixed_color_map(score_range)),
+                              layer=key)
+    return DiskTMS(directory, host)
+
+
+class DiskTMS(object):
+    """
+    Tile server for a directory of z/x/y PNG files, with the interface of
+        `gps.TMS` that GeoNotebook's `TMSRasterData` uses
+
+    Attributes:
+        directory (str): root of the tile files
+        default_host (str): address `bind` binds to when it isn't given
+            one, None for the loopback interface
+        host (str): address the server is bound to, None if unbound
+        port (int): port the server is bound to, None if unbound
+    """
+
+    def __init__(self, directory, default_host=None):
+        self.directory = directory
+        self.default_host = default_host
+        self.host = None
+        self.port = None
+        self._server = None
+
+    @property
+    def url_pattern(self):
+        """
+        (str): url template of the tiles
+        """
+        return 'http://{}:{}/tile/{{z}}/{{x}}/{{y}}.png'.format(self.host, self.port)
+
+    def bind(self, host=None, requested_port=None):
+        """
+        Start serving tiles in a background thread
+
+        Args:
+            host (str): address to bind to, defaults to `default_host`, or
+                the loopback interface so cached tiles aren't served to the
+                network
+            requested_port (int): port to bind to, defaults to a free port
+        """
+        directory = self.directory
+
+        class _Handler(SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                match = TILE_PATH.match(path.split('?')[0])
+                if match is None:
+                    return ''
+                return os.path.join(directory, *match.groups())
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host or self.default_host or '127.0.0.1',
+                                            requested_port or 0),
+                                           _Handler)
+        self.host, self.port = self._server.server_address[:2]
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def unbind(self):
+        """
+        Stop serving tiles
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self.host, self.port = None, None
@@ -2,13 +2,186 @@
 Utility functions for GeoNotebook
 """
 
+import os
+import json
+import hashlib
+import logging
 import geopyspark as gps
 
 from pyspark import SparkContext
 
+from overlay import constants, partitioning
 
-def overlay_geopyspark_conf(appName='ClimateOverlay', memory='12G'):
-    conf = gps.geopyspark_conf(appName="ClimateOverlay")
-    conf.set('spark.master.memory', '12G')
-    conf.set('spark.ui.enabled', True)
-    sc = SparkContext(conf=conf)
+logger = logging.getLogger(__name__)
+
+
+def overlay_geopyspark_conf(appName=constants.SPARK_APP_NAME,
+                            memory=constants.SPARK_DRIVER_MEMORY):
+    """
+    Create the Spark context of the overlay analysis, or reuse the running
+        one
+
+    Args:
+        appName (str): Spark application name
+        memory (str): driver memory, e.g. '12G'
+
+    Returns:
+        (pyspark.SparkContext): the context
+    """
+    return spark_context(appName=appName, memory=memory)
+
+
+def spark_conf(appName=constants.SPARK_APP_NAME, memory=constants.SPARK_DRIVER_MEMORY,
+               executor_memory=constants.SPARK_EXECUTOR_MEMORY, num_tiles=None,
+               master=None):
+    """
+    Build the GeoPySpark configuration of the overlay analysis
+
+    Args:
+        appName (str): Spark application name
+        memory (str): driver memory, e.g. '12G'
+        executor_memory (str): memory of each executor, e.g. '4G'
+        num_tiles (int): number of zoom 12 tiles of the largest study area
+            expected, used to set the default parallelism to the number of
+            partitions an overlay of that size uses. Defaults to None, which
+            keeps Spark's default.
+        master (str): Spark master url, e.g. 'local[*]'. Defaults to None,
+            which uses the master of the environment.
+
+    Returns:
+        (pyspark.SparkConf): the configuration
+    """
+    conf = gps.geopyspark_conf(master=master, appName=appName)
+    conf.set('spark.driver.memory', memory)
+    conf.set('spark.executor.memory', executor_memory)
+    conf.set('spark.serializer', constants.SPARK_SERIALIZER)
+    conf.set('spark.kryoserializer.buffer.max', constants.SPARK_KRYO_BUFFER_MAX)
+    conf.set('spark.ui.enabled', 'true')
+    if num_tiles is not None:
+        conf.set('spark.default.parallelism',
+                 str(partitioning.partition_count(num_tiles)))
+    return conf
+
+
+def spark_context(appName=constants.SPARK_APP_NAME, memory=constants.SPARK_DRIVER_MEMORY,
+                  executor_memory=constants.SPARK_EXECUTOR_MEMORY, num_tiles=None,
+                  prewarm=False, master=None):
+    """
+    Get a ready Spark context: the running one if there is one, otherwise a
+        new one configured with `spark_conf`. Settings only apply when a new
+        context is created, since the JVM of a running context can't be
+        reconfigured; `effective_conf` reports what is in use.
+
+    Args:
+        appName (str): Spark application name
+        memory (str): driver memory, e.g. '12G'
+        executor_memory (str): memory of each executor, e.g. '4G'
+        num_tiles (int): number of zoom 12 tiles of the largest study area
+            expected, defaults to None
+        prewarm (bool): run a trivial job on every executor so the first
+            analysis doesn't wait for the JVM and Python workers to start,
+            defaults to False
+        master (str): Spark master url, e.g. 'local[*]', defaults to None
+
+    Returns:
+        (pyspark.SparkContext): the context
+    """
+    sc = SparkContext._active_spark_context
+    if sc is None:
+        logger.info('Starting Spark context...')
+        sc = SparkContext.getOrCreate(conf=spark_conf(appName, memory,
+                                                      executor_memory, num_tiles,
+                                                      master))
+    if prewarm:
+        prewarm_context(sc)
+    return sc
+
+
+def prewarm_context(sc):
+    """
+    Start the executors and Python workers of a context by running a
+        trivial job with one task per core
+
+    Args:
+        sc (pyspark.SparkContext): the context
+    """
+    logger.info('Warming up Spark executors...')
+    slots = sc.defaultParallelism
+    sc.parallelize(range(slots), slots).map(lambda x: x).count()
+
+
+def effective_conf(sc=None):
+    """
+    Settings of a Spark context as it is running
+
+    Args:
+        sc (pyspark.SparkContext): the context, defaults to the running one
+
+    Returns:
+        (dict): setting names to values, with the default parallelism under
+            'spark.default.parallelism', or an empty dict if no context is
+            running
+    """
+    sc = sc or SparkContext._active_spark_context
+    if sc is None:
+        return {}
+    conf = dict(sc.getConf().getAll())
+    conf['spark.default.parallelism'] = str(sc.defaultParallelism)
+    return conf
+
+
+def file_identity(path):
+    """
+    Describe the version of an input file or directory (e.g. a geodatabase)
+        by its path, total size and latest modification time. A shapefile
+        is described together with its attribute, index and projection
+        files.
+
+    Args:
+        path (str): file or directory, or None
+
+    Returns:
+        (list): [path, size, mtime], or None if `path` is None
+    """
+    if path is None:
+        return None
+    if os.path.isdir(path):
+        files = [os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs]
+        size = sum(os.path.getsize(f) for f in files)
+        mtime = max([os.path.getmtime(f) for f in files] + [os.path.getmtime(path)])
+    else:
+        stem, ext = os.path.splitext(path)
+        files = [path]
+        if ext.lower() == '.shp':
+            files += [stem + e for e in constants.SHAPEFILE_SIDECARS
+                      if os.path.isfile(stem + e)]
+        size = sum(os.path.getsize(f) for f in files)
+        mtime = max(os.path.getmtime(f) for f in files)
+    return [os.path.abspath(path), size, mtime]
+
+
+def geometry_hash(geom):
+    """
+    Hash a geometry by its well-known binary
+
+    Args:
+        geom (shapely.geometry): geometry to hash
+
+    Returns:
+        (str): hex digest
+    """
+    return hashlib.sha1(geom.wkb).hexdigest()
+
+
+def hash_key(*parts):
+    """
+    Hash JSON-serializable parts into a short key
+
+    Args:
+        *parts: values that identify a computation
+
+    Returns:
+        (str): 20 character hex key
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:20]
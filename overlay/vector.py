@@ -0,0 +1,200 @@
+"""
+Read study area subsets of national vector datasets using persistent
+    spatial indexes
+"""
+
+import os
+import re
+import logging
+import fiona
+import geopandas as gpd
+
+from fiona.transform import transform, transform_geom
+from osgeo import ogr
+from shapely.geometry import shape
+from shapely.prepared import prep
+
+from overlay import constants, metrics, store
+
+logger = logging.getLogger(__name__)
+
+
+def build_spatial_index(shp):
+    """
+    Build a `.qix` quadtree index next to a shapefile. OGR uses it to answer
+        bounding box queries without reading every feature. The index is
+        built once per file and rebuilt only when the shapefile changes.
+
+    Args:
+        shp (str): path to shapefile
+
+    Returns:
+        (str): path to the index file, or None if it could not be written
+    """
+    qix = os.path.splitext(shp)[0] + '.qix'
+    if os.path.isfile(qix) and os.path.getmtime(qix) >= os.path.getmtime(shp):
+        return qix
+
+    logger.info('Building spatial index for {}...'.format(os.path.basename(shp)))
+    source = ogr.Open(shp, 1)
+    if source is None:
+        logger.warning('Could not open {} for writing, reading without an index'.format(shp))
+        return None
+    layer_name = source.GetLayer(0).GetName()
+    source.ExecuteSQL('CREATE SPATIAL INDEX ON "{}"'.format(layer_name))
+    source = None
+    return qix if os.path.isfile(qix) else None
+
+
+def read_bbox(shp, bbox, geometry=None):
+    """
+    Read the features of a shapefile whose bounding boxes overlap `bbox`.
+        Exact intersection tests are only run on those candidates. Reads
+        from the partitioned store when one has been ingested.
+
+    Args:
+        shp (str): path to shapefile
+        bbox ([float]): xmin, ymin, xmax, ymax in the shapefile's crs
+        geometry (shapely.geometry): if given, only keep features that
+            intersect it, defaults to None
+
+    Returns:
+        (gpd.GeoDataFrame): features in the bounding box
+    """
+    if store.has_store(shp):
+        subset = store.read_bbox(shp, bbox, geometry)
+        metrics.count('features_read', len(subset))
+        return subset
+
+    build_spatial_index(shp)
+    with fiona.open(shp) as source:
+        crs = source.crs
+        features = list(source.filter(bbox=tuple(bbox)))
+
+    metrics.count('features_read', len(features))
+    if len(features) == 0:
+        return gpd.GeoDataFrame(geometry=[], crs=crs)
+
+    subset = gpd.GeoDataFrame.from_features(features, crs=crs)
+    if geometry is not None:
+        subset = subset[subset.geometry.intersects(geometry)]
+    return subset
+
+
+def slr_layer_name(gdb, feet):
+    """
+    Find the name of the layer of a NOAA sea level rise geodatabase that
+        holds the inundation polygons for a given rise
+
+    Args:
+        gdb (str): path to sea level rise geodatabase
+        feet (int): feet of sea level rise
+
+    Returns:
+        (str): layer name
+    """
+    driver = ogr.GetDriverByName("OpenFileGDB")
+    g = driver.Open(gdb)
+    suffix = 'slr_{}ft'.format(str(feet))
+    for x in range(g.GetLayerCount()):
+        layer_name = g.GetLayerByIndex(x).GetName()
+        if layer_name.endswith(suffix):
+            break
+    return layer_name
+
+
+def slr_layer_names(gdb):
+    """
+    Find the layers of a NOAA sea level rise geodatabase that hold the
+        inundation polygons for each rise
+
+    Args:
+        gdb (str): path to sea level rise geodatabase
+
+    Returns:
+        (dict): feet of sea level rise to layer name
+    """
+    driver = ogr.GetDriverByName("OpenFileGDB")
+    g = driver.Open(gdb)
+    names = {}
+    for x in range(g.GetLayerCount()):
+        layer_name = g.GetLayerByIndex(x).GetName()
+        match = re.search(r'slr_(\d+)ft$', layer_name)
+        if match is not None:
+            names[int(match.group(1))] = layer_name
+    return names
+
+
+def read_batches(path, bbox_wgs, layer=None, batch_size=constants.SLR_BATCH_SIZE,
+                 crs='EPSG:4326', within=None):
+    """
+    Stream the polygons of a vector layer that overlap a bounding box in
+        batches. The bounding box is applied as an OGR spatial filter, so
+        features outside of it are never parsed, and only one batch is held
+        in memory at a time.
+
+    Args:
+        path (str): vector dataset, e.g. a geodatabase
+        bbox_wgs ([float]): xmin, ymin, xmax, ymax in EPSG:4326
+        layer (str): layer of the dataset, defaults to the first one
+        batch_size (int): polygons per batch
+        crs (str): crs of the yielded polygons, defaults to 'EPSG:4326'
+        within (shapely.geometry): if given, polygons are clipped to this
+            area, in `crs`, and dropped if they are outside it, defaults to
+            None
+
+    Yields:
+        ([shapely.geometry.Polygon]): polygons, with multipolygons split into
+            their parts
+    """
+    with fiona.open(path, layer=layer) as source:
+        src_crs = source.crs
+        xs, ys = transform('EPSG:4326', src_crs,
+                           [bbox_wgs[0], bbox_wgs[0], bbox_wgs[2], bbox_wgs[2]],
+                           [bbox_wgs[1], bbox_wgs[3], bbox_wgs[1], bbox_wgs[3]])
+        bbox = (min(xs), min(ys), max(xs), max(ys))
+
+        batch = []
+        read = 0
+        for feature in source.filter(bbox=bbox):
+            read += 1
+            if feature['geometry'] is None:
+                continue
+            geom = shape(transform_geom(src_crs, crs, feature['geometry']))
+            if within is not None:
+                batch.extend(clip([geom], within))
+            else:
+                batch.extend(getattr(geom, 'geoms', [geom]))
+            if len(batch) >= batch_size:
+                metrics.count('features_read', read)
+                read = 0
+                yield batch
+                batch = []
+        metrics.count('features_read', read)
+        if len(batch) > 0:
+            yield batch
+
+
+def clip(geoms, area):
+    """
+    Clip polygons to an area, e.g. the tiles a study area touches, so they
+        are only rasterized where they can reach the study area
+
+    Args:
+        geoms ([shapely.geometry]): polygons or multipolygons
+        area (shapely.geometry): area to clip to, in the crs of `geoms`
+
+    Returns:
+        ([shapely.geometry.Polygon]): clipped polygons, with multipart
+            results split into their parts
+    """
+    prepared = prep(area)
+    clipped = []
+    for geom in geoms:
+        if geom is None or not prepared.intersects(geom):
+            continue
+        part = geom if prepared.contains(geom) else geom.intersection(area)
+        # drop the lines and points left where a polygon touches the edge
+        clipped.extend(p for p in getattr(part, 'geoms', [part])
+                       if p.geom_type == 'Polygon' and not p.is_empty)
+    return clipped
@@ -0,0 +1,183 @@
+"""
+Zonal statistics of the overlay surface
+
+Zone polygons (e.g. counties, tracts or ZIP codes) are rasterized onto the
+    overlay layout, and every cell adds one to the count of its zone and
+    risk score. The counts of all zones are computed in one pass, with a
+    `bincount` over (zone, score) codes, on each tile on the Spark backend
+    and over the whole grid on the NumPy backend. Histograms, mean scores and
+    the area at risk of every zone are derived from the counts.
+"""
+
+import numpy as np
+import pandas as pd
+
+from affine import Affine
+from pyspark import SparkContext
+from rasterio import features
+from shapely import wkb
+
+from overlay import constants, expression, kernels, sparse
+from overlay.local import LocalLayer
+
+
+def zone_counts(scores, zones, num_zones, score_range):
+    """
+    Count the cells of every risk score in every zone
+
+    Args:
+        scores (np.ndarray): int32 risk scores, `kernels.NODATA` where
+            missing
+        zones (np.ndarray): zone number of each cell, from 1 to `num_zones`,
+            and 0 outside every zone
+        num_zones (int): number of zones
+        score_range ((int, int)): lowest and highest risk score
+
+    Returns:
+        (np.ndarray): (num_zones + 1, scores) int64 counts of the scores
+            from the lowest to the highest, with the cells outside every
+            zone in the first row
+    """
+    lowest, highest = score_range
+    num_scores = highest - lowest + 1
+    valid = (scores != kernels.NODATA) & (scores >= lowest) & (scores <= highest)
+    codes = zones[valid].astype(np.int64) * num_scores + (scores[valid] - lowest)
+    counts = np.bincount(codes, minlength=(num_zones + 1) * num_scores)
+    return counts.reshape(num_zones + 1, num_scores)
+
+
+def zonal_statistics(layer, grid, zones, id_field=None,
+                     at_risk_score=constants.AT_RISK_SCORE, score_range=None):
+    """
+    Compute the risk score histogram, mean score and area at risk of every
+        zone. Zones should not overlap; where they do, cells count towards
+        the zone that comes last.
+
+    Args:
+        layer (sparse.SparseTiledLayer, gps.TiledRasterLayer or
+            local.LocalLayer): overlay surface
+        grid (grid.Grid): grid of the overlay's study area
+        zones (gpd.GeoDataFrame): zone polygons
+        id_field (str): attribute that identifies each zone, defaults to the
+            index of `zones`
+        at_risk_score (int): lowest risk score that counts as at risk
+        score_range ((int, int)): lowest and highest risk score of the
+            layer, e.g. `Overlay.score_range`, defaults to the range of the
+            default weighted overlay
+
+    Returns:
+        (pd.DataFrame): one row per zone with its id, number of cells, mean
+            score, cells and area in square kilometers at or above
+            `at_risk_score`, and a `score_<n>` column with the cell count of
+            every score
+    """
+    if score_range is None:
+        score_range = expression.default_score_range()
+    zones_wm = zones.to_crs({'init': 'epsg:3857'})
+    geoms = list(zones_wm.geometry)
+    if isinstance(layer, LocalLayer):
+        shapes = [(g, i + 1) for i, g in enumerate(geoms)
+                  if g is not None and not g.is_empty]
+        zone_cells = np.zeros(grid.shape, dtype=np.int32)
+        if len(shapes) > 0:
+            features.rasterize(shapes, out=zone_cells, transform=grid.transform)
+        counts = zone_counts(layer.cells, zone_cells, len(geoms), score_range)
+    else:
+        counts = _tiled_counts(layer, grid, geoms, score_range)
+
+    ids = zones[id_field].values if id_field is not None else zones.index.values
+    return summarize(counts[1:], ids, grid.cell_size,
+                     zones.to_crs({'init': 'epsg:4326'}).geometry.centroid.y.values,
+                     at_risk_score, score_range[0])
+
+
+def summarize(counts, ids, cell_size, latitudes, at_risk_score=constants.AT_RISK_SCORE,
+              lowest_score=0):
+    """
+    Turn per-zone score counts into zonal statistics
+
+    Args:
+        counts (np.ndarray): (zones, scores) cell counts of consecutive
+            scores
+        ids (np.ndarray): id of each zone
+        cell_size (float): width of a cell in web mercator meters
+        latitudes (np.ndarray): latitude of each zone, used to correct the
+            web mercator cell area
+        at_risk_score (int): lowest risk score that counts as at risk
+        lowest_score (int): risk score of the first column of `counts`
+
+    Returns:
+        (pd.DataFrame): zonal statistics, as returned by `zonal_statistics`
+    """
+    cells = counts.sum(axis=1)
+    scores = np.arange(lowest_score, lowest_score + counts.shape[1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(cells > 0, (counts * scores).sum(axis=1) / cells, np.nan)
+    at_risk = counts[:, scores >= at_risk_score].sum(axis=1)
+    # web mercator stretches both axes by 1 / cos(latitude)
+    cell_km2 = (cell_size * np.cos(np.radians(latitudes))) ** 2 / 1e6
+
+    stats = pd.DataFrame({'zone': ids,
+                          'cells': cells,
+                          'mean_score': mean,
+                          'cells_at_risk': at_risk,
+                          'area_at_risk_km2': at_risk * cell_km2})
+    for i, s in enumerate(scores):
+        stats['score_{}'.format(s)] = counts[:, i]
+    return stats
+
+
+def _tiled_counts(layer, grid, geoms, score_range):
+    """
+    Helper function ('private') to count the cells of every zone and score
+        of a tiled layer in one distributed pass. Each tile's zones are
+        rasterized on the executor that holds the tile. Compressed tiles of
+        a sparse layer aren't expanded: the cells of each zone all count
+        towards the tile's single score.
+    """
+    num_zones = len(geoms)
+    bounds = np.array([g.bounds if g is not None and not g.is_empty
+                       else (np.inf, np.inf, -np.inf, -np.inf) for g in geoms])
+    shapes = SparkContext.getOrCreate().broadcast(
+        [None if g is None or g.is_empty else wkb.dumps(g) for g in geoms])
+
+    lowest, highest = score_range
+    tile_layout = layer.layer_metadata.layout_definition.tileLayout
+    tile_shape = (tile_layout.tileRows, tile_layout.tileCols)
+
+    def _partition_counts(tiles):
+        polygons = [None if s is None else wkb.loads(s) for s in shapes.value]
+        total = np.zeros((num_zones + 1, highest - lowest + 1), dtype=np.int64)
+        for key, tile in tiles:
+            xmin, ymin, xmax, ymax = grid.tile_extent(key.col, key.row)
+            hits = np.nonzero((bounds[:, 0] < xmax) & (bounds[:, 2] > xmin) &
+                              (bounds[:, 1] < ymax) & (bounds[:, 3] > ymin))[0]
+            if len(hits) == 0:
+                continue
+            if isinstance(tile, np.ndarray):
+                # int32 cells of a sparse layer, possibly compressed
+                scores = tile
+            else:
+                scores = kernels.from_tile(tile.cells[0], tile.no_data_value)
+            rows, cols = tile_shape
+            zone_cells = features.rasterize(
+                [(polygons[i], int(i) + 1) for i in hits],
+                out_shape=(rows, cols),
+                transform=Affine((xmax - xmin) / cols, 0, xmin,
+                                 0, -(ymax - ymin) / rows, ymax),
+                fill=0,
+                dtype='int32')
+            if scores.shape == sparse.CONSTANT_SHAPE:
+                score = scores[0, 0]
+                if score != kernels.NODATA and lowest <= score <= highest:
+                    total[:, score - lowest] += np.bincount(
+                        zone_cells.ravel(), minlength=num_zones + 1)
+            else:
+                total += zone_counts(scores, zone_cells, num_zones, score_range)
+        yield total
+
+    tiles = (layer.tiles if isinstance(layer, sparse.SparseTiledLayer)
+             else layer.to_numpy_rdd())
+    counts = tiles.mapPartitions(_partition_counts).treeReduce(np.add)
+    shapes.unpersist()
+    return counts
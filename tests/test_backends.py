@@ -0,0 +1,102 @@
+"""
+Tests that the NumPy backend builds valid layers from synthetic inputs, and
+    that the Spark and NumPy backends build the same layers from them
+"""
+
+import types
+
+import pytest
+
+np = pytest.importorskip('numpy')
+gpd = pytest.importorskip('geopandas')
+pytest.importorskip('rasterio')
+pytest.importorskip('osgeo')
+
+from overlay import constants, expression, kernels, local, synthetic  # noqa: E402
+from overlay.grid import Grid  # noqa: E402
+
+LAYERS = ['base', 'flood', 'sea_level_rise', 'storm_surge', 'overlay']
+
+
+def numpy_overlay(study_area):
+    """
+    Stand-in for an `Overlay` on the NumPy backend, with the study area
+        attributes the layer functions read
+    """
+    boundary = gpd.read_file(study_area)
+    geom_wgs = boundary.geometry.iloc[0]
+    geom_wm = boundary.to_crs({'init': 'epsg:3857'}).geometry.iloc[0]
+    grid = Grid(list(geom_wm.bounds))
+    cover = grid.cover(grid.covering_keys(geom_wm))
+    ov = types.SimpleNamespace(grid=grid, study_area={
+        'geom_wgs': [geom_wgs],
+        'bbox_wgs': list(geom_wgs.bounds),
+        'cover_wgs': gpd.GeoSeries([cover], crs={'init': 'epsg:3857'}).to_crs(
+            {'init': 'epsg:4326'}).iloc[0]})
+    ov.base = local.base(ov)
+    return ov
+
+
+@pytest.fixture(scope='module')
+def numpy_layers(tmp_path_factory):
+    study_area, input_data = synthetic.make_inputs(
+        str(tmp_path_factory.mktemp('synthetic_numpy')))
+    ov = numpy_overlay(study_area)
+    hazards = {'flood': local.flood_hazard(ov, input_data['flood']),
+               'sea_level_rise': local.sea_level_rise(ov, input_data['sea_level']),
+               'storm_surge': local.storm_surge(ov, input_data['storm_surge'])}
+    program = expression.Program(expression.weighted_overlay(
+        {name: 1 for name in hazards}))
+    built = dict(hazards, base=ov.base,
+                 overlay=local.weighted_overlay(ov, program, hazards))
+    return {name: layer.cells for name, layer in built.items()}
+
+
+def test_numpy_base_marks_study_area(numpy_layers):
+    base = numpy_layers['base']
+    assert set(np.unique(base)) == {kernels.NODATA, 1}
+    assert 0 < (base == 1).sum() < base.size
+
+
+@pytest.mark.parametrize('layer', ['flood', 'sea_level_rise', 'storm_surge'])
+def test_numpy_hazards_score_study_area(numpy_layers, layer):
+    cells, inside = numpy_layers[layer], numpy_layers['base'] == 1
+    lowest, highest = constants.SCORE_RANGES[layer]
+    assert (cells[~inside] == kernels.NODATA).all()
+    scored = cells[inside & (cells != kernels.NODATA)]
+    assert ((scored >= lowest) & (scored <= highest)).all()
+    # the synthetic hazards reach the study area
+    assert (scored > lowest).any()
+
+
+@pytest.mark.parametrize('layer', ['flood', 'sea_level_rise'])
+def test_numpy_vector_hazards_cover_study_area(numpy_layers, layer):
+    inside = numpy_layers['base'] == 1
+    assert (numpy_layers[layer][inside] != kernels.NODATA).all()
+
+
+def test_numpy_overlay_sums_hazards(numpy_layers):
+    hazards = [numpy_layers[name] for name in ('flood', 'sea_level_rise', 'storm_surge')]
+    scored = numpy_layers['base'] == 1
+    for cells in hazards:
+        scored &= cells != kernels.NODATA
+    # each hazard adds its score above 1
+    total = sum(cells[scored] - 1 for cells in hazards)
+    assert (numpy_layers['overlay'][scored] == total).all()
+    assert (numpy_layers['overlay'][~scored] == kernels.NODATA).all()
+
+
+@pytest.fixture(scope='module')
+def comparison(tmp_path_factory):
+    pytest.importorskip('geopyspark')
+    from overlay import utils
+
+    utils.spark_context(appName='overlay-tests',
+                        master=constants.BENCHMARK_SPARK_MASTER)
+    return synthetic.compare_backends(str(tmp_path_factory.mktemp('synthetic')))
+
+
+@pytest.mark.parametrize('layer', LAYERS)
+def test_backends_build_same_cells(comparison, layer):
+    assert comparison[layer]['cells'] > 0
+    assert comparison[layer]['mismatched'] == 0
@@ -0,0 +1,162 @@
+"""
+Tests of the on-disk cache of prepared inputs in overlay.cache
+"""
+
+import os
+import json
+
+import pytest
+
+pytest.importorskip('geopyspark')
+
+from urllib.error import URLError  # noqa: E402
+
+from overlay import cache, download  # noqa: E402
+from test_download import serve  # noqa: E402
+
+
+def write_bytes(size):
+    """
+    Writer of an entry holding one file of `size` bytes
+    """
+    def _write(directory):
+        with open(os.path.join(directory, 'data.bin'), 'wb') as f:
+            f.write(b'x' * size)
+    return _write
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    deleted = []
+    return cache.Manifest(str(tmp_path / 'manifest.json'), 100, deleted.append), deleted
+
+
+def test_manifest_evicts_least_recently_used(manifest, monkeypatch):
+    manifest, deleted = manifest
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+
+    for key in ('a', 'b'):
+        manifest.add(key, 40)
+        now[0] += 1
+    # 'a' is used again, so 'b' is now the least recently used
+    assert manifest.touch('a')['last_used'] == 1002.0
+    assert manifest.touch('missing') is None
+    now[0] += 1
+
+    manifest.add('c', 40)
+    assert deleted == ['b']
+    assert [e['key'] for e in manifest.entries()] == ['c', 'a']
+
+
+def test_manifest_keeps_new_entry_over_budget(manifest):
+    manifest, deleted = manifest
+    manifest.add('a', 10)
+    manifest.add('big', 500, source='x')
+
+    assert deleted == ['a']
+    assert [(e['key'], e['bytes'], e['source'])
+            for e in manifest.entries()] == [('big', 500, 'x')]
+
+
+def test_manifest_remove(manifest):
+    manifest, deleted = manifest
+    for key in ('a', 'b', 'c'):
+        manifest.add(key, 1)
+    manifest.remove(['b', 'missing'])
+    assert deleted == ['b']
+    assert sorted(e['key'] for e in manifest.entries()) == ['a', 'c']
+    manifest.remove()
+    assert manifest.entries() == []
+
+
+def test_file_cache_put_and_get(tmp_path):
+    file_cache = cache.FileCache(str(tmp_path / 'cache'), max_bytes=1000)
+    source = tmp_path / 'input.txt'
+    source.write_text('input')
+    key = file_cache.key('clip', [str(source)], feet=5)
+
+    assert key.startswith('clip_')
+    assert file_cache.key('clip', [str(source)], feet=6) != key
+    assert file_cache.get(key) is None
+
+    path = file_cache.put(key, write_bytes(10), layer='flood')
+    assert path == file_cache.get(key)
+    with open(os.path.join(path, 'data.bin'), 'rb') as f:
+        assert f.read() == b'x' * 10
+    assert file_cache.latest(layer='flood') == key
+    assert file_cache.latest(layer='storm_surge') is None
+    assert file_cache.list()[0]['bytes'] == 10
+
+    # a changed source has another key
+    source.write_text('changed input')
+    assert file_cache.key('clip', [str(source)], feet=5) != key
+
+
+def test_file_cache_put_is_atomic(tmp_path):
+    file_cache = cache.FileCache(str(tmp_path / 'cache'), max_bytes=1000)
+
+    def _fail(directory):
+        write_bytes(10)(directory)
+        raise RuntimeError('interrupted')
+
+    with pytest.raises(RuntimeError):
+        file_cache.put('partial', _fail)
+    # neither the entry nor its staging directory is left behind
+    assert file_cache.get('partial') is None
+    assert os.listdir(file_cache.root) == []
+
+
+def test_file_cache_put_keeps_first_writer(tmp_path):
+    file_cache = cache.FileCache(str(tmp_path / 'cache'), max_bytes=1000)
+    first = file_cache.put('key', write_bytes(10))
+    second = file_cache.put('key', write_bytes(20))
+
+    assert first == second
+    assert os.path.getsize(os.path.join(first, 'data.bin')) == 10
+    assert len(file_cache.list()) == 1
+
+
+def test_file_cache_evicts_and_purges(tmp_path):
+    file_cache = cache.FileCache(str(tmp_path / 'cache'), max_bytes=25)
+    for key in ('a', 'b', 'c'):
+        file_cache.put(key, write_bytes(10))
+
+    assert not os.path.exists(file_cache.path('a'))
+    assert [e['key'] for e in file_cache.list()] == ['c', 'b']
+
+    file_cache.purge(['b'])
+    assert not os.path.exists(file_cache.path('b'))
+    file_cache.purge()
+    assert file_cache.list() == []
+    assert not os.path.exists(file_cache.path('c'))
+
+
+def test_remote_identity_is_revalidated_after_ttl(tmp_path):
+    root = str(tmp_path / 'cache')
+    with serve(b'remote data') as (url, received):
+        first = cache.FileCache(root, remote_ttl=3600).key('slr', [url])
+        # within the time to live, the stored validators are used
+        assert cache.FileCache(root, remote_ttl=3600).key('slr', [url]) == first
+        assert len(received) == 1
+
+        cache.FileCache(root, remote_ttl=0).key('slr', [url])
+        assert len(received) == 2
+
+    with open(os.path.join(root, 'remote.json')) as f:
+        assert json.load(f)[url]['identity'] == [url, None, None, len(b'remote data')]
+
+
+def test_remote_identity_falls_back_offline(tmp_path, monkeypatch):
+    root = str(tmp_path / 'cache')
+    with serve(b'remote data') as (url, _):
+        key = cache.FileCache(root).key('slr', [url])
+
+    def _offline(url):
+        raise URLError('offline')
+
+    monkeypatch.setattr(download, 'remote_identity', _offline)
+    assert cache.FileCache(root, remote_ttl=0).key('slr', [url]) == key
+    # there is nothing to fall back to for a url that was never checked
+    with pytest.raises(URLError):
+        cache.FileCache(root, remote_ttl=0).key('slr', [url + '?other'])
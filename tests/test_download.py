@@ -0,0 +1,204 @@
+"""
+Tests of overlay.download against a local HTTP server stand-in
+"""
+
+import io
+import os
+import re
+import time
+import hashlib
+import threading
+import contextlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import pytest
+
+from overlay import download
+
+GDB_MEMBERS = {
+    'NY_slr_final_dist.gdb/a00000001.gdbtable': b'table' * 2000,
+    'NY_slr_final_dist.gdb/a00000001.gdbtablx': b'index' * 300,
+    'NY_slr_final_dist.gdb/gdb': b'gdb',
+}
+OTHER_MEMBERS = {
+    'NY_slr_data_dist/NY_low_lying_areas.gdb/a00000001.gdbtable': b'low' * 4000,
+    'NY_slr_metadata/NY_slr_final_dist.xml': b'<metadata/>',
+    'readme.txt': b'Sea level rise data',
+}
+
+
+def make_archive(members):
+    """
+    Zip members in memory
+
+    Args:
+        members (dict): member bytes by name
+
+    Returns:
+        (bytes): the archive
+    """
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w', ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+@contextlib.contextmanager
+def serve(data, ranges=True, gate=None):
+    """
+    Serve bytes from a local HTTP server
+
+    Args:
+        data (bytes): body of every response
+        ranges (bool): True to answer range requests, otherwise the whole
+            body is sent with a 200
+        gate (threading.Event): if given, requests wait for it to be set
+
+    Yields:
+        (str, list): url of the data and the Range header of every request
+            received, None for requests without one
+    """
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            received.append(self.headers.get('Range'))
+            if gate is not None:
+                gate.wait()
+            match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+            if not ranges or match is None:
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(data)))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(data[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/NY_slr_data_dist.zip'.format(
+            server.server_address[1]), received
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def extracted(directory):
+    """
+    List the files under a directory by their path relative to it
+    """
+    return sorted(os.path.relpath(os.path.join(root, name), directory)
+                  for root, _, names in os.walk(directory) for name in names)
+
+
+def test_download_resumes_truncated_part_file(tmp_path):
+    data = make_archive(dict(GDB_MEMBERS, **OTHER_MEMBERS))
+    path = str(tmp_path / 'archive.zip')
+    with open(path + '.part', 'wb') as f:
+        f.write(data[:len(data) // 3])
+
+    with serve(data) as (url, received):
+        download.download(url, path, md5=hashlib.md5(data).hexdigest())
+
+    assert received == ['bytes={}-'.format(len(data) // 3)]
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(path + '.part')
+
+
+def test_download_restarts_when_server_ignores_ranges(tmp_path):
+    data = make_archive(GDB_MEMBERS)
+    path = str(tmp_path / 'archive.zip')
+    with open(path + '.part', 'wb') as f:
+        f.write(b'stale')
+
+    with serve(data, ranges=False) as (url, _):
+        download.download(url, path)
+
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_download_rejects_checksum_mismatch(tmp_path):
+    data = make_archive(GDB_MEMBERS)
+    path = str(tmp_path / 'archive.zip')
+
+    with serve(data) as (url, _):
+        with pytest.raises(IOError, match='md5'):
+            download.download(url, path, md5='0' * 32)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_extract_members_keeps_only_final_geodatabase(tmp_path, ranges):
+    data = make_archive(dict(GDB_MEMBERS, **OTHER_MEMBERS))
+    directory = str(tmp_path / 'slr')
+
+    with serve(data, ranges=ranges) as (url, received):
+        paths = download.extract_members(url, directory, block_size=4096)
+
+    assert extracted(directory) == sorted(GDB_MEMBERS)
+    assert sorted(paths) == sorted(os.path.join(directory, name)
+                                   for name in GDB_MEMBERS)
+    for name, member in GDB_MEMBERS.items():
+        with open(os.path.join(directory, name), 'rb') as f:
+            assert f.read() == member
+    if ranges:
+        # read in place, without transferring the whole archive
+        assert None not in received
+        assert 'bytes=0-' not in received
+
+
+def test_concurrent_extractions_share_one_download(tmp_path):
+    data = make_archive(dict(GDB_MEMBERS, **OTHER_MEMBERS))
+    directory = str(tmp_path / 'slr')
+    gate = threading.Event()
+    results = []
+    errors = []
+
+    def _extract():
+        try:
+            results.append(download.extract_members(url, directory))
+        except Exception as e:
+            errors.append(e)
+
+    with serve(data, ranges=False, gate=gate) as (url, received):
+        callers = [threading.Thread(target=_extract) for _ in range(2)]
+        for caller in callers:
+            caller.start()
+        # hold the first request until both callers have started
+        while not received:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        gate.set()
+        for caller in callers:
+            caller.join()
+
+    assert errors == []
+    # one probe and one download of the archive
+    assert len(received) == 2
+    assert len(results) == 2 and sorted(results[0]) == sorted(results[1])
+    assert extracted(directory) == sorted(GDB_MEMBERS)
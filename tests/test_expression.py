@@ -0,0 +1,113 @@
+"""
+Tests of compiling and running overlay expressions in overlay.expression
+"""
+
+import weakref
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from overlay import expression, kernels  # noqa: E402
+from overlay.expression import Expression, Layer, Program  # noqa: E402
+from overlay.kernels import NODATA  # noqa: E402
+
+
+class Record(Expression):
+    """
+    Copy of its argument that keeps a weak reference to every result
+    """
+
+    def __init__(self, arg):
+        self.args = [arg]
+        self.results = []
+
+    @property
+    def key(self):
+        return ('record', self.args[0].key)
+
+    def evaluate(self, cells):
+        result = cells.copy()
+        self.results.append(weakref.ref(result))
+        return result
+
+
+class Check(Expression):
+    """
+    Pass-through of its argument that notes whether the results of a
+        `Record` are still held when it runs
+    """
+
+    def __init__(self, arg, record):
+        self.args = [arg]
+        self.record = record
+        self.alive = None
+
+    @property
+    def key(self):
+        return ('check', self.args[0].key)
+
+    def evaluate(self, cells):
+        self.alive = [r() is not None for r in self.record.results]
+        return cells
+
+
+def test_program_computes_shared_subexpressions_once(monkeypatch):
+    calls = []
+    combine = kernels.combine
+
+    def _combine(a, b, op):
+        calls.append(op.__name__)
+        return combine(a, b, op)
+
+    monkeypatch.setattr(kernels, 'combine', _combine)
+    program = Program((Layer('a') + 1) * (Layer('a') + 1))
+    result = program.run({'a': np.array([[1, NODATA]], dtype=np.int32)})
+
+    assert program.inputs == ['a']
+    assert sorted(calls) == ['add', 'multiply']
+    assert result.tolist() == [[4, NODATA]]
+
+
+def test_program_releases_results_after_last_use():
+    record = Record(Layer('a'))
+    check = Check(record + 1, record)
+    result = Program(check).run({'a': np.array([[1, 2]], dtype=np.int32)})
+
+    assert result.tolist() == [[2, 3]]
+    assert check.alive == [False]
+
+
+def test_program_broadcasts_constant_results():
+    result = Program(expression.Constant(3) * 2).run(
+        {'a': np.zeros((2, 2), dtype=np.int32)})
+    assert result.dtype == np.int32
+    assert result.tolist() == [[6, 6], [6, 6]]
+
+
+def test_weighted_overlay_masks_by_base():
+    program = Program(expression.weighted_overlay({'flood': 1, 'storm_surge': 2}))
+    result = program.run({'flood': np.array([[1, 5, 5]], dtype=np.int32),
+                          'storm_surge': np.array([[3, 5, NODATA]], dtype=np.int32),
+                          'base': np.array([[1, NODATA, 1]], dtype=np.int32)})
+    assert sorted(program.inputs) == ['base', 'flood', 'storm_surge']
+    assert result.tolist() == [[4, NODATA, NODATA]]
+
+
+def test_score_range_of_weighted_overlay():
+    program = Program(expression.weighted_overlay({'flood': 1, 'storm_surge': 2}))
+    ranges = {'flood': (1, 5), 'storm_surge': (1, 5), 'base': (1, 1)}
+    assert program.score_range(ranges) == (0, 12)
+
+
+def test_score_range_of_negative_weights_and_reclassification():
+    ranges = {'a': (1, 5)}
+    assert Program((Layer('a') - 1) * -1).score_range(ranges) == (-4, 0)
+    reclassed = expression.Reclassify(Layer('a'), {1: 2, 5: 7},
+                                      replace_nodata_with=0)
+    assert Program(reclassed).score_range(ranges) == (0, 7)
+
+
+def test_score_range_needs_every_input():
+    with pytest.raises(ValueError, match='heat'):
+        Program(Layer('heat') + 1).score_range({'flood': (1, 5)})
@@ -0,0 +1,65 @@
+"""
+Tests of the web mercator tile grid in overlay.grid
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('rasterio')
+pytest.importorskip('shapely')
+
+from shapely.geometry import Point, box  # noqa: E402
+
+from overlay.grid import Grid, WORLD_EXTENT  # noqa: E402
+
+# zoom 12 tiles are 9783.94 meters wide, so the bounding box touches 3
+#   columns and 4 rows of tiles of 8 x 8 cells: the origin is on the top edge
+#   of row 2048
+BBOX = [0, 0, 20000, 20000]
+
+
+@pytest.fixture
+def grid():
+    return Grid(BBOX, tile_size=8)
+
+
+def test_grid_covers_bounding_box(grid):
+    assert (grid.col_min, grid.row_min, grid.cols, grid.rows) == (2048, 2045, 3, 4)
+    assert grid.shape == (32, 24)
+    xmin, ymin, xmax, ymax = grid.extent
+    assert xmin <= BBOX[0] and ymin <= BBOX[1]
+    assert xmax >= BBOX[2] and ymax >= BBOX[3]
+    assert xmax - xmin == pytest.approx(3 * 2 * WORLD_EXTENT / 2 ** 12)
+
+
+def test_keys(grid):
+    keys = grid.keys()
+    assert len(keys) == 12
+    assert keys[:4] == [(2048, 2045), (2049, 2045), (2050, 2045), (2048, 2046)]
+    assert keys[-1] == (2050, 2048)
+
+
+def test_tile_slice_matches_tile_extent(grid):
+    rows, cols = grid.tile_slice(2049, 2047)
+    assert (rows, cols) == (slice(16, 24), slice(8, 16))
+
+    # the cells of the slice span the extent of the tile
+    left, top = grid.extent[0], grid.extent[3]
+    extent = [left + cols.start * grid.cell_size, top - rows.stop * grid.cell_size,
+              left + cols.stop * grid.cell_size, top - rows.start * grid.cell_size]
+    assert extent == pytest.approx(grid.tile_extent(2049, 2047), abs=1e-6)
+
+
+def test_covering_keys(grid):
+    assert grid.covering_keys(box(100, 100, 200, 200)) == [(2048, 2047)]
+    assert sorted(grid.covering_keys(box(100, 100, 15000, 200))) == [(2048, 2047),
+                                                                     (2049, 2047)]
+    assert grid.covering_keys(box(0, 0, 0, 0)) == []
+    assert grid.covering_keys(None) == []
+
+
+def test_point_keys(grid):
+    points = [Point(1, 1), Point(15000, 15000), Point(99999, 5), Point(100, 19000)]
+    keys = grid.point_keys([p.x for p in points], [p.y for p in points])
+    # the point outside the grid is left out
+    assert keys == [(2048, 2046), (2048, 2047), (2049, 2046)]
@@ -0,0 +1,76 @@
+"""
+Tests of the NumPy map algebra in overlay.kernels
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from overlay import kernels  # noqa: E402
+from overlay.kernels import NODATA  # noqa: E402
+
+
+def cells(*rows):
+    """
+    Build int32 cells from rows of values
+    """
+    return np.array(rows, dtype=np.int32)
+
+
+def test_reclassify_exact_drops_unmatched_cells():
+    result = kernels.reclassify(cells([1, 2, 5, NODATA]), {1: 1, 5: 5})
+    assert result.dtype == np.int32
+    assert result.tolist() == [[1, NODATA, 5, NODATA]]
+
+
+def test_reclassify_replaces_nodata():
+    result = kernels.reclassify(cells([1, 2, 5, NODATA]), {1: 1, 5: 5},
+                                replace_nodata_with=1)
+    assert result.tolist() == [[1, NODATA, 5, 1]]
+
+
+def test_reclassify_greater_than_or_equal_to():
+    result = kernels.reclassify(cells([-1, 0, 2, 3, 9, 10, 50, NODATA]),
+                                {0: 1, 3: 3, 10: 5},
+                                kernels.GREATER_THAN_OR_EQUAL_TO)
+    # cells below the lowest break match nothing
+    assert result.tolist() == [[NODATA, 1, 1, 3, 3, 5, 5, NODATA]]
+
+
+def test_reclassify_less_than_or_equal_to():
+    result = kernels.reclassify(cells([0, 2, 3, 6, 7, NODATA]), {2: 5, 6: 3},
+                                kernels.LESS_THAN_OR_EQUAL_TO)
+    # cells above the highest break match nothing
+    assert result.tolist() == [[5, 5, 3, 3, NODATA, NODATA]]
+
+
+def test_reclassify_rejects_unknown_strategy():
+    with pytest.raises(ValueError, match='strategy'):
+        kernels.reclassify(cells([1]), {1: 1}, 'nearest')
+
+
+def test_union_with_base_fills_study_area():
+    hazard = cells([NODATA, 5], [5, NODATA])
+    base = cells([1, 1], [NODATA, NODATA])
+    assert kernels.union_with_base(hazard, base).tolist() == [[1, 5],
+                                                             [NODATA, NODATA]]
+
+
+def test_union_with_base_broadcasts_compressed_tiles():
+    # a uniform hazard tile, compressed to one cell, over a full base tile
+    result = kernels.union_with_base(cells([5]), cells([1, NODATA], [1, 1]))
+    assert result.tolist() == [[5, NODATA], [5, 5]]
+
+
+def test_threshold_with_base_scores_nodata_inside_base():
+    feet = cells([0, 3, 5, NODATA], [0, 3, 5, NODATA])
+    base = cells([1, 1, 1, 1], [NODATA, NODATA, NODATA, NODATA])
+    result = kernels.threshold_with_base(feet, base, 3)
+    # cells never inundated are no hazard inside the base, and no data outside
+    assert result.tolist() == [[5, 5, 1, 1], [NODATA] * 4]
+
+
+def test_local_min_and_max_ignore_nodata():
+    a, b = cells([1, NODATA, NODATA]), cells([3, 2, NODATA])
+    assert kernels.local_max(a, b).tolist() == [[3, 2, NODATA]]
+    assert kernels.local_min(a, b).tolist() == [[1, 2, NODATA]]
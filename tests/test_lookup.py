@@ -0,0 +1,69 @@
+"""
+Tests of finding boundary features by name or code in overlay.lookup
+"""
+
+import os
+
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+pytest.importorskip('fiona')
+pytest.importorskip('geopyspark')
+
+from shapely.geometry import box  # noqa: E402
+
+from overlay import lookup  # noqa: E402
+
+BOUNDARIES = [
+    {'NAME': 'Houston-The Woodlands-Sugar Land, TX', 'GEOID': '26420',
+     'CBSAFP': '26420', 'STATEFP': '48'},
+    {'NAME': 'Austin-Round Rock, TX', 'GEOID': '12420',
+     'CBSAFP': '12420', 'STATEFP': '48'},
+    {'NAME': 'Portland-Vancouver-Hillsboro, OR-WA', 'GEOID': '38900',
+     'CBSAFP': '38900', 'STATEFP': '41'},
+    {'NAME': 'Portland-South Portland, ME', 'GEOID': '38860',
+     'CBSAFP': '38860', 'STATEFP': '23'},
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    shp = str(tmp_path / 'cbsa.shp')
+    gpd.GeoDataFrame(BOUNDARIES,
+                     geometry=[box(i, 0, i + 1, 1) for i in range(len(BOUNDARIES))],
+                     crs={'init': 'epsg:4326'}).to_file(shp)
+    return lookup.BoundaryIndex(shp)
+
+
+def test_index_is_written_next_to_shapefile(index):
+    assert os.path.isfile(lookup.index_path(index.shp))
+    assert [r['fid'] for r in index.records] == [0, 1, 2, 3]
+    assert index.records[0]['name'] == 'houston the woodlands sugar land tx'
+
+
+@pytest.mark.parametrize('query, fids', [
+    # codes
+    ('26420', [0]),
+    (' 12420 ', [1]),
+    # exact normalized name
+    ('austin-round rock, tx', [1]),
+    # prefix matches before names that only contain the query
+    ('portland', [2, 3]),
+    ('south portland', [3]),
+    ('round rock', [1]),
+    # closest place by fuzzy matching
+    ('huston', [0]),
+    ('nowhere at all', []),
+])
+def test_find(index, query, fids):
+    assert index.find(query) == fids
+
+
+def test_find_in_state(index):
+    assert index.find('portland', state_fips='23') == [3]
+    assert index.find('houston', state_fips=41) == []
+
+
+def test_read_matching_features(index):
+    features = index.read(index.find('portland'))
+    assert features['GEOID'].tolist() == ['38900', '38860']
@@ -0,0 +1,78 @@
+"""
+Tests of run reports and their exports in overlay.metrics
+"""
+
+import json
+import logging
+
+import pytest
+
+from overlay import metrics
+
+
+@pytest.fixture
+def report():
+    report = metrics.Report('houston', labels={'host': 'node "1"'})
+    with report.span('build_layers'):
+        metrics.count('features_read', 10)
+        with metrics.span('flood'):
+            metrics.count('features_read', 5)
+            metrics.count('cache_hits')
+            logging.getLogger('overlay.layers').warning('no flood zones')
+    with pytest.raises(ValueError):
+        with report.span('overlay_layers'):
+            raise ValueError('bad expression')
+    report.count('bytes_written', 100)
+    report.gauge('tiles', 42)
+    return report
+
+
+def test_report_to_json(report, tmp_path):
+    path = str(tmp_path / 'report.json')
+    data = json.loads(report.to_json(path))
+
+    with open(path) as f:
+        assert json.load(f) == data
+    assert data['name'] == 'houston' and data['run_id'] == report.run_id
+    assert data['labels'] == {'host': 'node "1"'}
+    assert data['counters'] == {'features_read': 15, 'cache_hits': 1, 'bytes_written': 100}
+    assert data['gauges'] == {'tiles': 42}
+    assert list(data['stages']) == ['build_layers', 'build_layers/flood', 'overlay_layers']
+    assert data['stages']['build_layers']['counters'] == {'features_read': 10}
+    assert data['stages']['build_layers/flood']['counters'] == {'features_read': 5,
+                                                                'cache_hits': 1}
+    assert data['stages']['overlay_layers']['errors'] == 1
+    assert [span['stage'] for span in data['spans']] == ['build_layers/flood',
+                                                         'build_layers',
+                                                         'overlay_layers']
+    assert data['spans'][-1]['error'] == 'ValueError'
+    assert [(m['stage'], m['level'], m['message']) for m in data['messages']] == [
+        ('build_layers/flood', 'WARNING', 'no flood zones')]
+
+
+def test_report_to_prometheus(report, tmp_path):
+    path = str(tmp_path / 'overlay.prom')
+    text = report.to_prometheus(path, prefix='test')
+
+    with open(path) as f:
+        assert f.read() == text
+    lines = text.splitlines()
+    labels = 'host="node \\"1\\"",run="houston",run_id="{}"'.format(report.run_id)
+    assert '# TYPE test_stage_seconds gauge' in lines
+    assert 'test_stage_calls{{{},stage="build_layers/flood"}} 1.0'.format(labels) in lines
+    assert 'test_stage_errors{{{},stage="overlay_layers"}} 1.0'.format(labels) in lines
+    assert '# TYPE test_features_read_total counter' in lines
+    assert 'test_features_read_total{{{},stage="build_layers"}} 10.0'.format(labels) in lines
+    assert 'test_features_read_total{{{},stage="build_layers/flood"}} 5.0'.format(
+        labels) in lines
+    # counts made outside of any stage
+    assert 'test_bytes_written_total{{{},stage=""}} 100.0'.format(labels) in lines
+    assert 'test_tiles{{{}}} 42.0'.format(labels) in lines
+    assert '# HELP test_tiles {}'.format(metrics.GAUGES['tiles']) in lines
+
+
+def test_counts_without_report_do_nothing():
+    assert metrics.active() is None
+    metrics.count('features_read')
+    with metrics.span('stage'):
+        assert metrics.active() is None
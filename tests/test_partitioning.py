@@ -0,0 +1,87 @@
+"""
+Tests of the spatial partitioner in overlay.partitioning
+"""
+
+import pytest
+
+pytest.importorskip('pyspark')
+
+from overlay import constants  # noqa: E402
+from overlay.partitioning import SpatialPartitioner, partition_count  # noqa: E402
+
+# 4 x 2 block of tiles
+KEYS = [(col, row) for row in range(100, 102) for col in range(200, 204)]
+
+
+def test_partitions_hold_compact_blocks_of_equal_size():
+    partitioner = SpatialPartitioner(KEYS, tiles_per_partition=2)
+
+    assert partitioner.num_partitions == 4
+    partitions = [partitioner(key) for key in KEYS]
+    assert sorted(partitions) == [0, 0, 1, 1, 2, 2, 3, 3]
+    # neighbours along the Z-order curve share a partition
+    assert partitioner((200, 100)) == partitioner((201, 100))
+    assert partitioner((202, 101)) == partitioner((203, 101))
+
+
+def test_keys_outside_study_area_are_hashed():
+    partitioner = SpatialPartitioner(KEYS, tiles_per_partition=2)
+    assert partitioner((0, 0)) == partitioner((0, 0))
+    assert isinstance(partitioner((0, 0)), int)
+
+
+def test_partition_count():
+    assert partition_count(0, 4) == 1
+    assert partition_count(4, 4) == 1
+    assert partition_count(5, 4) == 2
+
+
+def test_equal_partitioners():
+    a = SpatialPartitioner(KEYS, tiles_per_partition=2)
+    b = SpatialPartitioner(list(reversed(KEYS)) + KEYS[:2], tiles_per_partition=2)
+    c = SpatialPartitioner(KEYS[:4], tiles_per_partition=2)
+    d = SpatialPartitioner(KEYS, tiles_per_partition=4)
+
+    assert a == b and not a != b
+    assert hash(a) == hash(b)
+    assert a != c and a != d
+    assert a != object()
+
+
+@pytest.fixture(scope='module')
+def spark_context():
+    from pyspark import SparkConf, SparkContext
+
+    return SparkContext.getOrCreate(SparkConf()
+                                    .setMaster(constants.BENCHMARK_SPARK_MASTER)
+                                    .setAppName('overlay-tests'))
+
+
+def test_partition_places_keys_by_partitioner(spark_context):
+    partitioner = SpatialPartitioner(KEYS, tiles_per_partition=2)
+    rdd = spark_context.parallelize([(key, i) for i, key in enumerate(KEYS)], 3)
+
+    partitioned = partitioner.partition(rdd)
+
+    assert partitioned.getNumPartitions() == partitioner.num_partitions
+    for index, pairs in enumerate(partitioned.glom().collect()):
+        assert all(partitioner(key) == index for key, _ in pairs)
+    assert sorted(partitioned.collect()) == sorted(rdd.collect())
+
+
+def test_partition_keeps_rdd_on_equal_partitioner(spark_context):
+    rdd = spark_context.parallelize([(key, 1) for key in KEYS])
+    partitioned = SpatialPartitioner(KEYS, tiles_per_partition=2).partition(rdd)
+
+    # an equal partitioner built separately doesn't shuffle again
+    again = SpatialPartitioner(KEYS, tiles_per_partition=2).partition(partitioned)
+    assert again is partitioned
+
+
+def test_cogroup_tags_values_by_rdd(spark_context):
+    partitioner = SpatialPartitioner(KEYS, tiles_per_partition=2)
+    a = spark_context.parallelize([(KEYS[0], 'a0'), (KEYS[1], 'a1')])
+    b = spark_context.parallelize([(KEYS[1], 'b1')])
+
+    grouped = dict(partitioner.cogroup([a, b]).mapValues(sorted).collect())
+    assert grouped == {KEYS[0]: [(0, 'a0')], KEYS[1]: [(0, 'a1'), (1, 'b1')]}
@@ -0,0 +1,47 @@
+"""
+Tests of grouping points by tile in overlay.sampling
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pyspark')
+
+from overlay import sampling  # noqa: E402
+
+# layout of 2 x 1 tiles of 4 x 4 cells of 1 x 1
+EXTENT = [0, 0, 8, 4]
+
+
+def test_group_by_tile():
+    xs = np.array([0.5, 5.5, 1.5, 9.0, 7.99, -0.5])
+    ys = np.array([3.5, 0.5, 2.5, 1.0, 0.01, 2.0])
+    groups = sampling.group_by_tile(xs, ys, EXTENT, 2, 1, 4, 4)
+
+    # points outside the layout are left out
+    assert sorted(groups) == [(0, 0), (1, 0)]
+    index, cell_rows, cell_cols = groups[(0, 0)]
+    assert index.tolist() == [0, 2]
+    assert cell_rows.tolist() == [0, 1]
+    assert cell_cols.tolist() == [0, 1]
+    index, cell_rows, cell_cols = groups[(1, 0)]
+    assert index.tolist() == [1, 4]
+    assert cell_rows.tolist() == [3, 3]
+    assert cell_cols.tolist() == [1, 3]
+
+
+def test_group_by_tile_reads_cells():
+    cells = np.arange(32).reshape(4, 8)
+    xs = np.random.RandomState(0).uniform(0, 8, 50)
+    ys = np.random.RandomState(1).uniform(0, 4, 50)
+    groups = sampling.group_by_tile(xs, ys, EXTENT, 2, 1, 4, 4)
+
+    values = np.full(len(xs), -1)
+    for (col, row), (index, cell_rows, cell_cols) in groups.items():
+        tile = cells[row * 4:(row + 1) * 4, col * 4:(col + 1) * 4]
+        values[index] = tile[cell_rows, cell_cols]
+    assert values.tolist() == cells[(4 - ys).astype(int), xs.astype(int)].tolist()
+
+
+def test_group_by_tile_without_points():
+    assert sampling.group_by_tile(np.array([]), np.array([]), EXTENT, 2, 1, 4, 4) == {}
@@ -0,0 +1,53 @@
+"""
+Tests of compressing uniform tiles in overlay.sparse
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('geopyspark')
+
+from overlay import sparse  # noqa: E402
+from overlay.kernels import NODATA  # noqa: E402
+
+
+@pytest.mark.parametrize('value', [1, 5, NODATA])
+def test_compress_uniform_tile_round_trip(value):
+    full = np.full((4, 4), value, dtype=np.int32)
+    compressed = sparse.compress(full)
+
+    assert compressed.shape == sparse.CONSTANT_SHAPE
+    assert compressed.dtype == np.int32
+    assert compressed[0, 0] == value
+    # compressing again is a no-op
+    assert sparse.compress(compressed) is compressed
+
+    expanded = sparse.expand(compressed, (4, 4))
+    assert expanded.shape == (4, 4)
+    assert (expanded == full).all()
+    # a writable copy, not a broadcast view
+    expanded[0, 0] = 0
+    assert compressed[0, 0] == value
+
+
+def test_compress_keeps_mixed_tile():
+    full = np.ones((4, 4), dtype=np.int32)
+    full[3, 2] = NODATA
+    assert sparse.compress(full) is full
+    assert sparse.expand(full, (4, 4)) is full
+
+
+@pytest.mark.parametrize('cell_type, dtype, no_data_value', [
+    ('int8', np.int8, -128),
+    ('uint8', np.uint8, 0),
+    ('int16raw', np.int16, None),
+    ('int32ud-1', np.int32, -1),
+    ('bool', np.uint8, None),
+])
+def test_cell_type_no_data(cell_type, dtype, no_data_value):
+    assert sparse.cell_type_no_data(cell_type) == (np.dtype(dtype), no_data_value)
+
+
+def test_cell_type_no_data_of_floats():
+    dtype, no_data_value = sparse.cell_type_no_data('float32')
+    assert dtype == np.float32 and np.isnan(no_data_value)
@@ -0,0 +1,58 @@
+"""
+Tests of counting and summarizing risk scores by zone in overlay.zonal
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('rasterio')
+pytest.importorskip('pyspark')
+
+from overlay import zonal  # noqa: E402
+from overlay.kernels import NODATA  # noqa: E402
+
+
+def test_zone_counts():
+    scores = np.array([[1, 2, 3], [NODATA, 9, 3]], dtype=np.int32)
+    zones = np.array([[1, 0, 2], [2, 2, 2]], dtype=np.int32)
+    counts = zonal.zone_counts(scores, zones, 2, (0, 3))
+
+    assert counts.shape == (3, 4)
+    # cells outside every zone in the first row; no data and scores out of
+    #   range aren't counted
+    assert counts.tolist() == [[0, 0, 1, 0],
+                               [0, 1, 0, 0],
+                               [0, 0, 0, 2]]
+
+
+def test_zone_counts_of_negative_scores():
+    scores = np.array([[-2, 0, 2]], dtype=np.int32)
+    zones = np.array([[1, 1, 1]], dtype=np.int32)
+    assert zonal.zone_counts(scores, zones, 1, (-2, 2)).tolist() == [[0, 0, 0, 0, 0],
+                                                                      [1, 0, 1, 0, 1]]
+
+
+def test_summarize():
+    counts = np.array([[0, 2, 2], [0, 0, 0]])
+    stats = zonal.summarize(counts, np.array(['a', 'b']), 10.0, np.array([0.0, 60.0]),
+                            at_risk_score=2, lowest_score=0)
+
+    assert stats['zone'].tolist() == ['a', 'b']
+    assert stats['cells'].tolist() == [4, 0]
+    assert stats['mean_score'][0] == pytest.approx(1.5)
+    assert np.isnan(stats['mean_score'][1])
+    assert stats['cells_at_risk'].tolist() == [2, 0]
+    # 2 cells of 10 x 10 meters at the equator
+    assert stats['area_at_risk_km2'].tolist() == pytest.approx([2e-4, 0.0])
+    assert [stats['score_{}'.format(s)].tolist() for s in range(3)] == [[0, 0],
+                                                                        [2, 0],
+                                                                        [2, 0]]
+
+
+def test_summarize_corrects_area_by_latitude():
+    counts = np.array([[0, 4], [0, 4]])
+    stats = zonal.summarize(counts, np.array([1, 2]), 1000.0, np.array([0.0, 60.0]),
+                            at_risk_score=1, lowest_score=0)
+    # web mercator cells at 60 degrees cover a quarter of the area
+    assert stats['area_at_risk_km2'].tolist() == pytest.approx([4.0, 1.0])